@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+
+import metrics
+
+BALANCE_CACHE_TTL = float(os.getenv('BALANCE_CACHE_TTL', '30'))
+
+LOOKUPS = metrics.Counter('balance_cache_lookups_total', 'Balance cache lookups by result (hit, miss, fresh or coalesced into a running fetch).', ('result',))
+INVALIDATIONS = metrics.Counter('balance_cache_invalidations_total', 'Balance cache entries invalidated by webhooks or own transfers.')
+STALENESS = metrics.Histogram('balance_cache_staleness_seconds', 'Age of the cached balance when it was served.', buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60))
+
+class BalanceCache:
+    """Per-wallet balance cache, kept fresh by webhook invalidation with a short TTL as safety net.
+
+    Concurrent lookups of the same wallet share a single upstream fetch."""
+
+    def __init__(self, fetch: Callable[[str], Awaitable[float]], ttl: float = BALANCE_CACHE_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self._entries: dict[str, tuple[float, float]] = {}
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._generations: dict[str, int] = {}
+
+    async def get(self, wallet_id: str, fresh: bool = False) -> float:
+        """fresh skips the cached entry, invalidations only reach the cache of the worker that received them."""
+        entry = None if fresh else self._entries.get(wallet_id)
+        if entry is not None:
+            balance, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                LOOKUPS.inc(result='hit')
+                STALENESS.observe(age)
+                return balance
+
+        task = self._inflight.get(wallet_id)
+        # a running fetch may have started before the caller's transfer or an invalidation, fresh never joins one
+        if task is None or fresh:
+            LOOKUPS.inc(result='fresh' if fresh else 'miss')
+            task = self._inflight[wallet_id] = asyncio.create_task(self._fetch(wallet_id))
+        else:
+            LOOKUPS.inc(result='coalesced')
+        return await asyncio.shield(task)
+
+    async def _fetch(self, wallet_id: str) -> float:
+        generation = self._generations.get(wallet_id, 0)
+        try:
+            balance = await self.fetch(wallet_id)
+        finally:
+            # a fresh lookup may have replaced this fetch with a newer one meanwhile
+            if self._inflight.get(wallet_id) is asyncio.current_task():
+                del self._inflight[wallet_id]
+        # an invalidation that arrived during the fetch may mean the result is already outdated, so don't keep it
+        if self._generations.get(wallet_id, 0) == generation:
+            self._entries[wallet_id] = (balance, time.monotonic())
+        return balance
+
+    def invalidate(self, wallet_id: str):
+        INVALIDATIONS.inc()
+        self._generations[wallet_id] = self._generations.get(wallet_id, 0) + 1
+        self._entries.pop(wallet_id, None)
@@ -0,0 +1,300 @@
+"""End-to-end benchmarks: the real handlers of bot.py and server.py against local Telegram, Circle, OpenAI and ENS stubs.
+
+    python -m bench.run [--scenario balance_storm group_split webhook_burst] [--requests 500] [--circle-latency 0.08] ...
+
+Results are printed and saved as JSON (bench/results/ by default), pass --compare with an earlier file to see the change.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+from bench import stubs
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO / 'bench' / 'results'
+BOT_TOKEN = '123456:bench'
+RATES = {'USD': 1.0, 'EUR': 0.92, 'VND': 25_000.0, 'IDR': 15_500.0, 'GBP': 0.79}
+SPLIT_RECIPIENTS = 10
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(latencies) / duration, 1) if duration else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0.0) * 1000, 2),
+    }
+
+def prepare_workspace(directory: pathlib.Path):
+    """The files the bot reads on startup, in a scratch directory so benchmarks never touch data/."""
+    from Crypto.PublicKey import RSA
+    setup = directory / 'data' / 'setup'
+    setup.mkdir(parents=True)
+    (directory / 'data' / 'users').mkdir()
+    shutil.copy(REPO / 'data' / 'setup' / 'BotCommand.schema.json', setup)
+    prompt = REPO / 'data' / 'setup' / 'system_prompt.txt'
+    if prompt.exists():
+        shutil.copy(prompt, setup)
+    else:
+        (setup / 'system_prompt.txt').write_text('Turn the message into a bot command following this schema:\n{transactionSchema}')
+    (setup / 'key.pub').write_bytes(RSA.generate(2048).publickey().export_key())
+    (directory / 'rates.json').write_text(json.dumps(RATES))
+
+def configure_environment(telegram: stubs.Stub, circle: stubs.Stub, openai: stubs.Stub, ens: stubs.Stub):
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': telegram.url,
+        'CIRCLE_API_URL': circle.url,
+        'IRIS_API_URL': circle.url,
+        'CIRCLE_API_KEY': 'bench',
+        'ENTITY_SECRET': 'ab' * 32,
+        'WALLET_SET_ID': 'bench',
+        'OPENAI_BASE_URL': f'{openai.url}/v1',
+        'OPENAI_API_KEY': 'bench',
+        'ENS_API_URL': ens.url,
+        'EXCHANGE_RATES_SOURCE': 'file:rates.json',
+    })
+    # measure the pipeline, not the admission control, unless the caller configured limits
+    os.environ.setdefault('RATE_LIMITS', json.dumps({command: {'user': [1e9, 1e9], 'chat': [1e9, 1e9]} for command in ('parse', 'balance', 'send', 'request', 'bulk')} | {'upstreams': {'openai': [1e9, 1e9], 'circle': [1e9, 1e9]}}))
+
+def create_users(count: int) -> list:
+    import definitions as defs
+    users = []
+    for i in range(count):
+        wallet = defs.Wallet.model_validate({
+            'id': str(uuid.uuid4()), 'address': '0x' + uuid.uuid4().hex + uuid.uuid4().hex[:8], 'blockchain': 'MATIC-AMOY',
+            'createDate': '2024-09-20T00:00:00Z', 'updateDate': '2024-09-20T00:00:00Z', 'custodyType': 'DEVELOPER', 'state': 'LIVE',
+            'walletSetId': 'bench', 'accountType': 'SCA', 'scaCore': 'circle_6900_singleowner_v1',
+        })
+        user = defs.User(telegram_id=10_000 + i, username=f'benchuser{i}', wallet=wallet)
+        user.save(f'data/users/{user.telegram_id}.json')
+        users.append(user)
+    return users
+
+class Updates:
+    def __init__(self):
+        self.ids = itertools.count(1)
+
+    def message(self, chat_id: int, user, text: str) -> dict:
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        return {'update_id': next(self.ids), 'message': {
+            'message_id': next(self.ids), 'date': int(time.time()), 'text': text, 'entities': entities,
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group', 'title': 'bench'},
+            'from': {'id': user.telegram_id, 'is_bot': False, 'first_name': user.username, 'username': user.username},
+        }}
+
+    def callback(self, message: dict, user, data: str) -> dict:
+        return {'update_id': next(self.ids), 'callback_query': {
+            'id': str(next(self.ids)), 'chat_instance': 'bench', 'data': data,
+            'from': {'id': user.telegram_id, 'is_bot': False, 'first_name': user.username, 'username': user.username},
+            'message': {'message_id': message['message_id'], 'date': int(time.time()), 'text': message['text'], 'chat': {'id': message['chat_id'], 'type': 'group', 'title': 'bench'}},
+        }}
+
+class Harness:
+    def __init__(self, application, telegram: stubs.TelegramStub, users: list, concurrency: int):
+        self.application = application
+        self.telegram = telegram
+        self.users = users
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.updates = Updates()
+
+    async def timed(self, coroutine_function, *args) -> tuple[float, bool]:
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                await coroutine_function(*args)
+            except Exception:
+                return time.perf_counter() - start, False
+            return time.perf_counter() - start, True
+
+    async def process(self, data: dict):
+        import telegram
+        await self.application.process_update(telegram.Update.de_json(data, self.application.bot))
+
+async def run_batch(harness: Harness, coroutine_function, arguments: list[tuple]) -> dict:
+    start = time.perf_counter()
+    results = await asyncio.gather(*(harness.timed(coroutine_function, *args) for args in arguments))
+    duration = time.perf_counter() - start
+    return summarize([latency for latency, ok in results if ok], sum(not ok for _, ok in results), duration)
+
+async def balance_storm(harness: Harness, requests: int) -> dict:
+    """Many users asking for their /balance at once, repeated users hit the balance cache."""
+    arguments = [(harness.updates.message(user.telegram_id, user, '/balance'),) for user in itertools.islice(itertools.cycle(harness.users), requests)]
+    return {'balance_storm': await run_batch(harness, harness.process, arguments)}
+
+async def group_split(harness: Harness, requests: int) -> dict:
+    """10-way splits in group chats: the message up to the confirmation, then the ✅ up to the submitted transfers."""
+    groups = []
+    for i in range(requests):
+        payer = harness.users[i % len(harness.users)]
+        recipients = [harness.users[(i + j) % len(harness.users)] for j in range(1, SPLIT_RECIPIENTS + 1)]
+        text = f"split {15 * SPLIT_RECIPIENTS}k vnd between {' '.join('@' + user.username for user in recipients)}"
+        groups.append((-(1_000_000 + i), payer, text))
+
+    def confirmation_of(chat_id: int):
+        return lambda entry: entry['method'] == 'sendMessage' and int(entry['params']['chat_id']) == chat_id and entry['params'].get('reply_markup')
+
+    confirmations = {chat_id: harness.telegram.wait_for(confirmation_of(chat_id)) for chat_id, _, _ in groups}
+    messages = await run_batch(harness, harness.process, [(harness.updates.message(chat_id, payer, text),) for chat_id, payer, text in groups])
+
+    callbacks = []
+    for chat_id, payer, _ in groups:
+        if not confirmations[chat_id].done():
+            confirmations[chat_id].cancel()
+            continue
+        params = confirmations[chat_id].result()['params']
+        confirm = next(button['callback_data'] for row in params['reply_markup']['inline_keyboard'] for button in row if button['callback_data'].startswith('confirm_send:'))
+        message = {'message_id': params['message_id'], 'chat_id': chat_id, 'text': params['text']}
+        callbacks.append((harness.updates.callback(message, payer, confirm),))
+    confirms = await run_batch(harness, harness.process, callbacks)
+    return {'group_split.message': messages, 'group_split.confirm': confirms}
+
+async def webhook_burst(harness: Harness, requests: int) -> dict:
+    """A burst of inbound transfer notifications, from the POST until the recipient was notified."""
+    import server
+    from constants import USDC_TOKEN_IDS
+    await server.start(harness.application, '127.0.0.1', 0)
+    port = server.runner.addresses[0][1]
+    done: dict[str, asyncio.Future] = {}
+    handle_circle_webhook = server.handle_circle_webhook
+
+    async def timed_handler(data):
+        try:
+            await handle_circle_webhook(data)
+        finally:
+            future = done.get(data.get('notificationId'))
+            if future is not None and not future.done():
+                future.set_result(None)
+    server.handle_circle_webhook = timed_handler
+
+    async def deliver(session: aiohttp.ClientSession, user):
+        notification_id = str(uuid.uuid4())
+        done[notification_id] = asyncio.get_running_loop().create_future()
+        payload = {'notificationId': notification_id, 'notificationType': 'transactions.inbound', 'notification': {
+            'id': str(uuid.uuid4()), 'state': 'CONFIRMED', 'walletId': user.wallet.id, 'blockchain': user.wallet.blockchain.value,
+            'tokenId': USDC_TOKEN_IDS[user.wallet.blockchain.value], 'amounts': ['5'], 'sourceAddress': harness.users[0].wallet.address,
+        }}
+        async with session.post(f'http://127.0.0.1:{port}/circle-webhook', json=payload) as response:
+            response.raise_for_status()
+        try:
+            await done[notification_id]
+        finally:
+            del done[notification_id]
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            users = itertools.islice(itertools.cycle(harness.users), requests)
+            return {'webhook_burst': await run_batch(harness, deliver, [(session, user) for user in users])}
+    finally:
+        server.handle_circle_webhook = handle_circle_webhook
+        await server.stop()
+
+SCENARIOS = {
+    'balance_storm': balance_storm,
+    'group_split': group_split,
+    'webhook_burst': webhook_burst,
+}
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results: dict, baseline: dict | None = None):
+    print(f"{'scenario':<22}{'count':>7}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results['scenarios'].items():
+        line = f"{name:<22}{result['count']:>7}{result['errors']:>8}{result['throughput_per_s']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+        previous = (baseline or {}).get('scenarios', {}).get(name)
+        if previous and previous['p95_ms']:
+            line += f"   p95 {result['p95_ms'] / previous['p95_ms'] - 1:+.0%}, ops/s {result['throughput_per_s'] / max(previous['throughput_per_s'], 1e-9) - 1:+.0%}"
+        print(line)
+
+async def run(args) -> dict:
+    telegram = stubs.TelegramStub(stubs.Behaviour(args.telegram_latency, error_rate=args.telegram_errors))
+    circle = stubs.CircleStub(stubs.Behaviour(args.circle_latency, error_rate=args.circle_errors))
+    openai = stubs.OpenAIStub(stubs.Behaviour(args.openai_latency, error_rate=args.openai_errors))
+    ens = stubs.EnsStub(stubs.Behaviour(args.ens_latency, error_rate=args.ens_errors))
+    for stub in (telegram, circle, openai, ens):
+        await stub.start()
+    configure_environment(telegram, circle, openai, ens)
+
+    # imported only now: the modules read their configuration and files at import time
+    import bot
+    import circle_api
+    logging.getLogger().setLevel(logging.WARNING)
+    # hedged LLM requests are cancelled mid-upload, the OpenAI stub logs each of those
+    logging.getLogger('aiohttp.server').setLevel(logging.CRITICAL)
+    application = bot.build_application(BOT_TOKEN, polling=False)
+    await application.initialize()
+    await bot.EXCHANGE_RATES.start()
+    harness = Harness(application, telegram, create_users(args.users), args.concurrency)
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': {},
+    }
+    try:
+        # the handlers print every parsed command and Circle response
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name in args.scenario:
+                results['scenarios'].update(await SCENARIOS[name](harness, args.requests))
+    finally:
+        await application.shutdown()
+        await circle_api.close_client()
+        bot.QR_CODES.close()
+        for stub in (telegram, circle, openai, ens):
+            await stub.stop()
+    results['upstream_requests'] = {name: {'requests': stub.behaviour.requests, 'errors': stub.behaviour.errors} for name, stub in (('telegram', telegram), ('circle', circle), ('openai', openai), ('ens', ens))}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight at the same time')
+    for name, latency in (('telegram', 0.03), ('circle', 0.08), ('openai', 0.8), ('ens', 0.05)):
+        parser.add_argument(f'--{name}-latency', type=float, default=latency, help='seconds')
+        parser.add_argument(f'--{name}-errors', type=float, default=0.0, help='share of failing requests')
+    parser.add_argument('--output', type=pathlib.Path, help=f'result file, defaults to a new file in {RESULTS_DIR}')
+    parser.add_argument('--compare', type=pathlib.Path, help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    output = (args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json").resolve()
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    with tempfile.TemporaryDirectory(prefix='nomnompay-bench-') as directory:
+        prepare_workspace(pathlib.Path(directory))
+        os.chdir(directory)
+        sys.path.insert(0, str(REPO))
+        results = asyncio.run(run(args))
+
+    print_results(results, baseline)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'Saved results to {output}')
+
+if __name__ == '__main__':
+    main()
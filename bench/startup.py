@@ -0,0 +1,146 @@
+"""Startup benchmark: how long a fresh bot process takes to import, to get ready and to answer its first update.
+
+    python -m bench.startup [--runs 5] [--output result.json] [--compare earlier.json]
+
+Every run is a new interpreter against the same local stubs as bench.run. It also reports the heavy modules
+that were loaded and the network connections that were opened while importing bot.py, both should stay empty.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pathlib
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+# bench.run and bench.stubs are imported inside the functions: they load aiohttp, which would make
+# the child's import of bot.py look faster than it is
+
+HEAVY_MODULES = ('web3', 'eth_abi', 'openai', 'Crypto', 'qrcode', 'PIL')
+METRICS = ('import_s', 'ready_s', 'first_update_s', 'process_s')
+
+async def measure_child(started_at: float) -> dict:
+    """Runs in the child process, the stubs and the environment are set up by the parent."""
+    connections = []
+    connect = socket.socket.connect
+
+    def recording_connect(sock, address):
+        connections.append(str(address))
+        return connect(sock, address)
+
+    socket.socket.connect = recording_connect
+    start = time.perf_counter()
+    import bot
+    import_s = time.perf_counter() - start
+    socket.socket.connect = connect
+    heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    import logging
+    from bench import run as bench_run
+    logging.getLogger().setLevel(logging.WARNING)
+    user = bench_run.create_users(1)[0]
+    application = bot.build_application(bench_run.BOT_TOKEN, polling=False)
+    harness = bench_run.Harness(application, None, [user], 1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        async with application:
+            await application.post_init(application)
+            ready_s = time.perf_counter() - start
+            update_start = time.perf_counter()
+            await harness.process(harness.updates.message(user.telegram_id, user, '/balance'))
+            first_update_s = time.perf_counter() - update_start
+            process_s = time.time() - started_at
+            await application.post_shutdown(application)
+    return {
+        'import_s': import_s,
+        'ready_s': ready_s,
+        'first_update_s': first_update_s,
+        'process_s': process_s,
+        'heavy_modules': heavy_modules,
+        'import_connections': connections,
+    }
+
+async def run(args) -> dict:
+    from bench import run as bench_run
+    from bench import stubs
+    telegram = stubs.TelegramStub(stubs.Behaviour(args.telegram_latency))
+    circle = stubs.CircleStub(stubs.Behaviour(args.circle_latency))
+    openai = stubs.OpenAIStub(stubs.Behaviour())
+    ens = stubs.EnsStub(stubs.Behaviour())
+    for stub in (telegram, circle, openai, ens):
+        await stub.start()
+    bench_run.configure_environment(telegram, circle, openai, ens)
+    env = {**os.environ, 'PYTHONPATH': str(bench_run.REPO), 'WEBHOOK_PORT': '0'}
+
+    runs = []
+    try:
+        for _ in range(args.runs):
+            started_at = time.time()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'bench.startup', '--child', str(started_at),
+                env=env, stdout=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(f'startup run failed with exit code {process.returncode}')
+            runs.append(json.loads(stdout.decode().strip().splitlines()[-1]))
+    finally:
+        for stub in (telegram, circle, openai, ens):
+            await stub.stop()
+
+    return {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': bench_run.git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'child')},
+        'startup': {name: {
+            'median_ms': round(statistics.median(result[name] for result in runs) * 1000, 1),
+            'max_ms': round(max(result[name] for result in runs) * 1000, 1),
+        } for name in METRICS},
+        'heavy_modules': sorted({name for result in runs for name in result['heavy_modules']}),
+        'import_connections': sorted({address for result in runs for address in result['import_connections']}),
+    }
+
+def print_results(results: dict, baseline: dict | None = None):
+    print(f"{'phase':<18}{'median ms':>12}{'max ms':>10}")
+    for name, result in results['startup'].items():
+        line = f"{name:<18}{result['median_ms']:>12}{result['max_ms']:>10}"
+        previous = (baseline or {}).get('startup', {}).get(name)
+        if previous and previous['median_ms']:
+            line += f"   median {result['median_ms'] / previous['median_ms'] - 1:+.0%}"
+        print(line)
+    print(f"heavy modules loaded on import: {', '.join(results['heavy_modules']) or 'none'}")
+    print(f"connections opened on import: {', '.join(results['import_connections']) or 'none'}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes to start')
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help='seconds')
+    parser.add_argument('--circle-latency', type=float, default=0.08, help='seconds')
+    parser.add_argument('--output', type=pathlib.Path, help='result file, defaults to a new file in bench/results/')
+    parser.add_argument('--compare', type=pathlib.Path, help='earlier result file to compare against')
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(asyncio.run(measure_child(args.child))))
+        return
+
+    from bench import run as bench_run
+    output = (args.output or bench_run.RESULTS_DIR / f"startup-{time.strftime('%Y%m%d-%H%M%S')}.json").resolve()
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    with tempfile.TemporaryDirectory(prefix='nomnompay-startup-') as directory:
+        bench_run.prepare_workspace(pathlib.Path(directory))
+        os.chdir(directory)
+        results = asyncio.run(run(args))
+
+    print_results(results, baseline)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'Saved results to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+# In-process stand-ins for the Telegram Bot API, Circle (W3S and Iris), OpenAI and the ENS API.
+# Every stub answers after a configurable latency and fails a configurable share of requests.
+
+class Behaviour:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+    async def delay(self) -> bool:
+        """Wait the simulated latency, False if this request should fail."""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return False
+        return True
+
+class Stub:
+    def __init__(self, behaviour: Behaviour):
+        self.behaviour = behaviour
+        self.runner: web.AppRunner | None = None
+        self.url = ''
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    async def start(self, host: str = '127.0.0.1'):
+        app = web.Application()
+        self.routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+class TelegramStub(Stub):
+    """Bot API methods used by the handlers. Sent and edited messages are recorded for the scenarios."""
+
+    def __init__(self, behaviour: Behaviour, username: str = 'NomNomPaybot'):
+        super().__init__(behaviour)
+        self.username = username
+        self.message_ids = itertools.count(1_000_000)
+        self.sent: list[dict] = []
+        self.waiters: list[tuple[callable, asyncio.Future]] = []
+
+    def routes(self, app: web.Application):
+        app.router.add_post('/bot{token}/{method}', self.handle)
+
+    def wait_for(self, predicate) -> asyncio.Future:
+        """Future resolved with the first message sent from now on that matches predicate."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((predicate, future))
+        return future
+
+    def _record(self, method: str, params: dict):
+        entry = {'method': method, 'params': params, 'time': time.perf_counter()}
+        self.sent.append(entry)
+        for waiter in list(self.waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(entry):
+                future.set_result(entry)
+                self.waiters.remove(waiter)
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'text': params.get('text', ''),
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if not await self.behaviour.delay():
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error: injected'}, status=500)
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'NomNomPay', 'username': self.username}
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            if isinstance(params.get('reply_markup'), str):
+                params['reply_markup'] = json.loads(params['reply_markup'])
+            result = self._message(params)
+            params.setdefault('message_id', result['message_id'])
+        else:
+            result = True
+        self._record(method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+class CircleStub(Stub):
+    """The W3S endpoints used in circle_api.py plus Iris attestations. Every wallet holds plenty of USDC."""
+
+    def __init__(self, behaviour: Behaviour, balance: float = 1_000_000.0):
+        super().__init__(behaviour)
+        self.balance = balance
+        self.transactions: dict[str, dict] = {}
+
+    def routes(self, app: web.Application):
+        app.router.add_post('/v1/w3s/developer/wallets', self.create_wallets)
+        app.router.add_put('/v1/w3s/wallets/{wallet_id}', self.update_wallet)
+        app.router.add_get('/v1/w3s/wallets/{wallet_id}/balances', self.balances)
+        app.router.add_post('/v1/w3s/developer/transactions/transfer', self.create_transaction)
+        app.router.add_post('/v1/w3s/developer/transactions/contractExecution', self.create_transaction)
+        app.router.add_get('/v1/w3s/transactions/{transaction_id}', self.get_transaction)
+        app.router.add_post('/v1/faucet/drips', self.empty)
+        app.router.add_get('/v1/attestations/{message_hash}', self.attestation)
+
+    async def _fail(self) -> web.Response | None:
+        if not await self.behaviour.delay():
+            return web.json_response({'code': 500, 'message': 'injected error'}, status=500)
+        return None
+
+    async def create_wallets(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        payload = await request.json()
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        wallets = [{
+            'id': str(uuid.uuid4()), 'address': '0x' + uuid.uuid4().hex + uuid.uuid4().hex[:8], 'blockchain': blockchain,
+            'createDate': now, 'updateDate': now, 'custodyType': 'DEVELOPER', 'state': 'LIVE',
+            'walletSetId': payload.get('walletSetId') or 'bench', 'accountType': payload.get('accountType', 'EOA'), 'scaCore': 'circle_6900_singleowner_v1',
+        } for blockchain in payload['blockchains'] for _ in range(payload['count'])]
+        return web.json_response({'data': {'wallets': wallets}})
+
+    async def update_wallet(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        return web.json_response({'data': {'wallet': {'id': request.match_info['wallet_id'], **(await request.json())}}})
+
+    async def balances(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        return web.json_response({'data': {'tokenBalances': [{'token': {'symbol': 'USDC'}, 'amount': str(self.balance)}]}})
+
+    async def create_transaction(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        payload = await request.json()
+        transaction = {'id': str(uuid.uuid4()), 'state': 'INITIATED', 'refId': payload.get('refId')}
+        self.transactions[transaction['id']] = transaction
+        return web.json_response({'data': {'id': transaction['id'], 'state': transaction['state']}})
+
+    async def get_transaction(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        transaction = self.transactions.get(request.match_info['transaction_id'])
+        if transaction is None:
+            return web.json_response({'code': 404, 'message': 'not found'}, status=404)
+        return web.json_response({'data': {'transaction': {**transaction, 'state': 'COMPLETE'}}})
+
+    async def empty(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        return web.Response(status=204)
+
+    async def attestation(self, request: web.Request) -> web.Response:
+        if error := await self._fail():
+            return error
+        return web.json_response({'status': 'complete', 'attestation': '0x' + 'ab' * 65})
+
+class OpenAIStub(Stub):
+    """Chat completions with structured output. Recipients and amounts are read from the message with a regex."""
+
+    def routes(self, app: web.Application):
+        app.router.add_post('/v1/chat/completions', self.completions)
+
+    @staticmethod
+    def command(message: str) -> dict:
+        recipients = re.findall(r'@\w+|0x[0-9a-fA-F]{40}|[\w-]+\.eth', message)
+        amounts = re.findall(r'(\d+(?:\.\d+)?)(k?)', message)
+        if not recipients or not amounts:
+            return {'type': 'unknown_command', 'transactions': None, 'request': None}
+        number, multiplier = amounts[0]
+        total = float(number) * (1000 if multiplier else 1)
+        share = total / len(recipients) if 'split' in message.lower() else total
+        return {'type': 'transfer_money', 'request': None, 'transactions': [{
+            'amount': round(share, 2), 'currency': 'USDC', 'recipient': recipient,
+            'recipient_type': 'username' if recipient.startswith('@') else 'ens' if recipient.endswith('.eth') else 'address',
+            'network': 'default', 'currency_type': 'token', 'equivalent_currency': None,
+        } for recipient in recipients]}
+
+    async def completions(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        if not await self.behaviour.delay():
+            return web.json_response({'error': {'message': 'injected error', 'type': 'server_error'}}, status=500)
+        message = payload['messages'][-1]['content']
+        return web.json_response({
+            'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()), 'model': payload['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': json.dumps(self.command(message)), 'refusal': None}}],
+            'usage': {'prompt_tokens': 1000, 'completion_tokens': 50, 'total_tokens': 1050},
+        })
+
+class EnsStub(Stub):
+    """Forward and reverse lookups, every *.eth name resolves to an address derived from it."""
+
+    def routes(self, app: web.Application):
+        app.router.add_get('/{query}', self.lookup)
+
+    async def lookup(self, request: web.Request) -> web.Response:
+        if not await self.behaviour.delay():
+            return web.json_response({'error': 'injected'}, status=500)
+        query = request.match_info['query'].lower()
+        if query.endswith('.eth'):
+            return web.json_response({'ens': query, 'address': '0x' + uuid.uuid5(uuid.NAMESPACE_DNS, query).hex + '00000000'})
+        return web.json_response({'error': 'not found'}, status=404)
@@ -1,21 +1,29 @@
-import io
 import os
+import asyncio
+import html
 import logging
+import math
 import pathlib
-from typing import Any
 import dotenv
-import qrcode
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 import telegram
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import filters, Application, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler
 import uuid
+import bulk_payout
+import callback_store
+import cctp_pipeline
 import circle_api
 import definitions as defs
-import circle_api
-import requests
+import ens_resolver
+import exchange_rates
+import intent_gate
+import metrics
+import qr_codes
+import rate_limit
+import transaction_tracker
 import txt2command
+import wallet_pool
 import server
-import threading
 from constants import *
 import json
 
@@ -28,7 +36,7 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-USD_EXCHANGE_RATES = requests.get('https://open.er-api.com/v6/latest/USD').json()['rates']
+EXCHANGE_RATES = exchange_rates.ExchangeRateService()
 
 def compose_transfer_money_message(transactions: list[defs.Transaction]):
     if len(transactions) == 0:
@@ -38,13 +46,13 @@ def compose_transfer_money_message(transactions: list[defs.Transaction]):
 
     for transaction in transactions:
         message_parts = [
-            f'• <b>{format_amount(transaction.get_amount_usd(USD_EXCHANGE_RATES))} USDC</b>']
+            f'• <b>{format_amount(transaction.get_amount_usd(EXCHANGE_RATES.table))} USDC</b>']
         if transaction.currency_type == defs.CurrencyType.FIAT:
             message_parts.append(f'({format_amount(transaction.amount)} {transaction.equivalent_currency})')
         if transaction.recipient_type == defs.RecipientType.ENS:
-            message_parts.append(f'to <b>{transaction.recipient}</b> ({get_ens_address(transaction.recipient)})')
+            message_parts.append(f'to <b>{html.escape(transaction.recipient)}</b> ({get_ens_address(transaction.recipient)})')
         else:
-            message_parts.append(f'to <b>{transaction.recipient}</b>')
+            message_parts.append(f'to <b>{html.escape(transaction.recipient)}</b>')
         if transaction.network != "default":
             message_parts.append(f'on {transaction.network}')
         output.append(' '.join(message_parts))
@@ -74,40 +82,29 @@ def create_payment_request(user: defs.User, amount: float | None = None) -> str:
     print(eip681_url)
     return eip681_url
 
-class CallbackDataEntry:
-    def __init__(self, telegram_id:int, data: Any):
-        self.telegram_id = telegram_id
-        self.data = data
+CALLBACK_DATA = callback_store.CallbackStore()
 
-class CallBackData:
-    def __init__(self):
-        self.data: dict[str, CallbackDataEntry] = {}
-    
-    def set(self, entry) -> str:
-        key = str(uuid.uuid4())
-        self.data[key] = entry
-        return key
-    
-    def get(self, key: str):
-        return self.data.pop(key)
-    
-    def verify_user(self, key: str, telegram_id: int) -> bool:
-        return key in self.data and self.data[key].telegram_id == telegram_id
+TRANSFER_CONCURRENCY = int(os.getenv('TRANSFER_CONCURRENCY', '5'))
 
-CALLBACK_DATA = CallBackData()
+WALLET_POOL = wallet_pool.WalletPool()
 
-def get_unregistered_wallet(blockchain: defs.Blockchain) -> defs.Wallet | None:
-    fresh_wallets_path = f'data/wallets/{blockchain.value}.json'
-    wallets = defs.Wallets.load(fresh_wallets_path)
-    for i, wallet in enumerate(wallets.wallets):
-        if wallet.ref_id is None:
-            wallet = wallets.wallets.pop(i)
-            wallets.save(fresh_wallets_path)
-            return wallet
-    return None
+QR_CODES = qr_codes.QrCodeCache()
 
 # commands and handlers
 
+async def admit(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, cost: float = 1) -> bool:
+    wait_time = rate_limit.LIMITER.admit(command, update.effective_user.id, update.effective_chat.id, cost)
+    if wait_time is None:
+        return True
+    if rate_limit.LIMITER.should_notify(update.effective_user.id, update.effective_chat.id, wait_time):
+        if math.isinf(wait_time):
+            text = "That is more than I can handle at once, please split it into smaller batches."
+        else:
+            text = f"Easy there, that was a lot of requests in a short time. Please try again in {math.ceil(wait_time)} seconds."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    return False
+
+@metrics.timed('bot')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -131,6 +128,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await context.bot.send_message(chat_id=user_id, text=f"Welcome {update.effective_user.first_name}! Select a network to initialize your wallet.", reply_markup=reply_markup)
 
+@metrics.timed('bot')
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -151,19 +149,24 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query_create_wallet(update, context)
         return
         
-        
-    if callback_key not in CALLBACK_DATA.data:
+    if command in ('confirm_payout', 'cancel_payout'):
+        payout = bulk_payout.PAYOUTS.get(callback_key)
+        owner_id = payout['telegram_id'] if payout is not None and payout['state'] == bulk_payout.AWAITING_CONFIRMATION else None
+    else:
+        entry = CALLBACK_DATA.peek(callback_key)
+        owner_id = entry.telegram_id if entry is not None else None
+    if owner_id is None:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="The button is not longer valid. Please type your command again.")
         return
     # if user not in callback data send error message
-    if not CALLBACK_DATA.verify_user(callback_key, update.effective_user.id):
-        if command == 'confirm_send':
+    if owner_id != update.effective_user.id:
+        if command in ('confirm_send', 'confirm_payout'):
             type_text = 'approve'
-        elif command == 'cancel_send':
+        elif command in ('cancel_send', 'cancel_payout'):
             type_text = 'cancel'
         else:
             return
-        allowed_user = defs.User.load_by_id(CALLBACK_DATA.data[callback_key].telegram_id)
+        allowed_user = defs.User.load_by_id(owner_id)
         if allowed_user:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=f"@{update.effective_user.username}, you are not allowed to {type_text} this transaction. Only @{allowed_user.username} can {type_text} this transaction.")
         else:
@@ -174,10 +177,15 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await internal_confirm_send(update, context)
     elif command == 'cancel_send':
         await internal_cancel_send(update, context)
+    elif command == 'confirm_payout':
+        await internal_confirm_payout(update, context)
+    elif command == 'cancel_payout':
+        await internal_cancel_payout(update, context)
 
 
 # queries
 
+@metrics.timed('bot')
 async def query_create_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -193,16 +201,15 @@ async def query_create_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     
     blockchain = defs.Blockchain(query.data.split(':')[1])
-    wallet = get_unregistered_wallet(blockchain)
+    wallet = await WALLET_POOL.claim(blockchain)
     if wallet is None:
-        await query.edit_message_text("No wallets available to create.")
-        # TODO batch generate new wallets if none is available
+        await query.edit_message_text("No wallets available to create. Please try again in a few minutes.")
         return
     
     user = defs.User(telegram_id=update.effective_user.id, username=update.effective_user.username or "", wallet=wallet)
-    circle_api.update_wallet(wallet.id, user.username, str(user.telegram_id))
+    await circle_api.update_wallet(wallet.id, user.username, str(user.telegram_id))
     
-    circle_api.request_from_faucet(user)
+    await circle_api.request_from_faucet(user)
     # TODO fech wallet after update
     
     user.save(f'data/users/{user.telegram_id}.json')
@@ -211,6 +218,7 @@ async def query_create_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # commands
 
+@metrics.timed('bot')
 async def fund(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -229,25 +237,18 @@ async def fund(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     eip681_url = create_payment_request(user, amount)
-
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(eip681_url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    bio = io.BytesIO()
-    img.save(bio, 'PNG')
-    bio.seek(0)
     
     metamask_deep_link = f"https://metamask.app.link/send/{eip681_url}"
 
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=bio,
+    await QR_CODES.send(
+        context.bot,
+        update.effective_chat.id,
+        eip681_url,
         caption=f"Scan this QR code with your mobile wallet to fund your wallet with {format_amount(amount)} USDC.\n\n<a href='{metamask_deep_link}'>Or click here to send directly via MetaMask</a>",
         parse_mode=telegram.constants.ParseMode.HTML
     )
 
+@metrics.timed('bot')
 async def show_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -259,17 +260,9 @@ async def show_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please /start the bot first.")
         return
 
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(user.wallet.address)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    bio = io.BytesIO()
-    img.save(bio, 'PNG')
-    bio.seek(0)
-
-    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=bio, caption=f"Scan this QR code or use this address to fund your wallet:\n\n{user.wallet.address}\n\nOnly send USDC to this address on {user.pretty_print_blockchain()}.")
+    await QR_CODES.send(context.bot, update.effective_chat.id, user.wallet.address, caption=f"Scan this QR code or use this address to fund your wallet:\n\n{user.wallet.address}\n\nOnly send USDC to this address on {user.pretty_print_blockchain()}.")
 
+@metrics.timed('bot')
 async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -282,7 +275,9 @@ async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
         return
     
-    usdc_balance = circle_api.get_user_usdc_balance(user)
+    if not await admit(update, context, 'balance'):
+        return
+    usdc_balance = await circle_api.get_user_usdc_balance(user)
     
     await context.bot.send_message(
         chat_id=update.effective_chat.id, 
@@ -290,6 +285,7 @@ async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=telegram.constants.ParseMode.HTML
     )
 
+@metrics.timed('bot')
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="""This bot makes easy payment to other users in USDC. 
 
@@ -303,8 +299,12 @@ To use the payment bot in a group, create your telegram group and add NomNomPayb
 Request payment:
 You can request a payment from another user by using the /request command, e.g. /request @username 10.50 [optional message]
 This will send a payment request to the specified user for the given amount in USDC, along with an optional message if provided.
+
+Bulk payouts:
+Send a CSV file with a recipient (telegram handle, address or ENS name), an amount and optionally a currency per line, e.g. @alice,25 or bob.eth,30,EUR. In a group, mention the bot in the caption. After one confirmation all recipients are paid and you get a report with the result of every line.
 """)
 
+@metrics.timed('bot')
 async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -336,6 +336,7 @@ async def send_money(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await internal_send_money(update, context, [transaction])
 
+@metrics.timed('bot')
 async def internal_send_money(update: Update, context: ContextTypes.DEFAULT_TYPE, transactions: list[defs.Transaction]):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -348,12 +349,14 @@ async def internal_send_money(update: Update, context: ContextTypes.DEFAULT_TYPE
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
         return
     
+    recipients = defs.User.load_by_usernames([transaction.recipient for transaction in transactions if transaction.recipient_type == defs.RecipientType.USERNAME])
+    ens_addresses = await ens_resolver.RESOLVER.resolve_many([transaction.recipient for transaction in transactions if transaction.recipient_type == defs.RecipientType.ENS])
     users_without_wallet = []
     for transaction in transactions:
         # TODO check also wallet address and ens, not only telegram username
-        if transaction.recipient_type == defs.RecipientType.USERNAME and not defs.User.load_by_username(transaction.recipient):
+        if transaction.recipient_type == defs.RecipientType.USERNAME and not recipients[transaction.recipient]:
             users_without_wallet.append(transaction.recipient)
-        elif transaction.recipient_type == defs.RecipientType.ENS and not get_ens_address(transaction.recipient):
+        elif transaction.recipient_type == defs.RecipientType.ENS and not ens_addresses[transaction.recipient]:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=f"ENS name {transaction.recipient} does not exist.")
             return
     
@@ -367,17 +370,18 @@ async def internal_send_money(update: Update, context: ContextTypes.DEFAULT_TYPE
             await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{users_without_wallet_text} do not have a wallet yet. Please ask them to start the bot and set one up first.")
         return
 
-    total_amount = sum(transaction.get_amount_usd(USD_EXCHANGE_RATES) for transaction in transactions)
-    if total_amount <= 0 or total_amount > circle_api.get_user_usdc_balance(user):
+    total_amount = sum(transaction.get_amount_usd(EXCHANGE_RATES.table) for transaction in transactions)
+    if total_amount <= 0 or total_amount > await circle_api.get_user_usdc_balance(user):
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have enough money in your account. Check your /balance and top up.")
         return
     
-    callback_key = CALLBACK_DATA.set(CallbackDataEntry(update.effective_user.id, transactions))
+    callback_key = CALLBACK_DATA.set(callback_store.CallbackEntry(update.effective_user.id, transactions))
 
     keyboard = [[InlineKeyboardButton("❌", callback_data=f'cancel_send:{callback_key}'), InlineKeyboardButton("✅", callback_data=f'confirm_send:{callback_key}')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=compose_transfer_money_message(transactions), reply_markup=reply_markup, parse_mode=telegram.constants.ParseMode.HTML)
 
+@metrics.timed('bot')
 async def internal_confirm_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -389,67 +393,110 @@ async def internal_confirm_send(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     callback_key = query.data.split(':')[1]
 
-    transactions = CALLBACK_DATA.get(callback_key).data
+    entry = CALLBACK_DATA.peek(callback_key)
+    if entry is None:
+        # already confirmed or cancelled, e.g. by a double tap
+        return
+    # charged on confirmation, where the transfers are submitted, a throttled confirmation can be tapped again
+    if not await admit(update, context, 'send', cost=len(entry.data)):
+        return
+    entry = CALLBACK_DATA.get(callback_key)
+    if entry is None:
+        return
+    transactions = entry.data
 
     user = defs.User.load_by_id(update.effective_user.id)
     if user is None: # should never happen
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
         return
-    total_amount = sum(transaction.get_amount_usd(USD_EXCHANGE_RATES) for transaction in transactions)
-    if total_amount <= 0 or total_amount > circle_api.get_user_usdc_balance(user):
+    total_amount = sum(transaction.get_amount_usd(EXCHANGE_RATES.table) for transaction in transactions)
+    if total_amount <= 0 or total_amount > await circle_api.get_user_usdc_balance(user, fresh=True):
         message = "You don't have enough money in your account. Check your /balance and top up."
         await update.callback_query.edit_message_text(f"{update.callback_query.message.text_html}\n\n❌ {message}", parse_mode=telegram.constants.ParseMode.HTML)
         return
 
-    transaction_ids = []
-    for transaction in transactions:
+    recipients = defs.User.load_by_usernames([transaction.recipient for transaction in transactions if transaction.recipient_type == defs.RecipientType.USERNAME])
+    ens_addresses = await ens_resolver.RESOLVER.resolve_many([transaction.recipient for transaction in transactions if transaction.recipient_type == defs.RecipientType.ENS])
+    semaphore = asyncio.Semaphore(TRANSFER_CONCURRENCY)
+    message_text = update.callback_query.message.text_html
+
+    async def send(transaction: defs.Transaction) -> tuple[str, defs.CircleTransaction | None]:
+        usd_amount = transaction.get_amount_usd(EXCHANGE_RATES.table)
+        line = f'{format_amount(usd_amount)} USDC to {html.escape(transaction.recipient)}'
         destination_chain = user.wallet.blockchain
         if transaction.recipient_type == defs.RecipientType.USERNAME:
-            recipient = defs.User.load_by_username(transaction.recipient)
+            recipient = recipients[transaction.recipient]
+            if recipient is None:
+                return f'❌ {line}: {html.escape(transaction.recipient)} does not have a wallet', None
             recipient_address = recipient.wallet.address
             if recipient.wallet.blockchain != user.wallet.blockchain:
                 destination_chain = recipient.wallet.blockchain
         elif transaction.recipient_type == defs.RecipientType.ENS:
-            recipient_address = get_ens_address(transaction.recipient)
+            recipient_address = ens_addresses[transaction.recipient]
             if recipient_address is None:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"ENS name {transaction.recipient} does not exist.")
-                continue
+                return f'❌ {line}: ENS name {html.escape(transaction.recipient)} does not exist', None
         else:
             recipient_address = transaction.recipient
-        internal_transaction_id = str(uuid.uuid4())
-        
-        usd_amount = transaction.get_amount_usd(USD_EXCHANGE_RATES)
+
         # descide between single and cross chain transfer
-        response = ''
-        message = ''
-        if user.wallet.blockchain == destination_chain:
-            transfer_type = defs.TransferType.SINGLE_CHAIN
-            response = circle_api.send_transfer(user.wallet.id, recipient_address, USDC_TOKEN_IDS[user.wallet.blockchain.value], usd_amount, internal_transaction_id)
-            message = 'Money sent successfully!'
-        else:
-            transfer_type = defs.TransferType.CROSS_CHAIN
-            response = circle_api.cctp_burn_step_1(user, usd_amount, f'{internal_transaction_id}:approve')
-            message = 'Money sent successfully! (This is a cross chain transfer and takes 15 minutes to complete.)'
-            print('Cross chain transfer initiated')
-        
-        # transaction_ids.append(response['data']['id'])
-        defs.CircleTransaction(
-            id=response['data']['id'],
+        circle_transaction = defs.CircleTransaction(
+            ref_id=str(uuid.uuid4()),
+            id='',
             user_id=update.effective_user.id,
             chat_id=update.effective_chat.id,
             message_id=update.effective_message.message_id,
-            state=response['data']['state'],
-            transfer_type=transfer_type,
-            transaction=transaction
-        ).save(f'data/transactions/{internal_transaction_id}.json')
-    
-    await update.callback_query.edit_message_text(f"{update.callback_query.message.text_html}\n\n✅ {message}", parse_mode=telegram.constants.ParseMode.HTML)
-    # TODO transaction are initiated, but not completed yet, add check and update message if transaction is completed
+            state=transaction_tracker.SUBMITTING,
+            transfer_type=defs.TransferType.SINGLE_CHAIN if user.wallet.blockchain == destination_chain else defs.TransferType.CROSS_CHAIN,
+            transaction=transaction,
+            message_text=message_text
+        )
+        # stored before submitting, Circle's webhook can arrive before its response does
+        circle_transaction.save()
+        if circle_transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+            cctp_pipeline.PIPELINE.register(circle_transaction.ref_id, user, recipient, usd_amount)
+        try:
+            async with semaphore:
+                if circle_transaction.transfer_type is defs.TransferType.SINGLE_CHAIN:
+                    response = await circle_api.send_transfer(user.wallet.id, recipient_address, USDC_TOKEN_IDS[user.wallet.blockchain.value], usd_amount, circle_transaction.ref_id)
+                    status = f'⏳ {line}: submitted'
+                else:
+                    response = await circle_api.cctp_burn_step_1(user, usd_amount, f'{circle_transaction.ref_id}:approve', idempotency_key=cctp_pipeline.idempotency_key(circle_transaction.ref_id, 'approve'))
+                    status = f'⏳ {line}: submitted (cross chain, takes about 15 minutes)'
+                    logging.debug(f"Cross chain transfer {circle_transaction.ref_id} initiated")
+        except Exception:
+            logging.exception(f"Transfer {circle_transaction.ref_id} failed")
+            if circle_transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+                # Circle may have the approve nevertheless, the pipeline resubmits it with the same key and reports the outcome
+                return f'⏳ {line}: not confirmed by Circle yet, checking again (cross chain)', circle_transaction
+            circle_transaction.delete()
+            cctp_pipeline.PIPELINE.discard(circle_transaction.ref_id)
+            return f'❌ {line}: failed, please try again', None
+        if 'data' not in response:
+            circle_transaction.delete()
+            cctp_pipeline.PIPELINE.discard(circle_transaction.ref_id)
+            return f'❌ {line}: {html.escape(response.get("message", "failed, please try again"))}', None
+
+        circle_transaction = circle_transaction.set_submitted(response['data']['id'], response['data']['state'], transaction_tracker.SUBMITTING)
+        if circle_transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+            cctp_pipeline.PIPELINE.approve_submitted(circle_transaction.ref_id, circle_transaction.id)
+        return status, circle_transaction
+
+    results = await asyncio.gather(*(send(transaction) for transaction in transactions))
+
+    failed_lines = [line for line, circle_transaction in results if circle_transaction is None]
+    if failed_lines:
+        # keep the failures in the message when the tracker later reports the final states, reloaded as the tracker may have updated them meanwhile
+        stored_transactions = [defs.CircleTransaction.load(circle_transaction.ref_id) for _, circle_transaction in results if circle_transaction is not None]
+        for stored_transaction in stored_transactions:
+            stored_transaction.message_text = message_text + '\n\n' + '\n'.join(failed_lines)
+        defs.CircleTransaction.save_many(stored_transactions)
+
+    await update.callback_query.edit_message_text(message_text + '\n\n' + '\n'.join(line for line, _ in results), parse_mode=telegram.constants.ParseMode.HTML)
     # TODO add webhook that informs users about incoming transfers
-    # TODO handle cross chain transfer
 
 
 
+@metrics.timed('bot')
 async def internal_cancel_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is None:
         logging.error(f"Invalid update object, missing callback query or message: {update}")
@@ -457,9 +504,106 @@ async def internal_cancel_send(update: Update, context: ContextTypes.DEFAULT_TYP
     
     query = update.callback_query
     callback_key = query.data.split(':')[1]
-    CALLBACK_DATA.get(callback_key) # to invalidate the confirm button
+    if CALLBACK_DATA.get(callback_key) is None: # to invalidate the confirm button
+        return
     await update.callback_query.edit_message_text(f"{update.callback_query.message.text_html}\n\n❌ Transaction cancelled.", parse_mode=telegram.constants.ParseMode.HTML)
 
+# bulk payouts
+
+def compose_payout_message(file_name: str, rows: list[bulk_payout.PayoutRow], max_errors: int = 10) -> str:
+    valid = [row for row in rows if row.error is None]
+    invalid = [row for row in rows if row.error is not None]
+    output = [f'Pay the recipients in {html.escape(file_name)}:']
+    if valid:
+        output.append(f'• <b>{format_amount(sum(row.usd_amount for row in valid))} USDC</b> to {len(valid)} recipients')
+    if invalid:
+        output.append(f'• {len(invalid)} rows can not be paid and are skipped:')
+        output.extend(f'  line {row.line}: {html.escape(row.recipient or "(empty)")}, {html.escape(row.error)}' for row in invalid[:max_errors])
+        if len(invalid) > max_errors:
+            output.append(f'  and {len(invalid) - max_errors} more, all of them are listed in the report')
+    return '\n'.join(output)
+
+@metrics.timed('bot')
+async def handle_payout_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat is None or update.effective_user is None:
+        logging.error(f"Invalid update object, missing effective chat or user: {update}")
+        return
+    if update.message is None or update.message.document is None:
+        logging.error(f"Invalid update object, missing document: {update}")
+        return
+    # in groups only files meant for the bot, other members may share CSV files too
+    if update.effective_chat.type in ['group', 'supergroup'] and f'@{context.bot.username}'.lower() not in (update.message.caption or '').lower():
+        return
+
+    user = defs.User.load_by_id(update.effective_user.id)
+    if user is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > bulk_payout.BULK_MAX_FILE_SIZE:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="The file is too large, please split the payout into several files.")
+        return
+    if not await admit(update, context, 'bulk'):
+        return
+
+    telegram_file = await context.bot.get_file(document.file_id)
+    try:
+        rows = bulk_payout.parse_csv(bytes(await telegram_file.download_as_bytearray()))
+    except ValueError as e:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{e} Please send a CSV file with a recipient (username, address or ENS name), an amount and optionally a currency per line.")
+        return
+    await bulk_payout.validate(rows, user, EXCHANGE_RATES.table)
+    file_name = document.file_name or 'payout.csv'
+    text = compose_payout_message(file_name, rows)
+    if all(row.error is not None for row in rows):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{text}\n\nThere is nothing to pay, please fix the file and send it again.", parse_mode=telegram.constants.ParseMode.HTML)
+        return
+    total_amount = sum(row.usd_amount for row in rows if row.error is None)
+    if total_amount > await circle_api.get_user_usdc_balance(user):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"{text}\n\nYou don't have enough money in your account. Check your /balance and top up.", parse_mode=telegram.constants.ParseMode.HTML)
+        return
+
+    payout_id = bulk_payout.PAYOUTS.create(update.effective_user.id, update.effective_chat.id, file_name, rows)
+    keyboard = [[InlineKeyboardButton("❌", callback_data=f'cancel_payout:{payout_id}'), InlineKeyboardButton("✅", callback_data=f'confirm_payout:{payout_id}')]]
+    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=telegram.constants.ParseMode.HTML)
+    bulk_payout.PAYOUTS.set_message(payout_id, message.message_id)
+
+@metrics.timed('bot')
+async def internal_confirm_payout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat is None or update.effective_user is None:
+        logging.error(f"Invalid update object, missing effective chat or user: {update}")
+        return
+    if update.callback_query is None:
+        logging.error(f"Invalid update object, missing callback query: {update}")
+        return
+
+    payout_id = update.callback_query.data.split(':')[1]
+    user = defs.User.load_by_id(update.effective_user.id)
+    if user is None: # should never happen
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
+        return
+    if bulk_payout.PAYOUTS.pending_total(payout_id) > await circle_api.get_user_usdc_balance(user, fresh=True):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have enough money in your account. Check your /balance and top up.")
+        return
+    payout = bulk_payout.PAYOUTS.confirm(payout_id)
+    if payout is None:
+        # already confirmed or cancelled, e.g. by a double tap
+        return
+    await update.callback_query.edit_message_text(f"{update.callback_query.message.text_html}\n\n⏳ Paying out, the report follows once all transfers are submitted.", parse_mode=telegram.constants.ParseMode.HTML)
+    bulk_payout.PAYOUTS.start(payout)
+
+@metrics.timed('bot')
+async def internal_cancel_payout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query is None:
+        logging.error(f"Invalid update object, missing callback query or message: {update}")
+        return
+
+    payout_id = update.callback_query.data.split(':')[1]
+    if bulk_payout.PAYOUTS.cancel(payout_id) is None:
+        return
+    await update.callback_query.edit_message_text(f"{update.callback_query.message.text_html}\n\n❌ Payout cancelled.", parse_mode=telegram.constants.ParseMode.HTML)
+
+@metrics.timed('bot')
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -469,13 +613,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # Check if it's a group chat
     if update.effective_chat.type in ['group', 'supergroup']:
-        # Only process messages containing 'send', 'transfer', or 'split'
-        if not any(keyword in update.message.text.lower() for keyword in ['send', 'transfer', 'split']):
-            return  # Exit the function if none of the keywords are present
+        # Only process messages that look like a payment or talk to the bot
+        if not intent_gate.should_parse(update.message.text or "", context.bot.username):
+            return
     
-    await update.effective_chat.send_action(telegram.constants.ChatAction.TYPING)
-
-    bot_command = txt2command.parse_message(update.message.text or "")
+    bot_command = txt2command.parse_message_locally(update.message.text or "")
+    if bot_command is None:
+        if not await admit(update, context, 'parse'):
+            return
+        await update.effective_chat.send_action(telegram.constants.ChatAction.TYPING)
+        bot_command = await txt2command.parse_message_with_llm(update.message.text or "")
     print(bot_command.model_dump_json(indent=4))
 
     match bot_command.type:
@@ -494,6 +641,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         case defs.CommandType.SHOW_ADDRESS:
             await show_address(update, context)
 
+        case defs.CommandType.HELP:
+            await show_help(update, context)
+
         case defs.CommandType.REQUEST:
             if bot_command.request:
                 await internal_request_payment(update, context, bot_command.request)
@@ -521,9 +671,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text="Unexpected command type. Please try again."
             )
 
+@metrics.timed('bot')
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, I didn't understand that command.")
 
+@metrics.timed('bot')
 async def request_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -552,6 +704,7 @@ async def request_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await internal_request_payment(update, context, request)
 
+@metrics.timed('bot')
 async def internal_request_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, request: defs.Request):
     if update.effective_chat is None or update.effective_user is None:
         logging.error(f"Invalid update object, missing effective chat or user: {update}")
@@ -561,6 +714,8 @@ async def internal_request_payment(update: Update, context: ContextTypes.DEFAULT
     if requester is None:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You don't have a wallet yet. Please start the bot first.")
         return
+    if not await admit(update, context, 'request'):
+        return
 
     recipient_user = defs.User.load_by_username(request.target_username.lstrip('@'))
     if recipient_user is None:
@@ -578,12 +733,12 @@ async def internal_request_payment(update: Update, context: ContextTypes.DEFAULT
     )
 
 
-    callback_key = CALLBACK_DATA.set(CallbackDataEntry(recipient_user.telegram_id, [transaction]))
+    callback_key = CALLBACK_DATA.set(callback_store.CallbackEntry(recipient_user.telegram_id, [transaction]))
 
     keyboard = [[InlineKeyboardButton("❌", callback_data=f'cancel_send:{callback_key}'), InlineKeyboardButton("✅", callback_data=f'confirm_send:{callback_key}')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    request_message = f"@{requester.username} is requesting {format_amount(transaction.get_amount_usd(USD_EXCHANGE_RATES))} USDC"
+    request_message = f"@{requester.username} is requesting {format_amount(transaction.get_amount_usd(EXCHANGE_RATES.table))} USDC"
     if request.equivalent_currency:
         request_message += f" ({request.amount} {request.equivalent_currency})"
     request_message += " from you."
@@ -597,7 +752,7 @@ async def internal_request_payment(update: Update, context: ContextTypes.DEFAULT
             text=request_message, 
             reply_markup=reply_markup
         )
-        confirmation_message = f"Payment request for {format_amount(transaction.get_amount_usd(USD_EXCHANGE_RATES))} USDC"
+        confirmation_message = f"Payment request for {format_amount(transaction.get_amount_usd(EXCHANGE_RATES.table))} USDC"
         if request.equivalent_currency:
             confirmation_message += f" ({request.amount} {request.equivalent_currency})"
         confirmation_message += f" has been sent to {request.target_username}."
@@ -613,13 +768,47 @@ async def internal_request_payment(update: Update, context: ContextTypes.DEFAULT
             text=f"Unable to send payment request to {request.target_username}. They may have blocked the bot or never interacted with it."
         )
 
-if __name__ == '__main__':
-    bot_token = os.getenv('BOT_TOKEN')
-    if not bot_token:
-        raise ValueError("No BOT_TOKEN found in environment variables")
+BACKGROUND_TASKS: list[asyncio.Task] = []
+
+# with several worker processes only the primary one serves the Circle webhook and runs the background jobs
+IS_PRIMARY = True
+# the other workers serve their own /metrics on WEBHOOK_PORT + WORKER_INDEX
+WORKER_INDEX = 0
+
+async def post_init(application):
+    bulk_payout.PAYOUTS.bot = application.bot
+    if not IS_PRIMARY:
+        await server.start_metrics(port=server.WEBHOOK_PORT + WORKER_INDEX if server.WEBHOOK_PORT else 0)
+        await EXCHANGE_RATES.start()
+        BACKGROUND_TASKS.append(asyncio.create_task(EXCHANGE_RATES.follow()))
+        return
+    await server.start(application)
+    await EXCHANGE_RATES.start()
+    BACKGROUND_TASKS.append(asyncio.create_task(EXCHANGE_RATES.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(WALLET_POOL.run()))
+    transaction_tracker.TRACKER.bot = application.bot
+    BACKGROUND_TASKS.append(asyncio.create_task(transaction_tracker.TRACKER.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(cctp_pipeline.PIPELINE.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(bulk_payout.PAYOUTS.run()))
+
+async def post_shutdown(application):
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await server.stop()
+    txt2command.save_command_cache()
+    QR_CODES.close()
+    await circle_api.close_client()
+
+def build_application(bot_token: str, polling: bool = True) -> Application:
+    builder = ApplicationBuilder().token(bot_token).post_init(post_init).post_shutdown(post_shutdown)
+    if os.getenv('TELEGRAM_API_URL'):
+        # e.g. a local Bot API server or the stub used by the benchmarks
+        builder = builder.base_url(f"{os.getenv('TELEGRAM_API_URL')}/bot")
+    if not polling:
+        # updates are handed over by multi_worker instead
+        builder = builder.updater(None)
+    application = builder.build()
 
-    application = ApplicationBuilder().token(bot_token).build()
-    
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('address', show_address))
     application.add_handler(CommandHandler('fund', fund))
@@ -629,9 +818,17 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('request', request_payment))
     application.add_handler(CallbackQueryHandler(button_click))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_handler(MessageHandler(filters.Document.FileExtension('csv') | filters.Document.MimeType('text/csv'), handle_payout_file))
     application.add_handler(MessageHandler(filters.COMMAND, unknown))
-    
-    server.bot_application = application
-    threading.Thread(target=server.app.run, kwargs={'port': 5000}).start()
+    return application
+
+if __name__ == '__main__':
+    bot_token = os.getenv('BOT_TOKEN')
+    if not bot_token:
+        raise ValueError("No BOT_TOKEN found in environment variables")
 
-    application.run_polling()
\ No newline at end of file
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        import multi_worker
+        multi_worker.main(bot_token)
+    else:
+        build_application(bot_token).run_polling()
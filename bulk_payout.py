@@ -0,0 +1,438 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+
+import telegram
+
+import cctp_pipeline
+import circle_api
+import definitions as defs
+import ens_resolver
+import fast_parser
+import metrics
+import storage
+import transaction_tracker
+from constants import *
+from exchange_rates import RateTable
+from utils import format_amount
+
+# Payouts to many recipients from an uploaded CSV file with one recipient (username, address or ENS name), amount and
+# optional currency per line. Every row is validated when the file arrives, the owner confirms the whole payout once and
+# the transfers then run in the background. Each row keeps its own refId and idempotency key from the start, so a payout
+# interrupted by a crash is picked up again without paying anyone twice.
+
+BULK_PAYOUT_PATH = os.getenv('BULK_PAYOUT_PATH', 'data/bulk_payouts.db')
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', '500'))
+BULK_MAX_FILE_SIZE = 1024 * 1024
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '5'))
+BULK_CONFIRM_TTL = float(os.getenv('BULK_CONFIRM_TTL', str(24 * 3600)))
+BULK_POLL_TICK = 30.0
+# a running payout is leased for this long and renewed while it runs, if the process dies it is resumed afterwards
+LEASE_SECONDS = 120.0
+MAX_ATTEMPTS = 3
+
+AWAITING_CONFIRMATION = 'AWAITING_CONFIRMATION'
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+CANCELLED = 'CANCELLED'
+
+# row states
+PENDING = 'PENDING'
+SUBMITTED = 'SUBMITTED'
+APPROVAL_SUBMITTED = 'APPROVAL_SUBMITTED'    # cross chain, cctp_pipeline burns and mints once the approve is through
+FAILED = 'FAILED'
+SKIPPED = 'SKIPPED'    # invalid when the file was uploaded, never sent
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payouts (
+    id TEXT PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    file_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payouts_state ON payouts (state, leased_until);
+CREATE TABLE IF NOT EXISTS payout_rows (
+    payout_id TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    recipient TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    usd_amount REAL,
+    transaction_json TEXT,
+    address TEXT,
+    destination_chain TEXT,
+    state TEXT NOT NULL,
+    ref_id TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    circle_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (payout_id, line)
+);
+"""
+
+HEADER_NAMES = {
+    'recipient': 'recipient', 'username': 'recipient', 'user': 'recipient', 'address': 'recipient', 'ens': 'recipient',
+    'to': 'recipient', 'wallet': 'recipient', 'amount': 'amount', 'value': 'amount', 'currency': 'currency',
+}
+USERNAME_PATTERN = re.compile(r'\w{5,32}')
+RECIPIENT_PATTERN = re.compile(fast_parser.RECIPIENT)
+AMOUNT_PATTERN = re.compile(fast_parser.AMOUNT)
+REPORT_STATUS = {SUBMITTED: 'submitted', APPROVAL_SUBMITTED: 'approval submitted (cross chain)', FAILED: 'failed', SKIPPED: 'skipped', PENDING: 'not sent'}
+
+PAYOUT_ROWS = metrics.Counter('bulk_payout_rows_total', 'Rows of confirmed bulk payouts by outcome (submitted, failed or skipped).', ('status',))
+
+class PayoutRow:
+    def __init__(self, line: int, recipient: str, amount: str, currency: str):
+        self.line = line
+        self.recipient = recipient
+        self.amount = amount
+        self.currency = currency
+        self.transaction: defs.Transaction | None = None
+        self.usd_amount: float | None = None
+        self.address: str | None = None
+        self.destination_chain: defs.Blockchain | None = None
+        self.error: str | None = None
+
+def parse_row(line: int, values: list[str], columns: dict[str, int], decimal_comma: bool = False) -> PayoutRow:
+    def get(name: str) -> str:
+        index = columns.get(name)
+        return values[index].strip() if index is not None and index < len(values) else ''
+
+    row = PayoutRow(line, get('recipient'), get('amount'), get('currency'))
+    recipient = row.recipient
+    if USERNAME_PATTERN.fullmatch(recipient) and not recipient.lower().startswith('0x'):
+        recipient = f'@{recipient}'
+    if not RECIPIENT_PATTERN.fullmatch(recipient.lower()):
+        row.error = 'not a username, address or ENS name'
+        return row
+    match = AMOUNT_PATTERN.fullmatch(row.amount.lower())
+    number = match['number'] if match else ''
+    if decimal_comma and not fast_parser.THOUSANDS.fullmatch(number):
+        number = number.replace(',', '.')
+    amount = fast_parser.parse_amount(number, match['multiplier']) if match else None
+    if not amount:
+        row.error = 'ambiguous amount, write it without thousands separator' if fast_parser.DOT_THOUSANDS.fullmatch(number) else 'invalid amount'
+        return row
+    suffix = match['suffix']
+    if row.currency:
+        if suffix and suffix != row.currency.lower():
+            row.error = 'the amount and the currency column disagree'
+            return row
+        suffix = row.currency.lower()
+    currency = fast_parser.parse_currency(match['prefix'], suffix)
+    if currency is None:
+        row.error = 'unknown currency'
+        return row
+    is_token = currency in ('USDC', 'USD')
+    row.transaction = defs.Transaction(
+        amount=amount,
+        currency='USDC',
+        recipient=recipient,
+        recipient_type=fast_parser.parse_recipient(recipient.lower()),
+        network='default',
+        currency_type=defs.CurrencyType.TOKEN if is_token else defs.CurrencyType.FIAT,
+        equivalent_currency=None if is_token else currency
+    )
+    return row
+
+def parse_csv(data: bytes, max_rows: int = BULK_MAX_ROWS) -> list[PayoutRow]:
+    """One PayoutRow per non-empty line, rows that cannot be paid carry an error. Raises ValueError for unusable files."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("The file is not a UTF-8 encoded CSV file.")
+    # spreadsheets in locales with a decimal comma export with semicolons, csv.Sniffer often mistakes those for commas
+    first_line = text.lstrip().partition('\n')[0]
+    delimiter = '\t' if '\t' in first_line else ';' if ';' in first_line else ','
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    records = [(reader.line_num, values) for values in reader if any(value.strip() for value in values)]
+    if not records:
+        raise ValueError("The file is empty.")
+
+    columns = {'recipient': 0, 'amount': 1, 'currency': 2}
+    names = [value.strip().lower() for value in records[0][1]]
+    if any(name in HEADER_NAMES for name in names):
+        columns = {}
+        for index, name in enumerate(names):
+            columns.setdefault(HEADER_NAMES.get(name), index)
+        if 'recipient' not in columns or 'amount' not in columns:
+            raise ValueError("The header needs a recipient (or username, address, ens) and an amount column.")
+        records = records[1:]
+    if len(records) > max_rows:
+        raise ValueError(f"The file has {len(records)} rows, at most {max_rows} can be paid at once.")
+    return [parse_row(line, values, columns, decimal_comma=delimiter != ',') for line, values in records]
+
+async def validate(rows: list[PayoutRow], user: defs.User, rates: RateTable):
+    """Resolve all recipients and amounts in one batch, rows that cannot be paid get an error."""
+    valid = [row for row in rows if row.error is None]
+    usernames = [row.transaction.recipient for row in valid if row.transaction.recipient_type == defs.RecipientType.USERNAME]
+    recipients = await asyncio.to_thread(defs.User.load_by_usernames, usernames)
+    ens_addresses = await ens_resolver.RESOLVER.resolve_many([row.transaction.recipient for row in valid if row.transaction.recipient_type == defs.RecipientType.ENS])
+    for row in valid:
+        transaction = row.transaction
+        try:
+            row.usd_amount = transaction.get_amount_usd(rates)
+        except KeyError:
+            row.error = f'no exchange rate for {transaction.equivalent_currency}'
+            continue
+        if row.usd_amount <= 0:
+            row.error = 'amount too small'
+            continue
+        row.destination_chain = user.wallet.blockchain
+        if transaction.recipient_type == defs.RecipientType.USERNAME:
+            recipient = recipients[transaction.recipient]
+            if recipient is None:
+                row.error = f'{transaction.recipient} does not have a wallet yet'
+                continue
+            row.address = recipient.wallet.address
+            row.destination_chain = recipient.wallet.blockchain
+        elif transaction.recipient_type == defs.RecipientType.ENS:
+            row.address = ens_addresses[transaction.recipient]
+            if row.address is None:
+                row.error = f'ENS name {transaction.recipient} does not exist'
+        else:
+            row.address = transaction.recipient
+
+class BulkPayouts:
+    """Persistent bulk payouts: stores the validated rows, runs confirmed payouts and resumes the interrupted ones."""
+
+    def __init__(self, path: str = BULK_PAYOUT_PATH, concurrency: int = BULK_CONCURRENCY):
+        self.path = path
+        self.concurrency = concurrency
+        self.bot: telegram.Bot | None = None
+        self._db: storage.Database | None = None
+        self._db_lock = threading.Lock()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def db(self) -> storage.Database:
+        with self._db_lock:
+            if self._db is None:
+                self._db = storage.get_database(self.path)
+                self._db.executescript(SCHEMA)
+            return self._db
+
+    def get(self, payout_id: str) -> dict | None:
+        rows = self.db.execute('SELECT * FROM payouts WHERE id = ?', (payout_id,))
+        return dict(rows[0]) if rows else None
+
+    def rows(self, payout_id: str) -> list[dict]:
+        return [dict(row) for row in self.db.execute('SELECT * FROM payout_rows WHERE payout_id = ? ORDER BY line', (payout_id,))]
+
+    def _update(self, payout_id: str, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f'UPDATE payouts SET {assignments} WHERE id = ?', (*fields.values(), payout_id))
+
+    def _update_row(self, payout_id: str, line: int, **fields):
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f'UPDATE payout_rows SET {assignments} WHERE payout_id = ? AND line = ?', (*fields.values(), payout_id, line))
+
+    def create(self, telegram_id: int, chat_id: int, file_name: str, rows: list[PayoutRow]) -> str:
+        payout_id = secrets.token_urlsafe(12)
+        now = time.time()
+        with self.db.transaction() as connection:
+            connection.execute(
+                'INSERT INTO payouts (id, telegram_id, chat_id, file_name, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (payout_id, telegram_id, chat_id, file_name, AWAITING_CONFIRMATION, now, now)
+            )
+            connection.executemany(
+                'INSERT INTO payout_rows (payout_id, line, recipient, amount, currency, usd_amount, transaction_json, address, destination_chain, state, ref_id, idempotency_key, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(
+                    payout_id, row.line, row.recipient, row.amount, row.currency, row.usd_amount,
+                    row.transaction.model_dump_json() if row.transaction else None, row.address,
+                    row.destination_chain.value if row.destination_chain else None,
+                    SKIPPED if row.error else PENDING, str(uuid.uuid4()), str(uuid.uuid4()), row.error
+                ) for row in rows]
+            )
+        return payout_id
+
+    def set_message(self, payout_id: str, message_id: int):
+        self._update(payout_id, message_id=message_id)
+
+    def pending_total(self, payout_id: str) -> float:
+        rows = self.db.execute('SELECT COALESCE(SUM(usd_amount), 0) AS total FROM payout_rows WHERE payout_id = ? AND state = ?', (payout_id, PENDING))
+        return rows[0]['total']
+
+    def _transition(self, payout_id: str, from_state: str, to_state: str) -> dict | None:
+        """Move a payout awaiting confirmation on, a single statement so a double tap confirms or cancels only once."""
+        now = time.time()
+        rows = self.db.execute(
+            'UPDATE payouts SET state = ?, leased_until = ?, updated_at = ? WHERE id = ? AND state = ? AND created_at > ? RETURNING *',
+            (to_state, now + LEASE_SECONDS, now, payout_id, from_state, now - BULK_CONFIRM_TTL)
+        )
+        return dict(rows[0]) if rows else None
+
+    def confirm(self, payout_id: str) -> dict | None:
+        return self._transition(payout_id, AWAITING_CONFIRMATION, RUNNING)
+
+    def cancel(self, payout_id: str) -> dict | None:
+        return self._transition(payout_id, AWAITING_CONFIRMATION, CANCELLED)
+
+    def claim_stale(self) -> list[dict]:
+        """Lease the running payouts whose process stopped renewing them."""
+        now = time.time()
+        rows = self.db.execute(
+            'UPDATE payouts SET leased_until = ?, updated_at = ? WHERE state = ? AND leased_until <= ? RETURNING *',
+            (now + LEASE_SECONDS, now, RUNNING, now)
+        )
+        return [dict(row) for row in rows]
+
+    def start(self, payout: dict):
+        """Run a confirmed payout in the background, the handler that confirmed it returns right away."""
+        task = asyncio.create_task(self.execute(payout))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _renew_lease(self, payout_id: str):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            self._update(payout_id, leased_until=time.time() + LEASE_SECONDS)
+
+    async def execute(self, payout: dict):
+        renewal = asyncio.create_task(self._renew_lease(payout['id']))
+        try:
+            user = defs.User.load_by_id(payout['telegram_id'])
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def send(row: dict):
+                async with semaphore:
+                    await self.send_row(user, payout, row)
+
+            await asyncio.gather(*(send(row) for row in self.rows(payout['id']) if row['state'] == PENDING))
+            await self.finish(payout)
+        except Exception:
+            # the lease runs out and the payout is resumed by the next claim_stale
+            logging.exception(f"Bulk payout {payout['id']} failed")
+        finally:
+            renewal.cancel()
+
+    async def send_row(self, user: defs.User, payout: dict, row: dict):
+        transaction = defs.Transaction.model_validate_json(row['transaction_json'])
+        destination_chain = defs.Blockchain(row['destination_chain'])
+        recipient = None
+        if destination_chain != user.wallet.blockchain:
+            recipient = await asyncio.to_thread(defs.User.load_by_username, transaction.recipient)
+            if recipient is None:
+                self._update_row(payout['id'], row['line'], state=FAILED, error=f'{transaction.recipient} does not have a wallet anymore')
+                return
+        # tracked like any other transfer, without message_text the tracker leaves the payout message alone.
+        # Stored before submitting, Circle's webhook can arrive before its response does
+        circle_transaction = defs.CircleTransaction(
+            ref_id=row['ref_id'],
+            id='',
+            user_id=payout['telegram_id'],
+            chat_id=payout['chat_id'],
+            message_id=payout['message_id'],
+            state=transaction_tracker.SUBMITTING,
+            transfer_type=defs.TransferType.SINGLE_CHAIN if destination_chain == user.wallet.blockchain else defs.TransferType.CROSS_CHAIN,
+            transaction=transaction
+        )
+        try:
+            circle_transaction.save()
+            if recipient is not None:
+                cctp_pipeline.PIPELINE.register(row['ref_id'], user, recipient, row['usd_amount'])
+        except Exception as e:
+            # only this row fails, otherwise every resume of the payout would stop at it again
+            logging.exception(f"Bulk payout {payout['id']} line {row['line']} could not be stored")
+            self._update_row(payout['id'], row['line'], state=FAILED, error=f'could not be stored: {e}')
+            circle_transaction.delete()
+            cctp_pipeline.PIPELINE.discard(row['ref_id'])
+            return
+        response = None
+        # a row resumed after its last attempt is sent once more, with the same key Circle returns the transfer if it got it
+        for attempt in range(min(row['attempts'], MAX_ATTEMPTS - 1), MAX_ATTEMPTS):
+            self._update_row(payout['id'], row['line'], attempts=attempt + 1)
+            try:
+                # the stored idempotency key makes a repeated request return the transfer Circle already created,
+                # 429 and 5xx answers raise and are retried, any other answer is final
+                if circle_transaction.transfer_type is defs.TransferType.SINGLE_CHAIN:
+                    response = await circle_api.send_transfer(user.wallet.id, row['address'], USDC_TOKEN_IDS[user.wallet.blockchain.value], row['usd_amount'], row['ref_id'], idempotency_key=row['idempotency_key'])
+                else:
+                    response = await circle_api.cctp_burn_step_1(user, row['usd_amount'], f"{row['ref_id']}:approve", idempotency_key=cctp_pipeline.idempotency_key(row['ref_id'], 'approve'))
+                break
+            except Exception as e:
+                logging.warning(f"Bulk payout {payout['id']} line {row['line']} attempt {attempt + 1} failed: {e!r}")
+                await asyncio.sleep(2 ** attempt)
+        if response is None and circle_transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+            # Circle may have the approve nevertheless, the pipeline resubmits it with the same key and finishes or fails the transfer
+            self._update_row(payout['id'], row['line'], state=APPROVAL_SUBMITTED, error='not confirmed by Circle yet, checked again in the background')
+            return
+        if response is None or 'data' not in response:
+            error = 'Circle did not answer' if response is None else response.get('message', 'rejected by Circle')
+            self._update_row(payout['id'], row['line'], state=FAILED, error=error)
+            circle_transaction.delete()
+            cctp_pipeline.PIPELINE.discard(row['ref_id'])
+            return
+        circle_transaction = circle_transaction.set_submitted(response['data']['id'], response['data']['state'], transaction_tracker.SUBMITTING)
+        if circle_transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+            cctp_pipeline.PIPELINE.approve_submitted(row['ref_id'], circle_transaction.id)
+            self._update_row(payout['id'], row['line'], state=APPROVAL_SUBMITTED, circle_id=circle_transaction.id)
+        else:
+            self._update_row(payout['id'], row['line'], state=SUBMITTED, circle_id=circle_transaction.id)
+
+    def report(self, payout_id: str) -> bytes:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['line', 'recipient', 'amount', 'currency', 'usdc_amount', 'status', 'transaction_id', 'error'])
+        for row in self.rows(payout_id):
+            writer.writerow([
+                row['line'], row['recipient'], row['amount'], row['currency'],
+                round(row['usd_amount'], 6) if row['usd_amount'] is not None else '',
+                REPORT_STATUS[row['state']], row['circle_id'] or '', row['error'] or ''
+            ])
+        return output.getvalue().encode()
+
+    async def finish(self, payout: dict):
+        counts = {state: 0 for state in REPORT_STATUS}
+        total = 0.0
+        for row in self.rows(payout['id']):
+            counts[row['state']] += 1
+            if row['state'] in (SUBMITTED, APPROVAL_SUBMITTED):
+                total += row['usd_amount']
+        summary = f"Payout finished: {counts[SUBMITTED] + counts[APPROVAL_SUBMITTED]} transfers with {format_amount(total)} USDC submitted"
+        if counts[APPROVAL_SUBMITTED]:
+            summary += f" ({counts[APPROVAL_SUBMITTED]} of them cross chain, these take about 15 minutes more)"
+        summary += f", {counts[FAILED]} failed, {counts[SKIPPED]} skipped."
+        if self.bot is not None:
+            # sent before the payout is marked done, after a crash in between the report is sent once more
+            try:
+                await self.bot.edit_message_text(chat_id=payout['chat_id'], message_id=payout['message_id'], text=f"✅ {summary}")
+                await self.bot.send_document(
+                    chat_id=payout['chat_id'],
+                    document=telegram.InputFile(self.report(payout['id']), filename=f"payout-report-{payout['file_name'].removesuffix('.csv')}.csv"),
+                    caption=summary,
+                    reply_to_message_id=payout['message_id']
+                )
+            except telegram.error.TelegramError:
+                logging.exception(f"Failed to send the report of bulk payout {payout['id']}")
+        self._update(payout['id'], state=DONE)
+        for state in (SUBMITTED, APPROVAL_SUBMITTED, FAILED, SKIPPED):
+            PAYOUT_ROWS.inc(counts[state], status=REPORT_STATUS[state])
+
+    async def run(self, tick: float = BULK_POLL_TICK):
+        """Resume payouts interrupted by a crash or restart, meant to run as a background task on the primary worker."""
+        while True:
+            try:
+                for payout in self.claim_stale():
+                    logging.info(f"Resuming bulk payout {payout['id']}")
+                    self.start(payout)
+            except Exception:
+                logging.exception("Resuming bulk payouts failed")
+            await asyncio.sleep(tick)
+
+PAYOUTS = BulkPayouts()
@@ -0,0 +1,81 @@
+import json
+import os
+import secrets
+import time
+
+import definitions as defs
+import storage
+
+# Pending confirmations behind the inline ✅/❌ buttons. Kept in SQLite so they survive restarts and are
+# shared by every bot process using the same file, set CALLBACK_STORE_PATH to :memory: to keep them in process.
+
+CALLBACK_STORE_PATH = os.getenv('CALLBACK_STORE_PATH', 'data/callbacks.db')
+CALLBACK_TTL = float(os.getenv('CALLBACK_TTL', str(24 * 3600)))
+CALLBACK_STORE_SIZE = int(os.getenv('CALLBACK_STORE_SIZE', '100000'))
+PURGE_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS callbacks (
+    key TEXT PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS callbacks_expires_at ON callbacks (expires_at);
+"""
+
+class CallbackEntry:
+    def __init__(self, telegram_id: int, data: list[defs.Transaction]):
+        self.telegram_id = telegram_id
+        self.data = data
+
+def serialize(transactions: list[defs.Transaction]) -> str:
+    return json.dumps([transaction.model_dump(mode='json', exclude_defaults=True) for transaction in transactions], separators=(',', ':'))
+
+def deserialize(data: str) -> list[defs.Transaction]:
+    return [defs.Transaction.model_validate(transaction) for transaction in json.loads(data)]
+
+class CallbackStore:
+    """Expiring, size-capped store of the transactions a callback button confirms, keyed by a short random token."""
+
+    def __init__(self, path: str = CALLBACK_STORE_PATH, ttl: float = CALLBACK_TTL, max_size: int = CALLBACK_STORE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._db: storage.Database | None = None
+        self._puts = 0
+
+    @property
+    def db(self) -> storage.Database:
+        if self._db is None:
+            self._db = storage.Database(self.path) if self.path == ':memory:' else storage.get_database(self.path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def set(self, entry: CallbackEntry) -> str:
+        # 16 characters keep the button's callback_data well below Telegram's 64 byte limit
+        key = secrets.token_urlsafe(12)
+        self.db.execute('INSERT INTO callbacks VALUES (?, ?, ?, ?)', (key, entry.telegram_id, time.time() + self.ttl, serialize(entry.data)))
+        self._puts += 1
+        if self._puts % PURGE_EVERY == 0:
+            self.purge()
+        return key
+
+    def peek(self, key: str) -> CallbackEntry | None:
+        rows = self.db.execute('SELECT telegram_id, data FROM callbacks WHERE key = ? AND expires_at > ?', (key, time.time()))
+        if not rows:
+            return None
+        return CallbackEntry(rows[0]['telegram_id'], deserialize(rows[0]['data']))
+
+    def get(self, key: str) -> CallbackEntry | None:
+        """Remove and return the entry, only one caller ever gets it so a double tap cannot confirm twice."""
+        rows = self.db.execute('DELETE FROM callbacks WHERE key = ? RETURNING telegram_id, expires_at, data', (key,))
+        if not rows or rows[0]['expires_at'] <= time.time():
+            return None
+        return CallbackEntry(rows[0]['telegram_id'], deserialize(rows[0]['data']))
+
+    def purge(self):
+        """Drop expired entries and, above max_size, the ones closest to expiry."""
+        with self.db.transaction() as connection:
+            connection.execute('DELETE FROM callbacks WHERE expires_at <= ?', (time.time(),))
+            connection.execute('DELETE FROM callbacks WHERE key IN (SELECT key FROM callbacks ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_size,))
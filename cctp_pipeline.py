@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+
+import circle_api
+import definitions as defs
+import storage
+import transaction_tracker
+
+# Cross-chain transfers go approve -> depositForBurn on the source chain (both Circle transactions, driven by
+# their webhooks) -> attestation by Circle's Iris service -> receiveMessage on the destination chain.
+# Every transfer is tracked here from the moment its approve is submitted, one row per transfer, so transfers
+# survive restarts and lost webhooks.
+
+CCTP_PIPELINE_PATH = os.getenv('CCTP_PIPELINE_PATH', 'data/cctp.db')
+CCTP_POLL_TICK = float(os.getenv('CCTP_POLL_TICK', '2'))
+CCTP_BATCH_SIZE = int(os.getenv('CCTP_BATCH_SIZE', '50'))
+MIN_RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 60.0
+# a row is leased for this long while it is being worked on, if the process dies it is picked up again afterwards
+LEASE_SECONDS = 120.0
+MAX_MINT_ATTEMPTS = 5
+MAX_TRANSFER_AGE = 24 * 3600.0
+# an approve Circle has not confirmed within this long is given up
+MAX_APPROVE_AGE = 15 * 60.0
+
+APPROVING = 'APPROVING'  # approve submitted to Circle
+BURNING = 'BURNING'      # depositForBurn submitted to Circle
+BURNED = 'BURNED'        # waiting for the message and its attestation
+ATTESTED = 'ATTESTED'    # attestation available, mint not submitted yet
+MINTING = 'MINTING'      # receiveMessage submitted to Circle
+MINTED = 'MINTED'
+FAILED = 'FAILED'
+ACTIVE_STATES = (APPROVING, BURNING, BURNED, ATTESTED, MINTING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cctp_transfers (
+    ref_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    user_id INTEGER,
+    amount REAL,
+    source_chain TEXT NOT NULL,
+    destination_wallet_id TEXT NOT NULL,
+    destination_chain TEXT NOT NULL,
+    destination_address TEXT,
+    approve_id TEXT,
+    burn_id TEXT,
+    burn_tx_hash TEXT,
+    message_bytes TEXT,
+    message_hash TEXT,
+    attestation TEXT,
+    mint_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    mint_attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS cctp_transfers_due ON cctp_transfers (state, next_attempt_at);
+"""
+
+def retry_delay(attempts: int) -> float:
+    return min(MIN_RETRY_DELAY * 1.5 ** attempts, MAX_RETRY_DELAY)
+
+def idempotency_key(ref_id: str, step: str) -> str:
+    # derived from the refId, so submitting a step again after a timeout or crash returns the transaction Circle already created
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{ref_id}:{step}'))
+
+class CctpPipeline:
+    """Persistent state machine that mints burned USDC on the destination chain as soon as its attestation is ready."""
+
+    def __init__(self, path: str = CCTP_PIPELINE_PATH):
+        self.path = path
+        self._db: storage.Database | None = None
+        self._db_lock = threading.Lock()
+
+    @property
+    def db(self) -> storage.Database:
+        with self._db_lock:
+            if self._db is None:
+                self._db = storage.get_database(self.path)
+                self._db.executescript(SCHEMA)
+            return self._db
+
+    def get(self, ref_id: str) -> dict | None:
+        rows = self.db.execute('SELECT * FROM cctp_transfers WHERE ref_id = ?', (ref_id,))
+        return dict(rows[0]) if rows else None
+
+    def _update(self, ref_id: str, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f'UPDATE cctp_transfers SET {assignments} WHERE ref_id = ?', (*fields.values(), ref_id))
+
+    def register(self, ref_id: str, user: defs.User, recipient: defs.User, amount: float):
+        """Track a transfer before its approve is submitted with idempotency_key(ref_id, 'approve'), the USDC amount is the one the approve covers."""
+        now = time.time()
+        # webhooks drive the transfer, polling its Circle transactions is only the fallback, a resumed submission keeps its row
+        self.db.execute(
+            'INSERT OR IGNORE INTO cctp_transfers (ref_id, state, user_id, amount, source_chain, destination_wallet_id, destination_chain, destination_address, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (ref_id, APPROVING, user.telegram_id, amount, user.wallet.blockchain.value, recipient.wallet.id, recipient.wallet.blockchain.value, recipient.wallet.address, now + MAX_RETRY_DELAY, now, now)
+        )
+
+    def approve_submitted(self, ref_id: str, approve_id: str):
+        self._update(ref_id, approve_id=approve_id)
+
+    def discard(self, ref_id: str):
+        """Forget a transfer whose approve was rejected, one without an answer is resolved by run() instead."""
+        self.db.execute('DELETE FROM cctp_transfers WHERE ref_id = ? AND state = ?', (ref_id, APPROVING))
+
+    def _advance(self, ref_id: str, state: str, next_state: str, **fields) -> dict | None:
+        """Move a transfer on only if it is still in state, so duplicate webhooks and the poller never repeat a step."""
+        now = time.time()
+        fields.update(state=next_state, updated_at=now, next_attempt_at=fields.get('next_attempt_at', now + MAX_RETRY_DELAY))
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        rows = self.db.execute(f'UPDATE cctp_transfers SET {assignments} WHERE ref_id = ? AND state = ? RETURNING *', (*fields.values(), ref_id, state))
+        return dict(rows[0]) if rows else None
+
+    def claim_due(self, limit: int = CCTP_BATCH_SIZE) -> list[dict]:
+        """Lease the transfers whose next step is due, a single statement so concurrent workers never get the same row."""
+        now = time.time()
+        rows = self.db.execute(
+            f'UPDATE cctp_transfers SET next_attempt_at = ? WHERE ref_id IN ('
+            f'SELECT ref_id FROM cctp_transfers WHERE state IN ({", ".join("?" * len(ACTIVE_STATES))}) AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?'
+            f') RETURNING *',
+            (now + LEASE_SECONDS, *ACTIVE_STATES, now, limit)
+        )
+        return [dict(row) for row in rows]
+
+    async def on_notification(self, notification: dict):
+        """Advance a cross-chain transfer on the webhook of one of its Circle transactions (refId <id>:approve, :burn or :mint)."""
+        ref_id, _, step = notification['refId'].rpartition(':')
+        if notification['state'] in ('FAILED', 'CANCELLED', 'DENIED'):
+            if step == 'mint':
+                await self.retry_mint(ref_id, f"mint {notification['state'].lower()}")
+            else:
+                await self.fail(ref_id, f"{step} {notification['state'].lower()}")
+            return
+        if notification['state'] != 'COMPLETE':
+            return
+        if step == 'approve':
+            transfer = self._advance(ref_id, APPROVING, BURNING)
+            if transfer is not None:
+                print("Received approval, now burning")
+                await self.submit_burn(transfer)
+        elif step == 'burn':
+            # picked up by the next tick of run()
+            self._advance(ref_id, BURNING, BURNED, burn_tx_hash=notification['txHash'], next_attempt_at=time.time())
+        elif step == 'mint':
+            await self.complete(ref_id)
+
+    async def resubmit_approve(self, transfer: dict):
+        user = defs.User.load_by_id(transfer['user_id'])
+        # Circle answers the same key with the approve it already has, or creates it if the first request never arrived
+        response = await circle_api.cctp_burn_step_1(user, transfer['amount'], f"{transfer['ref_id']}:approve", idempotency_key=idempotency_key(transfer['ref_id'], 'approve'))
+        if 'data' not in response:
+            await self.fail(transfer['ref_id'], response.get('message', 'approve rejected'))
+            return
+        self.approve_submitted(transfer['ref_id'], response['data']['id'])
+
+    async def submit_burn(self, transfer: dict):
+        user = defs.User.load_by_id(transfer['user_id'])
+        response = await circle_api.cctp_burn_step_2(
+            user, defs.Blockchain(transfer['destination_chain']), transfer['destination_address'], transfer['amount'],
+            f"{transfer['ref_id']}:burn", idempotency_key=idempotency_key(transfer['ref_id'], 'burn')
+        )
+        if 'data' not in response:
+            await self.fail(transfer['ref_id'], response.get('message', 'burn rejected'))
+            return
+        self._update(transfer['ref_id'], burn_id=response['data']['id'])
+
+    async def poll_source(self, transfer: dict, step: str, transaction_id: str):
+        transaction = await circle_api.get_transaction(transaction_id)
+        await self.on_notification({'refId': f"{transfer['ref_id']}:{step}", 'state': transaction['state'], 'txHash': transaction.get('txHash')})
+
+    async def step(self, transfer: dict):
+        if time.time() - transfer['created_at'] > MAX_TRANSFER_AGE:
+            await self.fail(transfer['ref_id'], f"timed out in state {transfer['state']}")
+            return
+        if transfer['state'] == APPROVING:
+            if transfer['approve_id'] is not None:
+                await self.poll_source(transfer, 'approve', transfer['approve_id'])
+            elif time.time() - transfer['created_at'] > MAX_APPROVE_AGE:
+                await self.fail(transfer['ref_id'], 'approve not confirmed by Circle')
+            else:
+                # the submission timed out or its process died, first due a minute after register()
+                await self.resubmit_approve(transfer)
+        elif transfer['state'] == BURNING:
+            if transfer['burn_id'] is None:
+                # the process died between the approve and the burn submission
+                await self.submit_burn(transfer)
+            else:
+                await self.poll_source(transfer, 'burn', transfer['burn_id'])
+        if transfer['state'] == BURNED:
+            if transfer['message_hash'] is None:
+                message_bytes, message_hash = await asyncio.to_thread(circle_api.get_message_bytes_and_hash, defs.Blockchain(transfer['source_chain']), transfer['burn_tx_hash'])
+                transfer.update(message_bytes=message_bytes, message_hash=message_hash)
+                self._update(transfer['ref_id'], message_bytes=message_bytes, message_hash=message_hash)
+            attestation = await circle_api.get_atttestation(transfer['message_hash'])
+            if attestation is None:
+                self._update(transfer['ref_id'], attempts=transfer['attempts'] + 1, next_attempt_at=time.time() + retry_delay(transfer['attempts']))
+                return
+            print("Attestation received")
+            transfer.update(state=ATTESTED, attestation=attestation)
+            self._update(transfer['ref_id'], state=ATTESTED, attestation=attestation)
+        if transfer['state'] == ATTESTED:
+            # counted before submitting, so rejected mints and crashes in between use up attempts as well
+            transfer['mint_attempts'] += 1
+            self._update(transfer['ref_id'], mint_attempts=transfer['mint_attempts'])
+            # receiveMessage reverts for a message that was already received, so submitting again after a crash cannot mint twice
+            response = await circle_api.cctp_receive_message(
+                transfer['destination_wallet_id'], defs.Blockchain(transfer['destination_chain']),
+                transfer['message_bytes'], transfer['attestation'], f"{transfer['ref_id']}:mint"
+            )
+            if 'data' not in response:
+                await self.retry_mint(transfer['ref_id'], response.get('message', 'mint rejected'))
+                return
+            # the webhook finishes the transfer, polling is only the fallback
+            self._update(transfer['ref_id'], state=MINTING, mint_id=response['data']['id'], next_attempt_at=time.time() + MAX_RETRY_DELAY)
+        elif transfer['state'] == MINTING:
+            mint = await circle_api.get_transaction(transfer['mint_id'])
+            await self.on_notification({'refId': f"{transfer['ref_id']}:mint", 'state': mint['state']})
+            if mint['state'] not in transaction_tracker.TERMINAL_STATES:
+                self._update(transfer['ref_id'], next_attempt_at=time.time() + MAX_RETRY_DELAY)
+
+    async def retry_mint(self, ref_id: str, error: str):
+        transfer = self.get(ref_id)
+        if transfer is None or transfer['state'] not in (ATTESTED, MINTING):
+            return
+        if transfer['mint_attempts'] >= MAX_MINT_ATTEMPTS:
+            await self.fail(ref_id, error)
+            return
+        self._update(ref_id, state=ATTESTED, error=error, next_attempt_at=time.time() + retry_delay(transfer['mint_attempts']))
+
+    async def complete(self, ref_id: str):
+        self._update(ref_id, state=MINTED)
+        await self._finish(ref_id, 'COMPLETE')
+
+    async def fail(self, ref_id: str, error: str):
+        logging.error(f"Cross-chain transfer {ref_id} failed: {error}")
+        self._update(ref_id, state=FAILED, error=error)
+        await self._finish(ref_id, 'FAILED')
+
+    async def _finish(self, ref_id: str, state: str):
+        transaction = defs.CircleTransaction.load(ref_id)
+        if transaction is not None:
+            await transaction_tracker.TRACKER.update_state(transaction, state)
+
+    async def run_due(self):
+        async def run_step(transfer: dict):
+            try:
+                await self.step(transfer)
+            except Exception as e:
+                logging.exception(f"Cross-chain transfer {transfer['ref_id']} step failed")
+                self._update(transfer['ref_id'], attempts=transfer['attempts'] + 1, error=str(e), next_attempt_at=time.time() + retry_delay(transfer['attempts']))
+        await asyncio.gather(*(run_step(transfer) for transfer in self.claim_due()))
+
+    async def run(self, tick: float = CCTP_POLL_TICK):
+        """Advance due transfers, meant to run as a background task for the lifetime of the bot."""
+        while True:
+            try:
+                await self.run_due()
+            except Exception:
+                logging.exception("Cross-chain pipeline failed")
+            await asyncio.sleep(tick)
+
+PIPELINE = CctpPipeline()
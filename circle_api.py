@@ -2,139 +2,248 @@ import uuid
 import enum
 import dotenv
 import os
-import requests
 import asyncio
+import collections
+import functools
+import logging
+import threading
+import weakref
+import httpx
+import balance_cache
+import web3_providers
 import definitions as defs
+import metrics
 from constants import *
 
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
 import base64
-import web3
-from eth_abi import decode
 
 dotenv.load_dotenv()
 
 CIRCLE_API_KEY = os.getenv("CIRCLE_API_KEY")
 ENTITY_SECRET = os.getenv("ENTITY_SECRET", "")
 WALLET_SET_ID = os.getenv("WALLET_SET_ID")
-with open("data/setup/key.pub", "r") as f:
-    PUBLIC_KEY = f.read()
+CIRCLE_API_URL = os.getenv("CIRCLE_API_URL", "https://api.circle.com")
+IRIS_API_URL = os.getenv("IRIS_API_URL", "https://iris-api-sandbox.circle.com")
+CIRCLE_MAX_CONCURRENCY = int(os.getenv("CIRCLE_MAX_CONCURRENCY", "10"))
+CIPHERTEXT_POOL_SIZE = int(os.getenv("CIPHERTEXT_POOL_SIZE", "8"))
+PUBLIC_KEY_PATH = "data/setup/key.pub"
+
+# request timeouts in seconds, wallet creation and transfers take noticeably longer than reads
+TIMEOUTS = {
+    "create_wallet": 30.0,
+    "update_wallet": 10.0,
+    "get_wallet_balance": 5.0,
+    "send_transfer": 15.0,
+    "get_transaction": 5.0,
+    "execute_smart_contract": 15.0,
+    "get_atttestation": 10.0,
+    "request_from_faucet": 15.0,
+}
+
+class CircleUnavailable(Exception):
+    """Circle answered 429 or 5xx, the request did not take effect and can be repeated."""
+
+class CircleClient:
+    """Pooled keep-alive HTTP client that limits the number of concurrent requests to Circle."""
+
+    def __init__(self, max_concurrency: int = CIRCLE_MAX_CONCURRENCY):
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency, keepalive_expiry=60),
+            headers={"accept": "application/json"}
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def request(self, endpoint: str, method: str, url: str, json: dict | None = None, authorized: bool = True, raise_unavailable: bool = False) -> dict:
+        """The JSON answer, also for errors, with raise_unavailable 429 and 5xx answers raise CircleUnavailable instead."""
+        headers = {"authorization": f"Bearer {CIRCLE_API_KEY}"} if authorized else {}
+        async with self.semaphore:
+            response = await self.http.request(method, url, json=json, headers=headers, timeout=TIMEOUTS[endpoint])
+        if raise_unavailable and (response.status_code == 429 or response.status_code >= 500):
+            raise CircleUnavailable(f"{endpoint} answered HTTP {response.status_code}")
+        return response.json() if response.content else {}
+
+    async def close(self):
+        await self.http.aclose()
+
+# httpx clients are bound to the event loop they were created on, so keep one per loop
+_CLIENTS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, CircleClient]' = weakref.WeakKeyDictionary()
+
+def get_client() -> CircleClient:
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None:
+        client = _CLIENTS[loop] = CircleClient()
+    return client
+
+async def close_client():
+    client = _CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+async def run_and_close(awaitable):
+    """Await the given awaitable and close the client of the current loop afterwards, for short-lived event loops."""
+    try:
+        return await awaitable
+    finally:
+        await close_client()
+
+def run_sync(coroutine_function):
+    """Wrap an async API function so it can be called from scripts without a running event loop."""
+    @functools.wraps(coroutine_function)
+    def wrapper(*args, **kwargs):
+        return asyncio.run(run_and_close(coroutine_function(*args, **kwargs)))
+    return wrapper
+
+@functools.cache
+def get_entity_secret_cipher():
+    # loaded on the first transfer or wallet creation, not when the module is imported
+    from Crypto.Cipher import PKCS1_OAEP
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
 
-def generate_entity_secret_ciphertext():
     entity_secret = bytes.fromhex(ENTITY_SECRET)
     if len(entity_secret) != 32:
         raise Exception("invalid entity secret")
 
-    # encrypt data by the public key
-    public_key = RSA.importKey(PUBLIC_KEY)
-    cipher_rsa = PKCS1_OAEP.new(key=public_key, hashAlgo=SHA256)
-    encrypted_data = cipher_rsa.encrypt(entity_secret)
+    with open(PUBLIC_KEY_PATH, "r") as f:
+        public_key = RSA.importKey(f.read())
+    return PKCS1_OAEP.new(key=public_key, hashAlgo=SHA256), entity_secret
+
+_CIPHER_LOCK = threading.Lock()
+
+def generate_entity_secret_ciphertext():
+    cipher_rsa, entity_secret = get_entity_secret_cipher()
+
+    # encrypt data by the public key, OAEP is randomized so every call gives a new ciphertext
+    with _CIPHER_LOCK:
+        encrypted_data = cipher_rsa.encrypt(entity_secret)
 
     # encode to base64
     ciphertext = base64.b64encode(encrypted_data)
 
     return ciphertext.decode()
 
-def create_wallet(nr_wallets: int, blockchain: defs.Blockchain = defs.Blockchain.MATIC_AMOY) -> defs.Wallets:
+class CiphertextPool:
+    """Entity secret ciphertexts generated ahead of time by a background thread.
+
+    Circle rejects a ciphertext that was already used, so each one is handed out exactly once."""
+
+    def __init__(self, size: int = CIPHERTEXT_POOL_SIZE):
+        self.size = size
+        self._ciphertexts: collections.deque[str] = collections.deque()
+        self._wanted = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def take(self) -> str:
+        try:
+            ciphertext = self._ciphertexts.popleft()
+        except IndexError:
+            ciphertext = generate_entity_secret_ciphertext()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._fill, name="ciphertext-pool", daemon=True)
+            self._thread.start()
+        self._wanted.set()
+        return ciphertext
+
+    def _fill(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            while len(self._ciphertexts) < self.size:
+                self._ciphertexts.append(generate_entity_secret_ciphertext())
+
+CIPHERTEXT_POOL = CiphertextPool()
+
+@metrics.timed('circle_api')
+async def create_wallet(nr_wallets: int, blockchain: defs.Blockchain = defs.Blockchain.MATIC_AMOY) -> defs.Wallets:
     if nr_wallets > 200:
         raise ValueError("Cannot create more than 200 wallets at a time")
     
-    url = "https://api.circle.com/v1/w3s/developer/wallets"
-
+    url = f"{CIRCLE_API_URL}/v1/w3s/developer/wallets"
 
     payload = {
         "idempotencyKey": str(uuid.uuid4()),
         "accountType": "SCA",
         "blockchains": [blockchain.value],
         "count": nr_wallets,
-        "entitySecretCiphertext": generate_entity_secret_ciphertext(),
+        "entitySecretCiphertext": CIPHERTEXT_POOL.take(),
         "walletSetId": WALLET_SET_ID
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
 
-    response = requests.post(url, json=payload, headers=headers)
-    return defs.Wallets.parse_obj(response.json()['data'])
+    response = await get_client().request("create_wallet", "POST", url, json=payload)
+    return defs.Wallets.parse_obj(response['data'])
 
-def update_wallet(wallet_id: str, wallet_name: str, wallet_ref_id: str):
-    url = f"https://api.circle.com/v1/w3s/wallets/{wallet_id}"
+@metrics.timed('circle_api')
+async def update_wallet(wallet_id: str, wallet_name: str, wallet_ref_id: str):
+    url = f"{CIRCLE_API_URL}/v1/w3s/wallets/{wallet_id}"
 
     payload = {
         "name": wallet_name,
         "refId": wallet_ref_id
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
 
-    response = requests.put(url, json=payload, headers=headers)
-    return response.json()
+    return await get_client().request("update_wallet", "PUT", url, json=payload)
 
-def get_wallet_balance(wallet_id: str):
-    url = f"https://api.circle.com/v1/w3s/wallets/{wallet_id}/balances"
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
-    response = requests.get(url, headers=headers)
-    return response.json()
+@metrics.timed('circle_api')
+async def get_wallet_balance(wallet_id: str):
+    url = f"{CIRCLE_API_URL}/v1/w3s/wallets/{wallet_id}/balances"
+    return await get_client().request("get_wallet_balance", "GET", url)
 
-def get_user_usdc_balance(user: defs.User) -> float:
-    balances = get_wallet_balance(user.wallet.id)['data']
+@metrics.timed('circle_api')
+async def fetch_usdc_balance(wallet_id: str) -> float:
+    balances = (await get_wallet_balance(wallet_id))['data']
     for token in balances['tokenBalances']:
         if token['token']['symbol'] == 'USDC':
             return float(token['amount'])
     return 0.0
 
-def send_transfer(wallet_id: str, recipient: str, tokenId: str, amount: float, ref_id: str):
-    url = "https://api.circle.com/v1/w3s/developer/transactions/transfer"
+# invalidated by the transaction webhooks in server.py and by our own transfers
+BALANCE_CACHE = balance_cache.BalanceCache(fetch_usdc_balance)
+
+@metrics.timed('balance_cache')
+async def get_user_usdc_balance(user: defs.User, fresh: bool = False) -> float:
+    # fresh for the checks right before money moves, the cache of this worker may have missed an invalidation
+    return await BALANCE_CACHE.get(user.wallet.id, fresh=fresh)
+
+@metrics.timed('circle_api')
+async def send_transfer(wallet_id: str, recipient: str, tokenId: str, amount: float, ref_id: str, idempotency_key: str | None = None):
+    url = f"{CIRCLE_API_URL}/v1/w3s/developer/transactions/transfer"
 
     payload = {
         "walletId": wallet_id,
         "destinationAddress": recipient,
         "tokenId": tokenId,
         "amounts": [str(amount)],
-        "idempotencyKey": str(uuid.uuid4()), # TODO create a uuid from the user request so that it can only be sent once
-        "entitySecretCiphertext": generate_entity_secret_ciphertext(),
+        # Circle answers a repeated key with the transaction it already created, pass a stored key to retry safely
+        "idempotencyKey": idempotency_key or str(uuid.uuid4()),
+        "entitySecretCiphertext": CIPHERTEXT_POOL.take(),
         "feeLevel": "MEDIUM",
         "refId": ref_id
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
     
-    response = requests.post(url, json=payload, headers=headers)
-    print(response.json())
-    return response.json()
-
-def get_transaction(transaction_id: str):
-    url = f"https://api.circle.com/v1/w3s/transactions/{transaction_id}"
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
-    response = requests.get(url, headers=headers)
-    return response.json()["data"]["transaction"]
-
-def execute_smart_contract(wallet_id: str, contract_address: str, abi_function_signature: str, abi_parameters: list, amount: float | None = None, ref_id: str | None = None):
-    url = "https://api.circle.com/v1/w3s/developer/transactions/contractExecution"
+    # with a caller's idempotency key a failed request can be repeated, so let the caller retry it
+    response = await get_client().request("send_transfer", "POST", url, json=payload, raise_unavailable=idempotency_key is not None)
+    BALANCE_CACHE.invalidate(wallet_id)
+    logging.debug(f"send_transfer {ref_id}: {response}")
+    return response
+
+@metrics.timed('circle_api')
+async def get_transaction(transaction_id: str):
+    url = f"{CIRCLE_API_URL}/v1/w3s/transactions/{transaction_id}"
+    response = await get_client().request("get_transaction", "GET", url)
+    return response["data"]["transaction"]
+
+@metrics.timed('circle_api')
+async def execute_smart_contract(wallet_id: str, contract_address: str, abi_function_signature: str, abi_parameters: list, amount: float | None = None, ref_id: str | None = None, idempotency_key: str | None = None):
+    url = f"{CIRCLE_API_URL}/v1/w3s/developer/transactions/contractExecution"
 
     payload = {
         "walletId": wallet_id,
         "contractAddress": contract_address,
         "abiFunctionSignature": abi_function_signature,
         "abiParameters": abi_parameters,
-        "idempotencyKey": str(uuid.uuid4()),
-        "entitySecretCiphertext": generate_entity_secret_ciphertext(),
+        "idempotencyKey": idempotency_key or str(uuid.uuid4()),
+        "entitySecretCiphertext": CIPHERTEXT_POOL.take(),
         "feeLevel": "MEDIUM"
     }
 
@@ -144,14 +253,9 @@ def execute_smart_contract(wallet_id: str, contract_address: str, abi_function_s
     if ref_id is not None:
         payload["refId"] = ref_id
 
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {CIRCLE_API_KEY}"
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-    return response.json()
+    response = await get_client().request("execute_smart_contract", "POST", url, json=payload, raise_unavailable=idempotency_key is not None)
+    BALANCE_CACHE.invalidate(wallet_id)
+    return response
 
 def encode_address(address: str) -> str:
     address = address.lower().removeprefix('0x')
@@ -160,77 +264,71 @@ def encode_address(address: str) -> str:
     address_bytes = bytes.fromhex(address)
     return '0x' + (b'\x00' * 12 + address_bytes).hex()
 
-def cctp_burn(user: defs.User, destination_chain: defs.Blockchain, destination_address: str, amount: float, ref_id: str):
+@metrics.timed('circle_api')
+async def cctp_burn(user: defs.User, destination_chain: defs.Blockchain, destination_address: str, amount: float, ref_id: str):
     # TODO looks like we need to wait for the transaction 1 before sending transaction 2 otherwise cricle will reject it
     amount_str = str(round(amount * 1e6))
     chain = user.wallet.blockchain.value
     print(chain)
-    response1 = execute_smart_contract(user.wallet.id, USDC_TOKEN_ADDRESSES[chain], "approve(address,uint256)", [CCTP_TOKEN_MESSENGER[chain], amount_str])
+    response1 = await execute_smart_contract(user.wallet.id, USDC_TOKEN_ADDRESSES[chain], "approve(address,uint256)", [CCTP_TOKEN_MESSENGER[chain], amount_str])
     
     abi_function_signature = "depositForBurn(uint256,uint32,bytes32,address)"
     encoded_destination_address = encode_address(destination_address)    
     abi_parameters = [amount_str, CCTP_DOMAINS[destination_chain.value], encoded_destination_address, USDC_TOKEN_ADDRESSES[chain]]    
-    response2 = execute_smart_contract(user.wallet.id, CCTP_TOKEN_MESSENGER[chain], abi_function_signature, abi_parameters, ref_id=ref_id)
+    response2 = await execute_smart_contract(user.wallet.id, CCTP_TOKEN_MESSENGER[chain], abi_function_signature, abi_parameters, ref_id=ref_id)
     
     return response1, response2
 
 
-def cctp_burn_step_1(user: defs.User, amount: float, ref_id: str):
+@metrics.timed('circle_api')
+async def cctp_burn_step_1(user: defs.User, amount: float, ref_id: str, idempotency_key: str | None = None):
     amount_str = str(round(amount * 1e6))
     chain = user.wallet.blockchain.value
-    return execute_smart_contract(user.wallet.id, USDC_TOKEN_ADDRESSES[chain], "approve(address,uint256)", [CCTP_TOKEN_MESSENGER[chain], amount_str], ref_id=ref_id)
+    return await execute_smart_contract(user.wallet.id, USDC_TOKEN_ADDRESSES[chain], "approve(address,uint256)", [CCTP_TOKEN_MESSENGER[chain], amount_str], ref_id=ref_id, idempotency_key=idempotency_key)
 
-def cctp_burn_step_2(user: defs.User, destination_chain: defs.Blockchain, destination_address: str, amount: float, ref_id: str):
+@metrics.timed('circle_api')
+async def cctp_burn_step_2(user: defs.User, destination_chain: defs.Blockchain, destination_address: str, amount: float, ref_id: str, idempotency_key: str | None = None):
     amount_str = str(round(amount * 1e6))
     chain = user.wallet.blockchain.value
     abi_function_signature = "depositForBurn(uint256,uint32,bytes32,address)"
     encoded_destination_address = encode_address(destination_address)    
     abi_parameters = [amount_str, CCTP_DOMAINS[destination_chain.value], encoded_destination_address, USDC_TOKEN_ADDRESSES[chain]]    
-    return execute_smart_contract(user.wallet.id, CCTP_TOKEN_MESSENGER[chain], abi_function_signature, abi_parameters, ref_id=ref_id)
+    return await execute_smart_contract(user.wallet.id, CCTP_TOKEN_MESSENGER[chain], abi_function_signature, abi_parameters, ref_id=ref_id, idempotency_key=idempotency_key)
 
+@metrics.timed('circle_api')
 def get_message_bytes_and_hash(blockchain: defs.Blockchain, tx_hash: str) -> tuple[str, str]:
-    provider = web3.Web3(web3.HTTPProvider(INFURA_ENPOINTS[blockchain.value]))
-    # Get the transaction receipt
-    transaction_receipt = provider.eth.get_transaction_receipt(tx_hash)
-
-    # Create the event topic
-    event_topic = web3.Web3.keccak(text='MessageSent(bytes)').hex()
-
-    # Find the log with the matching topic
-    log = next((l for l in transaction_receipt['logs'] if l['topics'][0].hex() == event_topic), None)
-
-    if log is None:
-        raise ValueError("MessageSent event not found in transaction logs")
-
-    # Decode the log data
-    message_bytes = decode(['bytes'], log['data'])[0]
+    return web3_providers.PROVIDERS.get_cctp_message(blockchain.value, tx_hash)
 
-    # Calculate the message hash
-    message_hash = web3.Web3.keccak(message_bytes).hex()
+@metrics.timed('circle_api')
+async def get_atttestation(message_hash: str) -> str | None:
+    url = f"{IRIS_API_URL}/v1/attestations/{message_hash}"
 
-    return f'0x{message_bytes.hex()}', f'0x{message_hash}'
-
-def get_atttestation(message_hash: str) -> str | None:
-    url = f"https://iris-api-sandbox.circle.com/v1/attestations/{message_hash}"
-
-    headers = {"accept": "application/json"}
-
-    response = requests.get(url, headers=headers).json()
-    if response['status'] != 'complete':
+    response = await get_client().request("get_atttestation", "GET", url, authorized=False)
+    # Iris answers with 404 until it has seen the burn and with status pending_confirmations until it is final
+    if response.get('status') != 'complete':
         return None
     return response['attestation']
 
-def cctp_mint(source_chain: defs.Blockchain, destination_walled_id: str, destination_chain: defs.Blockchain, tx_hash: str):
+@metrics.timed('circle_api')
+async def cctp_receive_message(destination_walled_id: str, destination_chain: defs.Blockchain, message_bytes: str, attestation: str, ref_id: str | None = None):
     contract_address = CCTP_MESSAGE_TRANSMITTER[destination_chain.value]
-    message_bytes, message_hash = get_message_bytes_and_hash(source_chain, tx_hash)
-    attestation = get_atttestation(message_hash)
-    print("Attestation received")
     abi_function_signature = "receiveMessage(bytes,bytes)"
     abi_parameters = [message_bytes, attestation]
-    return execute_smart_contract(destination_walled_id, contract_address, abi_function_signature, abi_parameters)
+    return await execute_smart_contract(destination_walled_id, contract_address, abi_function_signature, abi_parameters, ref_id=ref_id)
+
+@metrics.timed('circle_api')
+async def cctp_mint(source_chain: defs.Blockchain, destination_walled_id: str, destination_chain: defs.Blockchain, tx_hash: str, ref_id: str | None = None):
+    # web3 is synchronous, keep it off the event loop
+    message_bytes, message_hash = await asyncio.to_thread(get_message_bytes_and_hash, source_chain, tx_hash)
+    attestation = await get_atttestation(message_hash)
+    if attestation is None:
+        raise ValueError(f"Attestation for {tx_hash} is not ready yet")
+    print("Attestation received")
+    return await cctp_receive_message(destination_walled_id, destination_chain, message_bytes, attestation, ref_id)
 
-def request_from_faucet(user: defs.User):
-    url = "https://api.circle.com/v1/faucet/drips"
+@metrics.timed('circle_api')
+async def request_from_faucet(user: defs.User):
+    url = f"{CIRCLE_API_URL}/v1/faucet/drips"
 
     payload = {
         "address": user.wallet.address,
@@ -238,9 +336,16 @@ def request_from_faucet(user: defs.User):
         "native": True,
         "usdc": True
     }
-    headers = {
-        "Authorization": f"Bearer {CIRCLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
 
-    requests.request("post", url, json=payload, headers=headers)
\ No newline at end of file
+    await get_client().request("request_from_faucet", "POST", url, json=payload)
+
+# blocking variants for scripts such as create_wallet.py
+create_wallet_sync = run_sync(create_wallet)
+update_wallet_sync = run_sync(update_wallet)
+get_wallet_balance_sync = run_sync(get_wallet_balance)
+get_user_usdc_balance_sync = run_sync(get_user_usdc_balance)
+send_transfer_sync = run_sync(send_transfer)
+get_transaction_sync = run_sync(get_transaction)
+execute_smart_contract_sync = run_sync(execute_smart_contract)
+cctp_mint_sync = run_sync(cctp_mint)
+request_from_faucet_sync = run_sync(request_from_faucet)
@@ -0,0 +1,190 @@
+import collections
+import json
+import logging
+import math
+import os
+import pathlib
+import re
+
+import definitions as defs
+import fast_parser
+
+# Caches LLM results by message template. Handles, amounts, addresses, ENS names and currency codes are
+# replaced by placeholders, so "split 150k vnd between @a and @b" and "split 90k idr between @c and @d"
+# share one entry whose skeleton is filled in with the values of the new message.
+
+COMMAND_CACHE_PATH = os.getenv('COMMAND_CACHE_PATH', 'data/command_cache.json')
+COMMAND_CACHE_SIZE = int(os.getenv('COMMAND_CACHE_SIZE', '5000'))
+SAVE_EVERY = 50
+
+TOKEN_PATTERN = re.compile(
+    r'(?P<A>\b0x[0-9a-fA-F]{40}\b)'
+    r'|(?P<E>\b[\w-]+(?:\.[\w-]+)*\.eth\b)'
+    r'|(?P<H>@\w+)'
+    r'|(?P<N>\d(?:[\d,]*\d)?(?:\.\d+)?[kKmM]?)(?!\w)'
+    r'|(?P<C>\b[A-Za-z]{3}\b)'
+)
+LEFTOVER_PATTERN = re.compile(r'\d|@|0x|\.eth', re.IGNORECASE)
+
+class Template:
+    def __init__(self, key: str, values: dict[str, list]):
+        self.key = key
+        self.values = values
+
+def parse_number(token: str) -> float | None:
+    multiplier = token[-1].lower() if token[-1] in 'kKmM' else ''
+    return fast_parser.parse_amount(token.removesuffix(token[-1]) if multiplier else token, multiplier)
+
+def templatize(message: str) -> Template | None:
+    values: dict[str, list] = {'A': [], 'E': [], 'H': [], 'N': [], 'C': []}
+    parts = []
+    position = 0
+    for match in TOKEN_PATTERN.finditer(message):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'C':
+            if token.upper() not in fast_parser.ISO_CURRENCIES:
+                continue
+            token = token.upper()
+        elif kind == 'N':
+            token = parse_number(token)
+            if token is None:
+                return None
+        parts.append(message[position:match.start()].lower())
+        parts.append(f'<{kind}{len(values[kind])}>')
+        values[kind].append(token)
+        position = match.end()
+    parts.append(message[position:].lower())
+    return Template(' '.join(''.join(parts).split()), values)
+
+def _skeleton_string(value: str, values: dict[str, list]):
+    for kind in ('A', 'E', 'H', 'C'):
+        for i, token in enumerate(values[kind]):
+            if value == token:
+                return {'$ref': kind, 'i': i, 'form': 'raw'}
+            if kind == 'H' and value == token[1:]:
+                return {'$ref': kind, 'i': i, 'form': 'bare'}
+            if value.lower() == token.lower():
+                return {'$ref': kind, 'i': i, 'form': 'lower' if value == value.lower() else 'upper'}
+    if LEFTOVER_PATTERN.search(value):
+        # probably derived from the message in a way we cannot replay (e.g. a free text note with numbers)
+        raise ValueError(value)
+    return value
+
+def _skeleton_number(value: float, values: dict[str, list]):
+    numbers = values['N']
+    for i, number in enumerate(numbers):
+        if math.isclose(value, number):
+            return {'$ref': 'N', 'i': i, 'ratio': 1.0}
+    if len(numbers) == 1 and numbers[0]:
+        # e.g. a split: every amount is a fixed share of the only number in the message
+        return {'$ref': 'N', 'i': 0, 'ratio': value / numbers[0]}
+    raise ValueError(value)
+
+def make_skeleton(data, values: dict[str, list]):
+    if isinstance(data, dict):
+        return {key: make_skeleton(value, values) for key, value in data.items()}
+    if isinstance(data, list):
+        return [make_skeleton(value, values) for value in data]
+    if isinstance(data, str):
+        return _skeleton_string(data, values)
+    if isinstance(data, (int, float)) and not isinstance(data, bool):
+        return _skeleton_number(float(data), values)
+    return data
+
+def references(skeleton) -> set[tuple[str, int]]:
+    if isinstance(skeleton, dict):
+        if '$ref' in skeleton:
+            return {(skeleton['$ref'], skeleton['i'])}
+        return set().union(*(references(value) for value in skeleton.values()))
+    if isinstance(skeleton, list):
+        return set().union(*(references(value) for value in skeleton))
+    return set()
+
+def fill_skeleton(skeleton, values: dict[str, list]):
+    if isinstance(skeleton, dict):
+        if '$ref' in skeleton:
+            token = values[skeleton['$ref']][skeleton['i']]
+            if skeleton['$ref'] == 'N':
+                return round(token * skeleton['ratio'], defs.DECIMALS)
+            return {'raw': token, 'bare': token[1:], 'lower': token.lower(), 'upper': token.upper()}[skeleton['form']]
+        return {key: fill_skeleton(value, values) for key, value in skeleton.items()}
+    if isinstance(skeleton, list):
+        return [fill_skeleton(value, values) for value in skeleton]
+    return skeleton
+
+class CommandCache:
+    """LRU cache of BotCommand skeletons keyed by message template, optionally persisted to disk.
+
+    The fingerprint identifies the prompt and schema the entries were produced with, entries from another fingerprint are discarded."""
+
+    def __init__(self, fingerprint: str, path: str | None = COMMAND_CACHE_PATH, max_size: int = COMMAND_CACHE_SIZE):
+        self.fingerprint = fingerprint
+        self.path = path or None
+        self.max_size = max_size
+        self.entries: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self._unsaved = 0
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            data = json.loads(pathlib.Path(self.path).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if data.get('fingerprint') != self.fingerprint:
+            logging.info("System prompt or schema changed, discarding the command cache")
+            return
+        self.entries.update(data['entries'])
+
+    def save(self):
+        if self.path is None or not self._unsaved:
+            return
+        path = pathlib.Path(self.path)
+        # one tmp file per process, several bot workers save the same cache
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps({'fingerprint': self.fingerprint, 'entries': self.entries}))
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is only an optimisation, never fail the command that triggered the save
+            logging.exception("Failed to save the command cache")
+            return
+        self._unsaved = 0
+
+    def get(self, message: str) -> defs.BotCommand | None:
+        template = templatize(message)
+        if template is None or template.key not in self.entries:
+            return None
+        self.entries.move_to_end(template.key)
+        try:
+            return defs.BotCommand.model_validate(fill_skeleton(self.entries[template.key], template.values))
+        except (IndexError, ValueError):
+            return None
+
+    def put(self, message: str, bot_command: defs.BotCommand):
+        if bot_command.type is defs.CommandType.ERROR:
+            return
+        template = templatize(message)
+        if template is None:
+            return
+        data = bot_command.model_dump(mode='json')
+        try:
+            skeleton = make_skeleton(data, template.values)
+        except ValueError:
+            return
+        # a token the answer does not use might still have mattered (e.g. 'try' as a word, not the currency), so skip those
+        if references(skeleton) != {(kind, i) for kind, tokens in template.values.items() for i in range(len(tokens))}:
+            return
+        # only keep skeletons that reproduce the original answer exactly
+        if defs.BotCommand.model_validate(fill_skeleton(skeleton, template.values)) != bot_command:
+            return
+        self.entries[template.key] = skeleton
+        self.entries.move_to_end(template.key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self._unsaved += 1
+        if self._unsaved >= SAVE_EVERY:
+            self.save()
@@ -1,8 +1,11 @@
+import sys
 import definitions as defs
 import circle_api
-circle_api.create_wallet(20, defs.Blockchain.MATIC_AMOY).save('data/wallets/MATIC-AMOY.json')
-print('wallets created')
+import wallet_pool
 
-
-# need to automate this in the future. 
-# can change to more wallets  e.g. 50, 100, 200, etc. 
+# usage: python create_wallet.py [count] [blockchain], the bot also refills the pool on its own when it runs low
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+blockchain = defs.Blockchain(sys.argv[2]) if len(sys.argv) > 2 else defs.Blockchain.MATIC_AMOY
+wallets = circle_api.create_wallet_sync(count, blockchain)
+wallet_pool.WalletPool().add(wallets.wallets)
+print(f'{len(wallets.wallets)} wallets created')
@@ -1,11 +1,13 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 from typing import List, Optional, Type, TypeVar
 from pydantic import BaseModel, Field, StrictStr
 from enum import Enum
 
-import requests
-import pathlib
+import transaction_store
+import user_index
+from utils import get_ens_address
+from exchange_rates import RateTable
 
 
 T = TypeVar('T', bound=BaseModel)
@@ -67,11 +69,11 @@ class Transaction(BaseModel):
     currency_type: CurrencyType = Field(description="The type of currency, such as token or fiat")
     equivalent_currency: Optional[str] = Field(description="The currency in which the amount is denominated if different from the currency being transferred")
     
-    def get_amount_usd(self, exchange_rates: dict[str, float]) -> float:
+    def get_amount_usd(self, exchange_rates: RateTable) -> float:
         if self.currency_type is CurrencyType.FIAT:
             if self.equivalent_currency is None:
                 raise ValueError("equivalent_currency is required for fiat currency")
-            return round(self.amount / exchange_rates[self.equivalent_currency], DECIMALS)
+            return round(self.amount * exchange_rates.to_usd[self.equivalent_currency.upper()], DECIMALS)
         return round(self.amount, DECIMALS)
     
     def get_recipient_address(self):
@@ -80,7 +82,7 @@ class Transaction(BaseModel):
         elif self.recipient_type is RecipientType.ADDRESS:
             return self.recipient
         elif self.recipient_type is RecipientType.ENS: # TODO add for non .eth ens names
-            return requests.get(f'https://api.ensdata.net/{self.recipient}').json().get('address')
+            return get_ens_address(self.recipient)
 
 class Request(BaseModel):
     target_username: str = Field(description="The username of the user to request from")
@@ -89,9 +91,9 @@ class Request(BaseModel):
     equivalent_currency: Optional[str] = Field(description="The currency in which the amount is denominated if different from the currency being transferred")
     message: Optional[str] = Field(description="An optional message to include in the request")
     
-    def get_amount_usd(self, exchange_rates: dict[str, float]) -> float:
+    def get_amount_usd(self, exchange_rates: RateTable) -> float:
         if self.equivalent_currency:
-            return round(self.amount / exchange_rates[self.equivalent_currency], DECIMALS)
+            return round(self.amount * exchange_rates.to_usd[self.equivalent_currency.upper()], DECIMALS)
         return round(self.amount, DECIMALS)
 
 class BotCommand(BaseModel):
@@ -142,32 +144,34 @@ class User(StoreableBaseModel):
         except FileNotFoundError:
             return None
     
+    def save(self, path: str):
+        super().save(path)
+        user_index.update(self.telegram_id, self.username, self.wallet.id, self.wallet.address)
+
     @classmethod
     def load_by_username(cls, username: str) -> 'User | None':
-        if username.startswith('@'):
-            username = username[1:]
-        # TODO improve this to not load all files
-        for path in pathlib.Path('data/users').glob('*.json'):
-            user = cls.load(str(path))
-            if user.username == username:
-                return user
-        return None
-    
+        telegram_id = user_index.find_by_username(username)
+        return cls.load_by_id(telegram_id) if telegram_id is not None else None
+
+    @classmethod
+    def load_by_usernames(cls, usernames: list[str]) -> dict[str, 'User | None']:
+        """Resolve all usernames with a single index lookup, keyed by the usernames as given."""
+        telegram_ids = user_index.find_by_usernames(usernames)
+        users = {}
+        for username in usernames:
+            telegram_id = telegram_ids.get(user_index.normalize_username(username))
+            users[username] = cls.load_by_id(telegram_id) if telegram_id is not None else None
+        return users
+
     @classmethod
     def load_by_wallet_id(cls, wallet_id: str) -> 'User | None':
-        for path in pathlib.Path('data/users').glob('*.json'):
-            user = cls.load(str(path))
-            if user and user.wallet.id == wallet_id:
-                return user
-        return None
+        telegram_id = user_index.find_by_wallet_id(wallet_id)
+        return cls.load_by_id(telegram_id) if telegram_id is not None else None
 
     @classmethod
     def load_by_wallet_address(cls, wallet_address: str) -> 'User | None':
-        for path in pathlib.Path('data/users').glob('*.json'):
-            user = cls.load(str(path))
-            if user and user.wallet.address == wallet_address:
-                return user
-        return None
+        telegram_id = user_index.find_by_wallet_address(wallet_address)
+        return cls.load_by_id(telegram_id) if telegram_id is not None else None
 
     def pretty_print_blockchain(self):
         if self.wallet.blockchain.value == 'ETH':
@@ -194,6 +198,7 @@ class TransferType(str, Enum):
     CROSS_CHAIN = "CROSS-CHAIN"
     
 class CircleTransaction(StoreableBaseModel):
+    ref_id: str = Field(..., description="Our own ID of the transaction, sent to Circle as refId")
     id: str = Field(..., description="The ID of the transaction")
     state: str = Field(..., description="The state of the transaction")
     user_id: int = Field(..., description="The ID of the user who initiated the transaction")
@@ -201,3 +206,36 @@ class CircleTransaction(StoreableBaseModel):
     message_id: int = Field(..., description="The ID of the message in the user's chat where the transaction was initiated")
     transfer_type: TransferType = Field(..., description="The type of transfer")
     transaction: Transaction
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the transaction was initiated")
+    message_text: Optional[str] = Field(None, description="The HTML text of the confirmation message, updated with the final state of its transactions")
+
+    # stored in the transaction database (see transaction_store.py) instead of one JSON file per transaction
+
+    def save(self):
+        self.save_many([self])
+
+    @classmethod
+    def save_many(cls, transactions: list['CircleTransaction']):
+        transaction_store.save_many([(transaction.model_dump(mode='json'), transaction.model_dump_json()) for transaction in transactions])
+
+    def set_submitted(self, circle_id: str, state: str, placeholder_state: str) -> 'CircleTransaction':
+        """The stored transaction with Circle's answer to its submission, see transaction_store.set_submitted."""
+        data = transaction_store.set_submitted(self.ref_id, circle_id, state, placeholder_state)
+        return self.model_validate_json(data) if data else self.model_copy(update={'id': circle_id, 'state': state})
+
+    def delete(self):
+        transaction_store.delete(self.ref_id)
+
+    @classmethod
+    def load(cls, ref_id: str) -> 'CircleTransaction | None':
+        data = transaction_store.load(ref_id)
+        return cls.model_validate_json(data) if data else None
+
+    @classmethod
+    def load_by_circle_id(cls, circle_id: str) -> 'CircleTransaction | None':
+        data = transaction_store.load_by_circle_id(circle_id)
+        return cls.model_validate_json(data) if data else None
+
+    @classmethod
+    def query(cls, user_id: int | None = None, chat_id: int | None = None, message_id: int | None = None, states: list[str] | None = None, since: datetime | None = None, until: datetime | None = None, limit: int | None = None, oldest_first: bool = False) -> list['CircleTransaction']:
+        return [cls.model_validate_json(data) for data in transaction_store.query(user_id, chat_id, message_id, states, since, until, limit, oldest_first)]
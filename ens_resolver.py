@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+ENS_API_URL = os.getenv('ENS_API_URL', 'https://api.ensdata.net')
+ENS_CACHE_TTL = float(os.getenv('ENS_CACHE_TTL', '3600'))
+ENS_NEGATIVE_CACHE_TTL = float(os.getenv('ENS_NEGATIVE_CACHE_TTL', '300'))
+ENS_TIMEOUT = 10
+
+class EnsResolver:
+    """Forward and reverse ENS lookups with a TTL cache for found and not found entries.
+
+    Every lookup response fills both directions, so resolving a name also caches the reverse lookup of its address."""
+
+    def __init__(self, api_url: str = ENS_API_URL, ttl: float = ENS_CACHE_TTL, negative_ttl: float = ENS_NEGATIVE_CACHE_TTL):
+        self.api_url = api_url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=20)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._addresses: dict[str, tuple[str | None, float]] = {}
+        self._names: dict[str, tuple[str | None, float]] = {}
+        self._lock = threading.Lock()
+
+    def _get_cached(self, cache: dict[str, tuple[str | None, float]], key: str) -> tuple[bool, str | None]:
+        entry = cache.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return False, None
+        return True, entry[0]
+
+    def _set_cached(self, cache: dict[str, tuple[str | None, float]], key: str, value: str | None):
+        cache[key] = (value, time.monotonic() + (self.ttl if value else self.negative_ttl))
+
+    def _lookup(self, query: str) -> dict:
+        response = self.session.get(f'{self.api_url}/{query}', timeout=ENS_TIMEOUT)
+        if response.status_code == 404:
+            return {}
+        response.raise_for_status()
+        data = response.json()
+        with self._lock:
+            if data.get('ens') and data.get('address'):
+                self._set_cached(self._addresses, data['ens'].lower(), data['address'])
+                self._set_cached(self._names, data['address'].lower(), data['ens'])
+        return data
+
+    def resolve_sync(self, ens_name: str) -> str | None:
+        key = ens_name.lower()
+        hit, address = self._get_cached(self._addresses, key)
+        if hit:
+            return address
+        address = self._lookup(ens_name).get('address')
+        with self._lock:
+            self._set_cached(self._addresses, key, address)
+        return address
+
+    def lookup_name_sync(self, address: str) -> str | None:
+        key = address.lower()
+        hit, name = self._get_cached(self._names, key)
+        if hit:
+            return name
+        name = self._lookup(address).get('ens')
+        with self._lock:
+            self._set_cached(self._names, key, name)
+        return name
+
+    @metrics.timed('ens')
+    async def resolve(self, ens_name: str) -> str | None:
+        hit, address = self._get_cached(self._addresses, ens_name.lower())
+        if hit:
+            return address
+        return await asyncio.to_thread(self.resolve_sync, ens_name)
+
+    @metrics.timed('ens')
+    async def lookup_name(self, address: str) -> str | None:
+        hit, name = self._get_cached(self._names, address.lower())
+        if hit:
+            return name
+        return await asyncio.to_thread(self.lookup_name_sync, address)
+
+    @metrics.timed('ens')
+    async def resolve_many(self, ens_names: list[str]) -> dict[str, str | None]:
+        """Resolve all names concurrently with at most one request per distinct uncached name, keyed by the names as given."""
+        unique_names = list({name.lower(): name for name in ens_names}.values())
+        addresses = await asyncio.gather(*(self.resolve(name) for name in unique_names))
+        resolved = {name.lower(): address for name, address in zip(unique_names, addresses)}
+        return {name: resolved[name.lower()] for name in ens_names}
+
+RESOLVER = EnsResolver()
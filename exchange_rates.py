@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+
+import httpx
+
+SNAPSHOT_PATH = os.getenv('EXCHANGE_RATES_SNAPSHOT_PATH', 'data/exchange_rates.json')
+SOURCE = os.getenv('EXCHANGE_RATES_SOURCE', 'https://open.er-api.com/v6/latest/USD')
+REFRESH_INTERVAL = float(os.getenv('EXCHANGE_RATES_REFRESH_INTERVAL', '3600'))
+RETRY_INTERVAL = 60.0
+FOLLOW_INTERVAL = 60.0
+
+class RateTable:
+    """Snapshot of exchange rates (units per USD) with a precomputed cross-rate table."""
+
+    def __init__(self, rates: dict[str, float], fetched_at: float = 0.0):
+        self.rates = {currency.upper(): float(rate) for currency, rate in rates.items() if rate}
+        self.rates['USD'] = 1.0
+        self.fetched_at = fetched_at
+        self.to_usd = {currency: 1 / rate for currency, rate in self.rates.items()}
+        self.cross = {
+            (base, quote): quote_rate / base_rate
+            for base, base_rate in self.rates.items()
+            for quote, quote_rate in self.rates.items()
+        }
+
+    def __getitem__(self, currency: str) -> float:
+        return self.rates[currency.upper()]
+
+    def __contains__(self, currency: str) -> bool:
+        return currency.upper() in self.rates
+
+    def convert(self, amount: float, currency: str, quote: str = 'USD') -> float:
+        return amount * self.cross[(currency.upper(), quote.upper())]
+
+class ApiSource:
+    """Rates from an open.er-api.com compatible endpoint."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    async def fetch(self) -> dict[str, float]:
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.get(self.url)
+        response.raise_for_status()
+        return response.json()['rates']
+
+class FileSource:
+    """Rates from a local JSON file, either a plain mapping or an API response with a 'rates' key."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def fetch(self) -> dict[str, float]:
+        data = json.loads(pathlib.Path(self.path).read_text())
+        return data.get('rates', data)
+
+def get_source(spec: str = SOURCE):
+    if spec.startswith('http://') or spec.startswith('https://'):
+        return ApiSource(spec)
+    return FileSource(spec.removeprefix('file:'))
+
+class ExchangeRateService:
+    """Keeps a RateTable up to date in the background and persists the last good snapshot for cold starts."""
+
+    def __init__(self, source=None, snapshot_path: str = SNAPSHOT_PATH, refresh_interval: float = REFRESH_INTERVAL):
+        self.source = source or get_source()
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.table = RateTable({})
+
+    def load_snapshot(self) -> bool:
+        try:
+            snapshot = json.loads(pathlib.Path(self.snapshot_path).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        self.table = RateTable(snapshot['rates'], snapshot['fetched_at'])
+        return True
+
+    def _save_snapshot(self):
+        path = pathlib.Path(self.snapshot_path)
+        # one tmp file per process, several bot workers may refresh at the same time
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps({'rates': self.table.rates, 'fetched_at': self.table.fetched_at}))
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.exception("Failed to save the exchange rate snapshot, the rates in memory are still used")
+
+    async def refresh(self) -> bool:
+        try:
+            rates = await self.source.fetch()
+        except Exception:
+            logging.exception("Failed to refresh exchange rates, keeping the previous snapshot")
+            return False
+        self.table = RateTable(rates, time.time())
+        self._save_snapshot()
+        return True
+
+    async def start(self):
+        """Load the last snapshot, fetching fresh rates only if there is none."""
+        if not self.load_snapshot():
+            await self.refresh()
+
+    async def run(self):
+        """Refresh on a schedule, meant to run as a background task for the lifetime of the bot."""
+        while True:
+            age = time.time() - self.table.fetched_at
+            await asyncio.sleep(max(self.refresh_interval - age, 0))
+            if not await self.refresh():
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    async def follow(self, interval: float = FOLLOW_INTERVAL):
+        """Reload the snapshot another process keeps refreshing, for secondary bot workers."""
+        while True:
+            await asyncio.sleep(interval)
+            self.load_snapshot()
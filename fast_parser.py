@@ -0,0 +1,124 @@
+import re
+
+import definitions as defs
+
+# Rule based parser for the handful of message shapes that make up most traffic.
+# It only answers when the whole message matches a known pattern, anything else is left to the LLM.
+
+CURRENCY_SYMBOLS = {
+    '$': 'USD',
+    '€': 'EUR',
+    '£': 'GBP',
+    '¥': 'JPY',
+    '₫': 'VND',
+    '₹': 'INR',
+    '₩': 'KRW',
+    '฿': 'THB',
+    '₱': 'PHP',
+    '₺': 'TRY',
+}
+
+CURRENCY_WORDS = {
+    'usdc': 'USDC',
+    'usd': 'USD',
+    'dollar': 'USD',
+    'dollars': 'USD',
+    'buck': 'USD',
+    'bucks': 'USD',
+    'euro': 'EUR',
+    'euros': 'EUR',
+}
+
+ISO_CURRENCIES = {
+    'AED', 'ARS', 'AUD', 'BRL', 'CAD', 'CHF', 'CLP', 'CNY', 'COP', 'CZK', 'DKK', 'EGP', 'EUR', 'GBP', 'HKD', 'HUF',
+    'IDR', 'ILS', 'INR', 'JPY', 'KES', 'KRW', 'MXN', 'MYR', 'NGN', 'NOK', 'NZD', 'PEN', 'PHP', 'PKR', 'PLN', 'RON',
+    'RUB', 'SAR', 'SEK', 'SGD', 'THB', 'TRY', 'TWD', 'UAH', 'USD', 'VND', 'ZAR',
+}
+
+MULTIPLIERS = {'': 1, 'k': 1_000, 'm': 1_000_000}
+
+SYMBOLS = ''.join(re.escape(symbol) for symbol in CURRENCY_SYMBOLS)
+AMOUNT = rf'(?P<prefix>[{SYMBOLS}])?\s*(?P<number>\d[\d,]*(?:\.\d+)?)(?P<multiplier>[km]?)(?:\s*(?P<suffix>[{SYMBOLS}]|[a-z]{{3,7}}))?'
+RECIPIENT = r'(?P<recipient>@\w{3,32}|0x[0-9a-f]{40}|[a-z0-9-]+(?:\.[a-z0-9-]+)*\.eth)'
+VERBS = r'(?:send|pay|transfer|give)'
+END = r'\s*[.!]?'
+
+TRANSFER_PATTERNS = [
+    re.compile(rf'{VERBS}\s+{RECIPIENT}\s+{AMOUNT}{END}'),
+    re.compile(rf'{VERBS}\s+{AMOUNT}\s+(?:to\s+)?{RECIPIENT}{END}'),
+]
+BALANCE_PATTERN = re.compile(r'/?(?:(?:show|check|what(?:\'s| is))\s+)?(?:my\s+)?(?:wallet\s+)?(?:balance|bal)\s*\??')
+ADDRESS_PATTERN = re.compile(r'/?(?:(?:show|what(?:\'s| is))\s+)?(?:me\s+)?(?:my\s+)?(?:wallet\s+)?address\s*\??')
+HELP_PATTERN = re.compile(r'/?help\s*[?!]?')
+THOUSANDS = re.compile(r'\d{1,3}(?:,\d{3})+(?:\.\d+)?')
+# '1.000' is 1000 in most European locales
+DOT_THOUSANDS = re.compile(r'\d{1,3}\.\d{3}')
+
+def parse_amount(number: str, multiplier: str) -> float | None:
+    if ',' in number:
+        # only accept commas as thousands separators, '10,5' could just as well be a decimal comma
+        if not THOUSANDS.fullmatch(number):
+            return None
+        number = number.replace(',', '')
+    elif DOT_THOUSANDS.fullmatch(number):
+        return None
+    return float(number) * MULTIPLIERS[multiplier]
+
+def parse_currency(prefix: str | None, suffix: str | None) -> str | None:
+    """Returns the currency code, 'USDC' when none is given, or None if the tokens are unknown or contradict each other."""
+    codes = set()
+    if prefix:
+        codes.add(CURRENCY_SYMBOLS[prefix])
+    if suffix:
+        code = CURRENCY_SYMBOLS.get(suffix) or CURRENCY_WORDS.get(suffix) or (suffix.upper() if suffix.upper() in ISO_CURRENCIES else None)
+        if code is None:
+            return None
+        codes.add(code)
+    if len(codes) > 1:
+        return None
+    return codes.pop() if codes else 'USDC'
+
+def parse_recipient(recipient: str) -> defs.RecipientType:
+    if recipient.startswith('@'):
+        return defs.RecipientType.USERNAME
+    if recipient.startswith('0x') and len(recipient) == 42:
+        return defs.RecipientType.ADDRESS
+    return defs.RecipientType.ENS
+
+def parse_transfer(match: re.Match, original: str) -> defs.BotCommand | None:
+    amount = parse_amount(match['number'], match['multiplier'])
+    currency = parse_currency(match['prefix'], match['suffix'])
+    if not amount or currency is None:
+        return None
+    # the match runs on the lower cased message, take the recipient from the original to keep its case
+    recipient = original[match.start('recipient'):match.end('recipient')]
+    is_token = currency in ('USDC', 'USD')
+    transaction = defs.Transaction(
+        amount=amount,
+        currency='USDC',
+        recipient=recipient,
+        recipient_type=parse_recipient(recipient.lower()),
+        network='default',
+        currency_type=defs.CurrencyType.TOKEN if is_token else defs.CurrencyType.FIAT,
+        equivalent_currency=None if is_token else currency
+    )
+    return defs.BotCommand(type=defs.CommandType.TRANSFER_MONEY, transactions=[transaction])
+
+def parse(message: str) -> defs.BotCommand | None:
+    """Parse the message locally, returns None if it is not confidently one of the known shapes."""
+    stripped = message.strip()
+    text = stripped.lower()
+    if len(text) != len(stripped):
+        # lower casing changed the length (rare unicode), match positions would not line up with the original
+        return None
+    if BALANCE_PATTERN.fullmatch(text):
+        return defs.BotCommand(type=defs.CommandType.SHOW_BALANCE)
+    if ADDRESS_PATTERN.fullmatch(text):
+        return defs.BotCommand(type=defs.CommandType.SHOW_ADDRESS)
+    if HELP_PATTERN.fullmatch(text):
+        return defs.BotCommand(type=defs.CommandType.HELP)
+    for pattern in TRANSFER_PATTERNS:
+        match = pattern.fullmatch(text)
+        if match:
+            return parse_transfer(match, stripped)
+    return None
@@ -0,0 +1,124 @@
+import re
+import unicodedata
+
+import fast_parser
+import metrics
+
+# Decides whether a group message is worth an LLM call. A payment needs a payment word plus an amount and either
+# a recipient or a currency, or no word at all but a recipient, an amount and a currency ("@bob 12$").
+# Messages that mention the bot are always parsed. Private chats are not gated.
+
+PAYMENT_KEYWORDS = [
+    # English
+    'send', 'pay', 'transfer', 'split', 'give', 'owe', 'reimburse', 'refund', 'tip',
+    # Spanish, Portuguese, Italian, French
+    'enviar', 'envía', 'envia', 'manda', 'pagar', 'paga', 'transferir', 'transfiere', 'dividir', 'divide', 'reembols',
+    'inviare', 'invia', 'pagare', 'bonifico', 'dividere', 'dividi',
+    'envoie', 'envoyer', 'payer', 'paie', 'virement', 'vire', 'partager', 'partage', 'rembourse',
+    # German, Dutch
+    'sende', 'schick', 'zahl', 'bezahl', 'überweis', 'ueberweis', 'teilen', 'teile', 'stuur', 'betaal', 'overmak', 'verdeel',
+    # Turkish, Polish, Czech, Romanian
+    'gönder', 'gonder', 'öde', 'ode', 'bölüş', 'wyślij', 'wyslij', 'zapłać', 'zaplac', 'przelej', 'podziel', 'pošli', 'zaplať',
+    'trimite', 'plătește', 'plateste',
+    # Russian, Ukrainian
+    'отправ', 'перевед', 'переведи', 'переказ', 'плат', 'оплат', 'заплат', 'раздел', 'скинь', 'надішли', 'сплат',
+    # Indonesian, Malay, Filipino, Vietnamese, Thai
+    'kirim', 'bayar', 'bagi', 'hantar', 'magpadala', 'bayad', 'hatiin',
+    'gửi', 'chuyển', 'trả', 'chia', 'thanh toán',
+    'โอน', 'จ่าย', 'ส่ง', 'แบ่ง',
+    # Chinese, Japanese, Korean
+    '转', '轉', '付', '支付', '发给', '發給', '平分', '分账', '分帳',
+    '送金', '払', '振込', '振り込', '割り勘', '送って',
+    '보내', '송금', '이체', '지불', '나누', '더치',
+    # Hindi, Arabic, Persian, Hebrew
+    'भेज', 'भुगतान', 'ट्रांसफर', 'बांट', 'अदा',
+    'ارسل', 'أرسل', 'ادفع', 'حول', 'حوّل', 'قسم', 'بفرست', 'پرداخت', 'שלח', 'תשלם', 'העבר',
+]
+
+CURRENCY_KEYWORDS = [
+    *fast_parser.CURRENCY_WORDS,
+    'usdt', 'dong', 'đồng', 'rupiah', 'rupee', 'peso', 'reais', 'lira', 'baht', 'ringgit', 'yen', 'yuan',
+    'pound', 'franc', 'krone', 'kronor', 'zloty', 'złot', 'руб', 'грн', 'гривн', '元', '块', '塊', '円', '원', 'บาท', 'रुपय', 'रुपए', 'ريال', 'درهم', 'جنيه', 'שקל',
+]
+
+# scripts written without spaces, keywords there can start anywhere in a word
+NO_SPACE_SCRIPTS = ('CJK', 'HIRAGANA', 'KATAKANA', 'THAI')
+
+NUMBER_PATTERN = re.compile(r'\d')
+RECIPIENT_PATTERN = re.compile(r'@\w{3,32}|\b0x[0-9a-fA-F]{40}\b|\b[\w-]+\.eth\b')
+SYMBOL_PATTERN = re.compile(f'[{fast_parser.SYMBOLS}]')
+ISO_PATTERN = re.compile(r'\b[A-Za-z]{3}\b')
+
+GATED_MESSAGES = metrics.Counter('intent_gate_messages_total', 'Group messages by intent gate decision (forwarded to the parser or gated).', ('decision',))
+
+def _needs_word_start(keyword: str) -> bool:
+    return not unicodedata.name(keyword[0], '').startswith(NO_SPACE_SCRIPTS)
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over lower case keywords, finds all of them in one pass over the text."""
+
+    def __init__(self, keywords: dict[str, str]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list[tuple[str, str]]] = [[]]
+        for keyword, kind in keywords.items():
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append((keyword, kind))
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def kinds(self, text: str) -> set[str]:
+        """The kinds of all keywords in text, those of spaced scripts only where a word starts."""
+        found = set()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword, kind in self.output[state]:
+                start = position - len(keyword) + 1
+                if kind in found:
+                    continue
+                if start > 0 and text[start - 1].isalnum() and _needs_word_start(keyword):
+                    continue
+                found.add(kind)
+        return found
+
+AUTOMATON = KeywordAutomaton({**{keyword: 'currency' for keyword in CURRENCY_KEYWORDS}, **{keyword: 'payment' for keyword in PAYMENT_KEYWORDS}})
+
+def has_currency(text: str, kinds: set[str]) -> bool:
+    if 'currency' in kinds or SYMBOL_PATTERN.search(text):
+        return True
+    return any(token.upper() in fast_parser.ISO_CURRENCIES for token in ISO_PATTERN.findall(text))
+
+def is_payment_intent(text: str, bot_username: str | None = None) -> bool:
+    lowered = text.lower()
+    if bot_username and f'@{bot_username.lower()}' in lowered:
+        return True
+    if not NUMBER_PATTERN.search(text):
+        return False
+    kinds = AUTOMATON.kinds(lowered)
+    has_recipient = RECIPIENT_PATTERN.search(text) is not None
+    if 'payment' in kinds:
+        return has_recipient or has_currency(text, kinds)
+    return has_recipient and has_currency(text, kinds)
+
+def should_parse(text: str, bot_username: str | None = None) -> bool:
+    """Whether a group message is worth parsing, counted in intent_gate_messages_total."""
+    forward = is_payment_intent(text, bot_username)
+    GATED_MESSAGES.inc(decision='forwarded' if forward else 'gated')
+    return forward
@@ -0,0 +1,153 @@
+import contextlib
+import functools
+import inspect
+import math
+import threading
+import time
+
+REGISTRY: dict[str, 'Metric'] = {}
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labelnames)
+
+    def _format_labels(self, key: tuple[str, ...], extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = '+Inf' if bound == math.inf else str(bound)
+                    lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": le})} {count}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {self._sums[key]}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {counts[-1]}')
+        return lines
+
+def render() -> str:
+    """Render all registered metrics in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in REGISTRY.values()) + '\n'
+
+OPERATION_SECONDS = Histogram('operation_duration_seconds', 'Duration of instrumented handlers and upstream calls.', ('component', 'operation'))
+OPERATION_CALLS = Counter('operation_calls_total', 'Calls of instrumented handlers and upstream calls.', ('component', 'operation'))
+OPERATION_ERRORS = Counter('operation_errors_total', 'Calls of instrumented handlers and upstream calls that raised.', ('component', 'operation'))
+OPERATION_IN_FLIGHT = Gauge('operation_in_flight', 'Instrumented handlers and upstream calls currently running.', ('component', 'operation'))
+
+@contextlib.contextmanager
+def timing(component: str, operation: str):
+    """Record duration, calls, errors and in-flight count of a block, e.g. one that is itself a context manager."""
+    labels = {'component': component, 'operation': operation}
+    OPERATION_CALLS.inc(**labels)
+    OPERATION_IN_FLIGHT.inc(**labels)
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        OPERATION_IN_FLIGHT.dec(**labels)
+        OPERATION_SECONDS.observe(time.perf_counter() - started, **labels)
+        if failed:
+            OPERATION_ERRORS.inc(**labels)
+
+def timed(component: str):
+    """Decorator recording duration, calls, errors and in-flight count of a function or coroutine function."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with timing(component, function.__name__):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timing(component, function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
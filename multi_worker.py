@@ -0,0 +1,177 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+
+from aiohttp import web
+import telegram
+from telegram.ext import Application
+
+# Webhook mode: a small front process receives the Telegram updates over HTTPS and hands each one to one of
+# BOT_WORKERS processes, chosen by chat, so the updates of a chat are handled in order by the same worker.
+# Everything the workers share (callbacks, transactions, users, wallet pool, exchange rates) lives in data/.
+
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_HOST = os.getenv('TELEGRAM_WEBHOOK_HOST', '0.0.0.0')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8443'))
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', str(os.cpu_count() or 1)))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))
+SUPERVISE_INTERVAL = 5.0
+
+def chat_key(update: dict) -> int:
+    """The chat an update belongs to, or the user for updates without a chat (e.g. inline queries)."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if value.get('from'):
+            return value['from']['id']
+    return update.get('update_id', 0)
+
+def worker_for(update: dict, workers: int) -> int:
+    return chat_key(update) % workers
+
+class ChatSerializer:
+    """Processes updates concurrently across chats but strictly one after another within a chat."""
+
+    def __init__(self, application: Application):
+        self.application = application
+        self.queues: dict[int, asyncio.Queue] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(self, key: int, update: telegram.Update):
+        chat_queue = self.queues.get(key)
+        if chat_queue is None:
+            chat_queue = self.queues[key] = asyncio.Queue()
+            task = asyncio.create_task(self._drain(key, chat_queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        chat_queue.put_nowait(update)
+
+    async def _drain(self, key: int, chat_queue: asyncio.Queue):
+        while not chat_queue.empty():
+            update = chat_queue.get_nowait()
+            try:
+                await self.application.process_update(update)
+            except Exception:
+                logging.exception(f"Failed to process update {update.update_id}")
+        del self.queues[key]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+async def serve_updates(application: Application, updates: multiprocessing.Queue):
+    serializer = ChatSerializer(application)
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        try:
+            while True:
+                data = await asyncio.to_thread(updates.get)
+                if data is None:
+                    break
+                serializer.submit(chat_key(data), telegram.Update.de_json(data, application.bot))
+            await serializer.join()
+        finally:
+            await application.stop()
+            await application.post_shutdown(application)
+
+def run_worker(index: int, workers: int, bot_token: str, updates: multiprocessing.Queue):
+    import bot
+    import rate_limit
+    bot.IS_PRIMARY = index == 0
+    bot.WORKER_INDEX = index
+    rate_limit.LIMITER.split_upstreams(workers)
+    asyncio.run(serve_updates(bot.build_application(bot_token, polling=False), updates))
+
+class WorkerPool:
+    def __init__(self, bot_token: str, workers: int = BOT_WORKERS, queue_size: int = WORKER_QUEUE_SIZE):
+        self.bot_token = bot_token
+        # spawn, not fork: the front process may already hold sockets, threads and SQLite connections
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.processes: list[multiprocessing.Process | None] = [None] * workers
+
+    def _start(self, index: int):
+        process = self.context.Process(target=run_worker, args=(index, len(self.queues), self.bot_token, self.queues[index]), name=f'bot-worker-{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._start(index)
+
+    def submit(self, update: dict) -> bool:
+        try:
+            self.queues[worker_for(update, len(self.queues))].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    async def supervise(self, interval: float = SUPERVISE_INTERVAL):
+        """Restart workers that died, their queued updates are kept."""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logging.error(f"Bot worker {index} exited with {process.exitcode}, restarting it")
+                    self._start(index)
+
+    def stop(self, timeout: float = 30.0):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+def create_app(pool: WorkerPool, bot_token: str, webhook_secret: str = TELEGRAM_WEBHOOK_SECRET) -> web.Application:
+    # without a secret anyone who reaches the port could post updates, e.g. a forged tap on ✅ of someone's transfer
+    if not webhook_secret:
+        if not TELEGRAM_WEBHOOK_URL:
+            raise ValueError("TELEGRAM_WEBHOOK_SECRET must be set when the webhook is not registered by this process (TELEGRAM_WEBHOOK_URL)")
+        # registered with Telegram on startup, so a random secret works
+        webhook_secret = secrets.token_urlsafe(32)
+
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, webhook_secret):
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        if not pool.submit(update):
+            # Telegram redelivers updates that were not acknowledged
+            return web.Response(status=503)
+        return web.Response()
+
+    async def on_startup(app: web.Application):
+        pool.start()
+        app['supervisor'] = asyncio.create_task(pool.supervise())
+        if TELEGRAM_WEBHOOK_URL:
+            async with telegram.Bot(bot_token) as bot:
+                await bot.set_webhook(TELEGRAM_WEBHOOK_URL, secret_token=webhook_secret, allowed_updates=telegram.Update.ALL_TYPES)
+
+    async def on_cleanup(app: web.Application):
+        app['supervisor'].cancel()
+        await asyncio.to_thread(pool.stop)
+
+    app = web.Application()
+    app.router.add_post('/telegram', telegram_webhook)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main(bot_token: str, host: str = TELEGRAM_WEBHOOK_HOST, port: int = TELEGRAM_WEBHOOK_PORT):
+    """Run the webhook front end with BOT_WORKERS bot processes, TELEGRAM_WEBHOOK_URL must point to /telegram on it."""
+    pool = WorkerPool(bot_token)
+    web.run_app(create_app(pool, bot_token), host=host, port=port)
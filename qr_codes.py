@@ -0,0 +1,93 @@
+import asyncio
+import collections
+import concurrent.futures
+import io
+import os
+
+import telegram
+
+import storage
+
+QR_CODES_PATH = os.getenv('QR_CODES_PATH', 'data/qr_codes.db')
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', '256'))
+QR_RENDER_WORKERS = int(os.getenv('QR_RENDER_WORKERS', '2'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_ids (
+    payload TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL
+);
+"""
+
+def render_png(payload: str) -> bytes:
+    # imported here, it is only needed in the render worker processes
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    bio = io.BytesIO()
+    img.save(bio, 'PNG')
+    return bio.getvalue()
+
+class QrCodeCache:
+    """Renders QR codes in worker processes and remembers the Telegram file_id of every uploaded image.
+
+    A wallet address or payment link always gives the same image, so after the first upload it is resent by file_id."""
+
+    def __init__(self, path: str = QR_CODES_PATH, max_size: int = QR_CACHE_SIZE, workers: int = QR_RENDER_WORKERS):
+        self.path = path
+        self.max_size = max_size
+        self.workers = workers
+        self._images: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._executor: concurrent.futures.ProcessPoolExecutor | None = None
+        self._db: storage.Database | None = None
+
+    @property
+    def db(self) -> storage.Database:
+        if self._db is None:
+            self._db = storage.get_database(self.path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def get_file_id(self, payload: str) -> str | None:
+        rows = self.db.execute('SELECT file_id FROM file_ids WHERE payload = ?', (payload,))
+        return rows[0]['file_id'] if rows else None
+
+    def set_file_id(self, payload: str, file_id: str | None):
+        if file_id is None:
+            self.db.execute('DELETE FROM file_ids WHERE payload = ?', (payload,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO file_ids VALUES (?, ?)', (payload, file_id))
+
+    async def render(self, payload: str) -> bytes:
+        if payload in self._images:
+            self._images.move_to_end(payload)
+            return self._images[payload]
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        png = await asyncio.get_running_loop().run_in_executor(self._executor, render_png, payload)
+        self._images[payload] = png
+        while len(self._images) > self.max_size:
+            self._images.popitem(last=False)
+        return png
+
+    async def send(self, bot: telegram.Bot, chat_id: int, payload: str, **kwargs) -> telegram.Message:
+        """Send the QR code for payload as a photo, by file_id when it was uploaded before."""
+        file_id = self.get_file_id(payload)
+        if file_id is not None:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except telegram.error.BadRequest:
+                # the file_id is no longer valid, upload the image again
+                self.set_file_id(payload, None)
+        message = await bot.send_photo(chat_id=chat_id, photo=await self.render(payload), **kwargs)
+        if message.photo:
+            self.set_file_id(payload, message.photo[-1].file_id)
+        return message
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,134 @@
+import collections
+import json
+import os
+import time
+
+import metrics
+
+# Token buckets per user, per chat and per upstream, configured per command type as (tokens per second, burst).
+# RATE_LIMITS can override single entries, e.g. RATE_LIMITS='{"parse": {"user": [0.5, 10]}, "upstreams": {"openai": [50, 100]}}'.
+# With several bot workers every process has its own buckets, chats stick to one worker so the chat limits stay exact
+# and every worker gets its share of the upstream limits. User limits apply per worker: a user active in chats that
+# are handled by N workers gets up to N times the user limit, the chat and upstream limits still bound the total.
+
+COMMAND_LIMITS = {
+    # free text that needs the LLM
+    'parse': {'user': (10 / 60, 5), 'chat': (30 / 60, 10)},
+    'balance': {'user': (6 / 60, 3), 'chat': (20 / 60, 10)},
+    # one token per recipient, so a 10-way split costs 10
+    'send': {'user': (30 / 60, 20), 'chat': (60 / 60, 40)},
+    'request': {'user': (6 / 60, 3), 'chat': (20 / 60, 10)},
+    # one token per uploaded payout file, its transfers are bounded by BULK_CONCURRENCY instead of 'send'
+    'bulk': {'user': (3 / 3600, 3), 'chat': (6 / 3600, 3)},
+}
+UPSTREAM_LIMITS = {
+    'openai': (20, 40),
+    'circle': (50, 100),
+}
+COMMAND_UPSTREAMS = {
+    'parse': 'openai',
+    'balance': 'circle',
+    'send': 'circle',
+}
+MAX_BUCKETS = 100_000
+
+THROTTLED = metrics.Counter('rate_limit_throttled_total', 'Requests rejected by admission control by command and the limit that was hit (user, chat or upstream).', ('command', 'scope'))
+ADMITTED = metrics.Counter('rate_limit_admitted_total', 'Requests admitted by admission control by command.', ('command',))
+
+def load_limits() -> tuple[dict, dict]:
+    command_limits = {command: dict(limits) for command, limits in COMMAND_LIMITS.items()}
+    upstream_limits = dict(UPSTREAM_LIMITS)
+    overrides = json.loads(os.getenv('RATE_LIMITS', '{}'))
+    for upstream, limit in overrides.pop('upstreams', {}).items():
+        upstream_limits[upstream] = tuple(limit)
+    for command, limits in overrides.items():
+        command_limits.setdefault(command, {}).update({scope: tuple(limit) for scope, limit in limits.items()})
+    return command_limits, upstream_limits
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Seconds until cost tokens are available, 0 if they are now."""
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        if cost > self.burst:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+class RateLimiter:
+    """Admission control in front of the upstream APIs: a request is admitted only if every bucket it touches has room."""
+
+    def __init__(self, command_limits: dict | None = None, upstream_limits: dict | None = None, max_buckets: int = MAX_BUCKETS):
+        if command_limits is None or upstream_limits is None:
+            command_limits, upstream_limits = load_limits()
+        self.command_limits = command_limits
+        self.upstream_limits = upstream_limits
+        self.max_buckets = max_buckets
+        self.buckets: collections.OrderedDict[tuple, TokenBucket] = collections.OrderedDict()
+        self._notified_until: dict[tuple[int, int], float] = {}
+
+    def split_upstreams(self, workers: int):
+        """Divide the upstream limits between workers processes, so together they stay within them."""
+        for upstream, (rate, burst) in self.upstream_limits.items():
+            # a burst below the largest single request would reject that request forever
+            largest = max((limits['user'][1] for command, limits in self.command_limits.items() if COMMAND_UPSTREAMS.get(command) == upstream and 'user' in limits), default=1)
+            self.upstream_limits[upstream] = (rate / workers, min(burst, max(burst / workers, largest)))
+        self.buckets = collections.OrderedDict((key, bucket) for key, bucket in self.buckets.items() if key[0] != 'upstream')
+
+    def _bucket(self, key: tuple, limit: tuple[float, float]) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit)
+            while len(self.buckets) > self.max_buckets:
+                # the least recently used bucket has long refilled, forgetting it changes nothing
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def admit(self, command: str, user_id: int, chat_id: int, cost: float = 1) -> float | None:
+        """Take cost tokens from every bucket of the command, or none of them and return the seconds to wait."""
+        limits = self.command_limits.get(command, {})
+        buckets = []
+        if 'user' in limits:
+            buckets.append(('user', self._bucket((command, 'user', user_id), limits['user'])))
+        if 'chat' in limits:
+            buckets.append(('chat', self._bucket((command, 'chat', chat_id), limits['chat'])))
+        upstream = COMMAND_UPSTREAMS.get(command)
+        if upstream in self.upstream_limits:
+            buckets.append(('upstream', self._bucket(('upstream', upstream), self.upstream_limits[upstream])))
+        now = time.monotonic()
+        for scope, bucket in buckets:
+            wait_time = bucket.wait_time(cost, now)
+            if wait_time > 0:
+                THROTTLED.inc(command=command, scope=scope)
+                return wait_time
+        for _, bucket in buckets:
+            bucket.take(cost)
+        ADMITTED.inc(command=command)
+        return None
+
+    def should_notify(self, user_id: int, chat_id: int, wait_time: float) -> bool:
+        """Whether to tell the user about being throttled, at most once per waiting period so the reply is not spam itself."""
+        now = time.monotonic()
+        if self._notified_until.get((user_id, chat_id), 0) > now:
+            return False
+        if len(self._notified_until) > self.max_buckets:
+            self._notified_until = {key: until for key, until in self._notified_until.items() if until > now}
+        self._notified_until[(user_id, chat_id)] = now + min(wait_time, 60)
+        return True
+
+LIMITER = RateLimiter()
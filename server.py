@@ -1,15 +1,34 @@
-from flask import Flask, request, jsonify
+import asyncio
+import collections
+import logging
+import os
+import time
+from aiohttp import web
 import telegram
 from telegram.ext import Application
 import json
-import asyncio
+import cctp_pipeline
 import circle_api
 import definitions as defs
-import requests
+import metrics
+import transaction_tracker
 from constants import *
 
-app = Flask(__name__)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '5000'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '10000'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+SEEN_NOTIFICATIONS_SIZE = 100_000
+
+NOTIFICATIONS = metrics.Counter('circle_webhook_notifications_total', 'Circle notifications received by outcome (accepted, duplicate, rejected, failed).', ('result',))
+QUEUE_DEPTH = metrics.Gauge('circle_webhook_queue_depth', 'Circle notifications waiting to be processed.')
+PROCESSING_SECONDS = metrics.Histogram('circle_webhook_processing_seconds', 'Time from receiving a Circle notification until it was processed.', ('notification_type',))
+
 bot_application: Application = None  # This will be set when the bot starts
+queue: asyncio.Queue | None = None
+seen_notifications: collections.OrderedDict[str, None] = collections.OrderedDict()
+workers: list[asyncio.Task] = []
+runner: web.AppRunner | None = None
 
 def format_amount(amount: float) -> str:
     amount = float(amount)
@@ -17,12 +36,90 @@ def format_amount(amount: float) -> str:
         return f'{amount:,.0f}'
     return f'{amount:,.2f}'
 
-@app.route('/circle-webhook', methods=['POST'])
-def circle_webhook():
-    data = request.json
-    asyncio.run(handle_circle_webhook(data))
-    return jsonify({"status": "success"}), 200
+def remember_notification(notification_id: str | None):
+    if notification_id is None:
+        return
+    seen_notifications[notification_id] = None
+    if len(seen_notifications) > SEEN_NOTIFICATIONS_SIZE:
+        seen_notifications.popitem(last=False)
+
+@metrics.timed('server')
+async def circle_webhook(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({"status": "invalid"}, status=400)
+    notification_id = data.get('notificationId')
+    if notification_id is not None and notification_id in seen_notifications:
+        # Circle retries deliveries it considers failed, those were already handled
+        NOTIFICATIONS.inc(result='duplicate')
+        return web.json_response({"status": "success"})
+    try:
+        queue.put_nowait((time.monotonic(), data))
+    except asyncio.QueueFull:
+        # let Circle retry later instead of dropping the notification
+        NOTIFICATIONS.inc(result='rejected')
+        return web.json_response({"status": "busy"}, status=503)
+    remember_notification(notification_id)
+    NOTIFICATIONS.inc(result='accepted')
+    QUEUE_DEPTH.set(queue.qsize())
+    return web.json_response({"status": "success"})
+
+@metrics.timed('server')
+async def circle_webhook_head(request: web.Request) -> web.Response:
+    # Circle checks that the endpoint is reachable before subscribing it
+    return web.Response()
+
+async def process_notifications():
+    while True:
+        received_at, data = await queue.get()
+        QUEUE_DEPTH.set(queue.qsize())
+        try:
+            await handle_circle_webhook(data)
+        except Exception:
+            NOTIFICATIONS.inc(result='failed')
+            logging.exception(f"Failed to process Circle notification {data.get('notificationId')}")
+        finally:
+            PROCESSING_SECONDS.observe(time.monotonic() - received_at, notification_type=data.get('notificationType'))
+            queue.task_done()
 
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    # Prometheus scrape endpoint, the metrics of this process only
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+def create_app(webhook: bool = True) -> web.Application:
+    app = web.Application()
+    if webhook:
+        app.router.add_post('/circle-webhook', circle_webhook)
+        app.router.add_route('HEAD', '/circle-webhook', circle_webhook_head)
+    app.router.add_get('/metrics', metrics_endpoint)
+    return app
+
+async def start(application: Application, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """Serve the webhook endpoint on the running event loop, the same one the bot uses."""
+    global bot_application, queue, runner
+    bot_application = application
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workers.extend(asyncio.create_task(process_notifications()) for _ in range(WEBHOOK_WORKERS))
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+async def start_metrics(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """Serve only /metrics, for the bot workers that do not receive the Circle webhook."""
+    global runner
+    runner = web.AppRunner(create_app(webhook=False))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+async def stop():
+    if runner is not None:
+        await runner.cleanup()
+    for worker in workers:
+        worker.cancel()
+    workers.clear()
+
+@metrics.timed('server')
 async def handle_circle_webhook(data):
     if not bot_application:
         print("Bot application not initialized")
@@ -30,6 +127,8 @@ async def handle_circle_webhook(data):
     
     notification_type = data.get('notificationType')
     notification = data['notification']
+    if notification_type in ('transactions.inbound', 'transactions.outbound') and notification.get('walletId'):
+        circle_api.BALANCE_CACHE.invalidate(notification['walletId'])
     if notification_type == 'transactions.inbound':
         await handle_inbound_transaction(notification)
         return
@@ -37,6 +136,7 @@ async def handle_circle_webhook(data):
         await handle_outbound_transaction(notification)
         return
 
+@metrics.timed('server')
 async def handle_inbound_transaction(notification):
     print('Received INBOUND transaction')
     if notification['state'] == 'CONFIRMED' and notification['tokenId'] == USDC_TOKEN_IDS[notification['blockchain']]:
@@ -60,28 +160,9 @@ async def handle_inbound_transaction(notification):
         else:
             print(f"User not found for wallet ID: {wallet_id}")
 
+@metrics.timed('server')
 async def handle_outbound_transaction(notification):
-    if notification['state'] != 'COMPLETE':
-        return
-    if not notification['refId']:
-        return
-    if notification['refId'].endswith(':approve'):
-        transaction = defs.CircleTransaction.load(f"data/transactions/{notification['refId'].replace(':approve', '')}.json")
-        print("Received approval, now burning")
-        user = defs.User.load_by_id(transaction.user_id)
-        recipient = defs.User.load_by_username(transaction.transaction.recipient)
-        
-        response = circle_api.cctp_burn_step_2(user, recipient.wallet.blockchain, recipient.wallet.address, transaction.transaction.amount, notification['refId'].replace('approve', 'burn'))
-        print(response)
-    elif notification['refId'].endswith(':burn'):
-        transaction = defs.CircleTransaction.load(f"data/transactions/{notification['refId'].replace(':burn', '')}.json")
-        # print(f"Minting on destination chain {recipient.wallet.blockchain}")
-        user = defs.User.load_by_id(transaction.user_id)
-        recipient = defs.User.load_by_username(transaction.transaction.recipient)
-        bot_application.job_queue.run_once(circle_api.cctp_mint, when=datetime.timedelta(minutes=15), job_kwargs={
-            'source_chain':user.wallet.blockchain, 'destination_walled_id': recipient.wallet.id, 'destination_chain': recipient.wallet.blockchain, 'notification': notification['txHash']})
-        # Add delayed job so that the attestation has time to be confirmed
-        # response = circle_api.cctp_mint(user.wallet.blockchain, recipient.wallet.id, recipient.wallet.blockchain, notification['txHash'])
-
-if __name__ == '__main__':
-    app.run(port=5000)  # Run on port 5000
\ No newline at end of file
+    await transaction_tracker.TRACKER.on_notification(notification)
+    if notification.get('refId') and ':' in notification['refId']:
+        # approve, burn or mint step of a cross-chain transfer
+        await cctp_pipeline.PIPELINE.on_notification(notification)
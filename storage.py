@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+class Database:
+    """Thin wrapper around a SQLite connection that can be shared between threads."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    @metrics.timed('storage')
+    def execute(self, sql: str, parameters=()) -> list[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    @metrics.timed('storage')
+    def executescript(self, sql: str):
+        with self.lock:
+            self.connection.executescript(sql)
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent writers (threads or processes) queue up instead of deadlocking
+        with metrics.timing('storage', 'transaction'), self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+_DATABASES: dict[tuple[int, str], Database] = {}
+_DATABASES_LOCK = threading.Lock()
+
+def get_database(path: str) -> Database:
+    # connections must not be shared across forked worker processes, so they are cached per pid
+    key = (os.getpid(), path)
+    with _DATABASES_LOCK:
+        if key not in _DATABASES:
+            _DATABASES[key] = Database(path)
+        return _DATABASES[key]
@@ -0,0 +1,136 @@
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Iterator
+
+import storage
+
+TRANSACTIONS_PATH = os.getenv('TRANSACTIONS_PATH', 'data/transactions.db')
+LEGACY_TRANSACTIONS_DIR = 'data/transactions'
+MIGRATION_BATCH_SIZE = 500
+STORE_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    ref_id TEXT PRIMARY KEY,
+    circle_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_circle_id ON transactions (circle_id);
+CREATE INDEX IF NOT EXISTS transactions_user_id ON transactions (user_id, created_at);
+CREATE INDEX IF NOT EXISTS transactions_chat_id ON transactions (chat_id, created_at);
+CREATE INDEX IF NOT EXISTS transactions_state ON transactions (state, created_at);
+CREATE INDEX IF NOT EXISTS transactions_message_id ON transactions (chat_id, json_extract(data, '$.message_id'));
+"""
+
+_INIT_LOCK = threading.Lock()
+_INITIALIZED: set[int] = set()
+
+def get_store() -> storage.Database:
+    db = storage.get_database(TRANSACTIONS_PATH)
+    if id(db) in _INITIALIZED:
+        return db
+    with _INIT_LOCK:
+        if db.execute('PRAGMA user_version')[0][0] != STORE_VERSION:
+            db.executescript(SCHEMA)
+            db.execute(f'PRAGMA user_version = {STORE_VERSION}')
+        _INITIALIZED.add(id(db))
+    return db
+
+def _row(data: dict, json_data: str) -> tuple:
+    created_at = data['created_at']
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at).timestamp()
+    return (data['ref_id'], data['id'], data['user_id'], data['chat_id'], data['state'], created_at, time.time(), json_data)
+
+def save_many(transactions: list[tuple[dict, str]]):
+    """Write many (fields, json) pairs in a single database transaction."""
+    with get_store().transaction() as connection:
+        connection.executemany('INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [_row(data, json_data) for data, json_data in transactions])
+
+def set_submitted(ref_id: str, circle_id: str, state: str, placeholder_state: str) -> str | None:
+    """Fill in the Circle id, the state only while it is still placeholder_state. One statement, so a webhook that already
+    moved the transaction on is never overwritten."""
+    rows = get_store().execute(
+        "UPDATE transactions SET circle_id = ?, state = CASE WHEN state = ? THEN ? ELSE state END, "
+        "data = json_set(data, '$.id', ?, '$.state', CASE WHEN state = ? THEN ? ELSE state END), updated_at = ? WHERE ref_id = ? RETURNING data",
+        (circle_id, placeholder_state, state, circle_id, placeholder_state, state, time.time(), ref_id)
+    )
+    return rows[0]['data'] if rows else None
+
+def delete(ref_id: str):
+    get_store().execute('DELETE FROM transactions WHERE ref_id = ?', (ref_id,))
+
+def load(ref_id: str) -> str | None:
+    rows = get_store().execute('SELECT data FROM transactions WHERE ref_id = ?', (ref_id,))
+    return rows[0]['data'] if rows else None
+
+def load_by_circle_id(circle_id: str) -> str | None:
+    rows = get_store().execute('SELECT data FROM transactions WHERE circle_id = ?', (circle_id,))
+    return rows[0]['data'] if rows else None
+
+def query(user_id: int | None = None, chat_id: int | None = None, message_id: int | None = None, states: list[str] | None = None, since: datetime | None = None, until: datetime | None = None, limit: int | None = None, oldest_first: bool = False) -> list[str]:
+    """Transactions matching all given filters, newest first unless oldest_first."""
+    conditions, parameters = [], []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        parameters.append(user_id)
+    if chat_id is not None:
+        conditions.append('chat_id = ?')
+        parameters.append(chat_id)
+    if message_id is not None:
+        # covered by the transactions_message_id expression index together with chat_id
+        conditions.append("json_extract(data, '$.message_id') = ?")
+        parameters.append(message_id)
+    if states:
+        conditions.append(f'state IN ({", ".join("?" * len(states))})')
+        parameters.extend(states)
+    if since is not None:
+        conditions.append('created_at >= ?')
+        parameters.append(since.timestamp())
+    if until is not None:
+        conditions.append('created_at < ?')
+        parameters.append(until.timestamp())
+    sql = 'SELECT data FROM transactions'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY created_at' if oldest_first else ' ORDER BY created_at DESC'
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+    return [row['data'] for row in get_store().execute(sql, parameters)]
+
+def _read_legacy(directory: str) -> Iterator[tuple[dict, str]]:
+    for path in pathlib.Path(directory).glob('*.json'):
+        data = json.loads(path.read_text())
+        # the file name was our own transaction id (the refId sent to Circle), the creation time was never stored
+        data.setdefault('ref_id', path.stem)
+        data.setdefault('created_at', path.stat().st_mtime)
+        yield data, json.dumps(data)
+
+def migrate(directory: str = LEGACY_TRANSACTIONS_DIR, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Import the one-file-per-transaction JSON files in batches without loading them all into memory."""
+    count = 0
+    batch = []
+    for transaction in _read_legacy(directory):
+        batch.append(transaction)
+        if len(batch) >= batch_size:
+            save_many(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        save_many(batch)
+        count += len(batch)
+    return count
+
+if __name__ == '__main__':
+    # python transaction_store.py [directory]
+    print(f'Imported {migrate(*sys.argv[1:2])} transactions')
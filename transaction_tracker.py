@@ -0,0 +1,134 @@
+import asyncio
+import html
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import telegram
+
+import circle_api
+import definitions as defs
+from utils import format_amount
+
+POLL_TICK = float(os.getenv('TRACKER_POLL_TICK', '10'))
+POLL_BATCH_SIZE = int(os.getenv('TRACKER_POLL_BATCH_SIZE', '100'))
+# pending transactions loaded per tick (newest first), webhooks keep the rest up to date
+POLL_SCAN_LIMIT = int(os.getenv('TRACKER_POLL_SCAN_LIMIT', '5000'))
+MIN_POLL_INTERVAL = 15.0
+MAX_POLL_INTERVAL = 15 * 60.0
+MAX_TRACKING_AGE = 2 * 24 * 3600.0
+
+# stored before the request to Circle so an early webhook finds it, never polled
+SUBMITTING = 'SUBMITTING'
+PENDING_STATES = ['INITIATED', 'PENDING_RISK_SCREENING', 'QUEUED', 'SENT', 'CONFIRMED', 'CLEARED', 'STUCK']
+TERMINAL_STATES = {
+    'COMPLETE': '✅ sent',
+    'FAILED': '❌ failed',
+    'CANCELLED': '❌ cancelled',
+    'DENIED': '❌ denied',
+}
+
+class TransactionTracker:
+    """Follows transfers until Circle reports a final state, then updates the confirmation message in the chat.
+
+    Webhooks drive the updates, transactions that stay quiet are polled in batches with an interval that grows with their age."""
+
+    def __init__(self):
+        self.bot: telegram.Bot | None = None
+        self._next_poll: dict[str, float] = {}
+
+    def _poll_interval(self, transaction: defs.CircleTransaction) -> float:
+        age = (datetime.now(timezone.utc) - transaction.created_at).total_seconds()
+        return min(max(age / 4, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+    async def on_notification(self, notification: dict):
+        # by refId first, a webhook can arrive before Circle's answer to the submission filled in the Circle id
+        transaction = defs.CircleTransaction.load(notification['refId']) if notification.get('refId') else None
+        if transaction is None:
+            transaction = defs.CircleTransaction.load_by_circle_id(notification['id'])
+        if transaction is None:
+            # not one of ours
+            return
+        if transaction.transfer_type is defs.TransferType.CROSS_CHAIN:
+            # this is only the approval, cctp_pipeline reports the outcome of the whole transfer
+            return
+        if not transaction.id:
+            transaction.id = notification['id']
+        self._next_poll[transaction.ref_id] = time.monotonic() + self._poll_interval(transaction)
+        await self.update_state(transaction, notification['state'])
+
+    async def update_state(self, transaction: defs.CircleTransaction, state: str):
+        if state == transaction.state:
+            return
+        transaction.state = state
+        transaction.save()
+        if state in TERMINAL_STATES:
+            self._next_poll.pop(transaction.ref_id, None)
+            await self.finish_message(transaction)
+
+    async def finish_message(self, transaction: defs.CircleTransaction):
+        """Edit the confirmation message once every transfer it started has reached a final state."""
+        if self.bot is None or transaction.message_text is None:
+            return
+        transactions = defs.CircleTransaction.query(chat_id=transaction.chat_id, message_id=transaction.message_id)
+        if any(other.state not in TERMINAL_STATES for other in transactions if other.transfer_type is defs.TransferType.SINGLE_CHAIN):
+            return
+        lines = []
+        for other in reversed(transactions):
+            amount = f'{format_amount(other.transaction.amount)} {other.transaction.equivalent_currency or "USDC"}'
+            if other.transfer_type is defs.TransferType.CROSS_CHAIN:
+                status = TERMINAL_STATES.get(other.state, '⏳ cross-chain, in progress')
+            else:
+                status = TERMINAL_STATES.get(other.state, '⏳ in progress')
+            lines.append(f'{status}: {amount} to {html.escape(other.transaction.recipient)}')
+        try:
+            await self.bot.edit_message_text(
+                chat_id=transaction.chat_id,
+                message_id=transaction.message_id,
+                text=transaction.message_text + '\n\n' + '\n'.join(lines),
+                parse_mode=telegram.constants.ParseMode.HTML
+            )
+        except telegram.error.TelegramError:
+            logging.exception(f"Failed to update the message of transaction {transaction.ref_id}")
+
+    async def poll(self, transaction: defs.CircleTransaction):
+        try:
+            circle_transaction = await circle_api.get_transaction(transaction.id)
+        except Exception:
+            logging.exception(f"Failed to poll transaction {transaction.ref_id}")
+            return
+        await self.update_state(transaction, circle_transaction['state'])
+
+    async def poll_due(self):
+        now = time.monotonic()
+        due = []
+        scanned = set()
+        # transactions older than MAX_TRACKING_AGE are never polled again, so they are not loaded either. Oldest first,
+        # so with more than POLL_SCAN_LIMIT pending the ones closest to dropping out are still polled
+        since = datetime.now(timezone.utc) - timedelta(seconds=MAX_TRACKING_AGE)
+        for transaction in defs.CircleTransaction.query(states=PENDING_STATES, since=since, limit=POLL_SCAN_LIMIT, oldest_first=True):
+            if transaction.transfer_type is not defs.TransferType.SINGLE_CHAIN:
+                continue
+            scanned.add(transaction.ref_id)
+            age = (datetime.now(timezone.utc) - transaction.created_at).total_seconds()
+            # give the webhook a chance before the first poll
+            next_poll = self._next_poll.setdefault(transaction.ref_id, now + max(MIN_POLL_INTERVAL - age, 0))
+            if next_poll <= now and len(due) < POLL_BATCH_SIZE:
+                due.append(transaction)
+                self._next_poll[transaction.ref_id] = now + self._poll_interval(transaction)
+        # forget the schedule of transactions that aged out or were finished by another process
+        self._next_poll = {ref_id: next_poll for ref_id, next_poll in self._next_poll.items() if ref_id in scanned}
+        # the Circle client bounds how many of these run at the same time
+        await asyncio.gather(*(self.poll(transaction) for transaction in due))
+
+    async def run(self, tick: float = POLL_TICK):
+        """Poll quiet transactions, meant to run as a background task for the lifetime of the bot."""
+        while True:
+            try:
+                await self.poll_due()
+            except Exception:
+                logging.exception("Transaction polling failed")
+            await asyncio.sleep(tick)
+
+TRACKER = TransactionTracker()
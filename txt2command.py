@@ -1,30 +1,147 @@
+import asyncio
+import collections
+import functools
+import hashlib
 import json
 import pathlib
 import os
+import time
 import dotenv
 
-import openai
+import command_cache
 import definitions as defs
+import fast_parser
+import metrics
 
 dotenv.load_dotenv()
 
-TRANSACTION_SCHEMA = json.loads(pathlib.Path('data/setup/BotCommand.schema.json').read_text())
-SYSTEM_PROMPT = pathlib.Path('data/setup/system_prompt.txt').read_text().replace('{transactionSchema}', json.dumps(TRANSACTION_SCHEMA, indent=4))
+MODEL = "gpt-4o-mini"
 
-CLIENT = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "15"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "4"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
 
-def parse_message(user_message: str) -> defs.BotCommand:
-    try:
-        completion = CLIENT.beta.chat.completions.parse(
-            model="gpt-4o-mini",
+SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+LATENCIES: collections.deque[float] = collections.deque(maxlen=200)
+
+PARSED_MESSAGES = metrics.Counter('txt2command_messages_total', 'Parsed messages by the parser that produced the command (local fast path, template cache or llm).', ('parser',))
+
+# The prompt, the OpenAI client (the openai package alone takes about half a second to import) and the
+# command cache are created on first use, so importing this module does no I/O and needs no credentials.
+
+@functools.cache
+def get_system_prompt() -> str:
+    transaction_schema = json.loads(pathlib.Path('data/setup/BotCommand.schema.json').read_text())
+    return pathlib.Path('data/setup/system_prompt.txt').read_text().replace('{transactionSchema}', json.dumps(transaction_schema, indent=4))
+
+@functools.cache
+def get_client():
+    import openai
+    # retries are done here (hedged), not inside the client
+    return openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+@functools.cache
+def get_command_cache() -> command_cache.CommandCache:
+    # the system prompt embeds the schema, so its hash changes whenever the prompt or the schema changes
+    return command_cache.CommandCache(hashlib.sha256(f'{MODEL}\n{get_system_prompt()}'.encode()).hexdigest())
+
+def save_command_cache():
+    if get_command_cache.cache_info().currsize:
+        get_command_cache().save()
+
+@metrics.timed('txt2command')
+def parse_message_locally(user_message: str) -> defs.BotCommand | None:
+    """The command from the fast parser or the template cache, None if it needs the LLM."""
+    bot_command = fast_parser.parse(user_message)
+    if bot_command is not None:
+        PARSED_MESSAGES.inc(parser='local')
+        return bot_command
+    bot_command = get_command_cache().get(user_message)
+    if bot_command is not None:
+        PARSED_MESSAGES.inc(parser='cache')
+        return bot_command
+    return None
+
+@metrics.timed('txt2command')
+async def parse_message_with_llm(user_message: str) -> defs.BotCommand:
+    PARSED_MESSAGES.inc(parser='llm')
+    bot_command = await parse_message_llm(user_message)
+    get_command_cache().put(user_message, bot_command)
+    return bot_command
+
+@metrics.timed('txt2command')
+async def parse_message(user_message: str) -> defs.BotCommand:
+    bot_command = parse_message_locally(user_message)
+    if bot_command is not None:
+        return bot_command
+    return await parse_message_with_llm(user_message)
+
+def hedge_delay() -> float:
+    """Start a second attempt once the first one is slower than ~95% of recent completions."""
+    if len(LATENCIES) < 20:
+        return LLM_HEDGE_DELAY
+    return max(sorted(LATENCIES)[int(len(LATENCIES) * 0.95)], 1.0)
+
+async def complete(user_message: str, started: asyncio.Event | None = None) -> defs.BotCommand:
+    async with SEMAPHORE:
+        if started is not None:
+            started.set()
+        start = time.monotonic()
+        completion = await get_client().beta.chat.completions.parse(
+            model=MODEL,
             messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "system", "content": get_system_prompt()},
                 {"role": "user", "content": user_message}
             ],
             response_format=defs.BotCommand
         )
-        bot_command = completion.choices[0].message
-        return bot_command.parsed or defs.BotCommand(type=defs.CommandType.UNKNOWN_COMMAND, transactions=[])
+        LATENCIES.append(time.monotonic() - start)
+    bot_command = completion.choices[0].message
+    return bot_command.parsed or defs.BotCommand(type=defs.CommandType.UNKNOWN_COMMAND, transactions=[])
+
+async def complete_hedged(user_message: str) -> defs.BotCommand:
+    """Run completions until one succeeds, starting another attempt when one fails or is slow, at most LLM_MAX_ATTEMPTS in total."""
+    attempts = 1
+    started = asyncio.Event()
+    pending = {asyncio.create_task(complete(user_message, started))}
+    try:
+        while True:
+            timeout = None
+            waiter = None
+            if attempts < LLM_MAX_ATTEMPTS:
+                if started.is_set():
+                    timeout = hedge_delay()
+                else:
+                    # the newest attempt still waits for the semaphore, a hedge now would only queue up behind it
+                    waiter = asyncio.create_task(started.wait())
+            done, pending = await asyncio.wait(pending if waiter is None else pending | {waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if waiter is not None:
+                waiter.cancel()
+                pending.discard(waiter)
+                done.discard(waiter)
+                if started.is_set() and not done:
+                    # the hedge delay starts now that the attempt is running
+                    continue
+            error = None
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if attempts < LLM_MAX_ATTEMPTS:
+                attempts += 1
+                started = asyncio.Event()
+                pending.add(asyncio.create_task(complete(user_message, started)))
+            elif not pending:
+                raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def parse_message_llm(user_message: str) -> defs.BotCommand:
+    try:
+        async with asyncio.timeout(LLM_DEADLINE):
+            return await complete_hedged(user_message)
     except Exception as e:
-        print(f"Error parsing message: {e}")
-        return defs.BotCommand(type=defs.CommandType.ERROR, transactions=[])
\ No newline at end of file
+        print(f"Error parsing message: {e!r}")
+        return defs.BotCommand(type=defs.CommandType.ERROR, transactions=[])
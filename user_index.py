@@ -0,0 +1,88 @@
+import json
+import os
+import pathlib
+import threading
+
+import storage
+
+USERS_DIR = 'data/users'
+INDEX_PATH = os.getenv('USER_INDEX_PATH', 'data/user_index.db')
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    wallet_id TEXT NOT NULL,
+    wallet_address TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username);
+CREATE INDEX IF NOT EXISTS users_wallet_id ON users (wallet_id);
+CREATE INDEX IF NOT EXISTS users_wallet_address ON users (wallet_address);
+"""
+
+_INIT_LOCK = threading.Lock()
+_INITIALIZED: set[int] = set()
+
+def normalize_username(username: str) -> str:
+    return username.strip().removeprefix('@').lower()
+
+def normalize_address(address: str) -> str:
+    return address.strip().lower()
+
+def get_index() -> storage.Database:
+    db = storage.get_database(INDEX_PATH)
+    if id(db) in _INITIALIZED:
+        return db
+    with _INIT_LOCK:
+        if db.execute('PRAGMA user_version')[0][0] != INDEX_VERSION:
+            # first use (or schema change): build the index from the existing user files
+            db.executescript(SCHEMA)
+            rebuild(db)
+            db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+        _INITIALIZED.add(id(db))
+    return db
+
+def _row(telegram_id: int, username: str, wallet_id: str, wallet_address: str) -> tuple:
+    return (telegram_id, normalize_username(username), wallet_id, normalize_address(wallet_address))
+
+def update(telegram_id: int, username: str, wallet_id: str, wallet_address: str):
+    get_index().execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', _row(telegram_id, username, wallet_id, wallet_address))
+
+def rebuild(db: storage.Database | None = None, users_dir: str = USERS_DIR) -> int:
+    """Recreate the index from the user JSON files, returns the number of indexed users."""
+    db = db or get_index()
+    rows = []
+    for path in pathlib.Path(users_dir).glob('*.json'):
+        user = json.loads(path.read_text())
+        rows.append(_row(user['telegram_id'], user['username'], user['wallet']['id'], user['wallet']['address']))
+    with db.transaction() as connection:
+        connection.execute('DELETE FROM users')
+        connection.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', rows)
+    return len(rows)
+
+def _find(column: str, value: str) -> int | None:
+    rows = get_index().execute(f'SELECT telegram_id FROM users WHERE {column} = ? LIMIT 1', (value,))
+    return rows[0]['telegram_id'] if rows else None
+
+def find_by_username(username: str) -> int | None:
+    username = normalize_username(username)
+    return _find('username', username) if username else None
+
+def find_by_wallet_id(wallet_id: str) -> int | None:
+    return _find('wallet_id', wallet_id)
+
+def find_by_wallet_address(wallet_address: str) -> int | None:
+    return _find('wallet_address', normalize_address(wallet_address))
+
+def find_by_usernames(usernames: list[str]) -> dict[str, int]:
+    """Resolve many usernames in a single query, keyed by normalized username. Unknown usernames are omitted."""
+    normalized = list({normalize_username(username) for username in usernames} - {''})
+    if not normalized:
+        return {}
+    placeholders = ', '.join('?' * len(normalized))
+    rows = get_index().execute(f'SELECT username, telegram_id FROM users WHERE username IN ({placeholders})', normalized)
+    return {row['username']: row['telegram_id'] for row in rows}
+
+if __name__ == '__main__':
+    print(f'Indexed {rebuild()} users')
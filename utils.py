@@ -1,4 +1,5 @@
-import requests
+import ens_resolver
+import metrics
 
 def format_amount(amount: float) -> str:
     amount = float(amount)
@@ -6,8 +7,10 @@ def format_amount(amount: float) -> str:
         return f'{amount:,.0f}'
     return f'{amount:,.2f}'
 
+@metrics.timed('ens')
 def get_ens_address(ens_name: str) -> str | None:
-    return requests.get(f'https://api.ensdata.net/{ens_name}').json().get('address')
+    return ens_resolver.RESOLVER.resolve_sync(ens_name)
 
+@metrics.timed('ens')
 def get_ens_name(address: str) -> str | None:
-    return requests.get(f'https://api.ensdata.net/{address}').json().get('ens')
\ No newline at end of file
+    return ens_resolver.RESOLVER.lookup_name_sync(address)
\ No newline at end of file
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import pathlib
+import time
+import uuid
+
+import circle_api
+import definitions as defs
+import storage
+
+POOL_PATH = os.getenv('WALLET_POOL_PATH', 'data/wallet_pool.db')
+LEGACY_WALLETS_DIR = 'data/wallets'
+LOW_WATERMARK = int(os.getenv('WALLET_POOL_LOW_WATERMARK', '20'))
+BATCH_SIZE = min(int(os.getenv('WALLET_POOL_BATCH_SIZE', '100')), 200) # Circle creates at most 200 wallets per request
+CHECK_INTERVAL = float(os.getenv('WALLET_POOL_CHECK_INTERVAL', '60'))
+BLOCKCHAINS = [defs.Blockchain(blockchain) for blockchain in os.getenv('WALLET_POOL_BLOCKCHAINS', 'ETH-SEPOLIA,ARB-SEPOLIA,MATIC-AMOY').split(',')]
+POOL_VERSION = 1
+# only one process refills a blockchain at a time, if it dies its lease runs out after this long
+REFILL_LEASE_SECONDS = 120.0
+# how long a claim that found the pool dry waits for the refill of another process
+REFILL_WAIT_SECONDS = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS wallets (
+    id TEXT PRIMARY KEY,
+    blockchain TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS wallets_blockchain ON wallets (blockchain);
+CREATE TABLE IF NOT EXISTS refill_leases (
+    blockchain TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    leased_until REAL NOT NULL
+);
+"""
+
+class WalletPool:
+    """Pool of pre-created, unassigned Circle wallets per blockchain that is refilled in the background."""
+
+    def __init__(self, path: str = POOL_PATH, blockchains: list[defs.Blockchain] = BLOCKCHAINS, low_watermark: int = LOW_WATERMARK, batch_size: int = BATCH_SIZE):
+        self.path = path
+        self.blockchains = blockchains
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self._db: storage.Database | None = None
+        self._refills: dict[defs.Blockchain, asyncio.Task] = {}
+        self._owner = uuid.uuid4().hex
+
+    @property
+    def db(self) -> storage.Database:
+        if self._db is None:
+            db = storage.get_database(self.path)
+            if db.execute('PRAGMA user_version')[0][0] != POOL_VERSION:
+                db.executescript(SCHEMA)
+                self._import_legacy_wallets(db)
+                db.execute(f'PRAGMA user_version = {POOL_VERSION}')
+            self._db = db
+        return self._db
+
+    def _import_legacy_wallets(self, db: storage.Database):
+        # wallets used to be kept in one JSON file per blockchain
+        for path in pathlib.Path(LEGACY_WALLETS_DIR).glob('*.json'):
+            wallets = defs.Wallets.load(str(path)).wallets
+            self._insert(db, [wallet for wallet in wallets if wallet.ref_id is None])
+
+    def _insert(self, db: storage.Database, wallets: list[defs.Wallet]):
+        with db.transaction() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO wallets VALUES (?, ?, ?)',
+                [(wallet.id, wallet.blockchain.value, wallet.model_dump_json()) for wallet in wallets]
+            )
+
+    def add(self, wallets: list[defs.Wallet]):
+        self._insert(self.db, wallets)
+
+    def depth(self, blockchain: defs.Blockchain) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM wallets WHERE blockchain = ?', (blockchain.value,))[0][0]
+
+    def take(self, blockchain: defs.Blockchain) -> defs.Wallet | None:
+        # a single DELETE ... RETURNING statement, so two concurrent claims can never get the same wallet
+        rows = self.db.execute(
+            'DELETE FROM wallets WHERE id = (SELECT id FROM wallets WHERE blockchain = ? LIMIT 1) RETURNING data',
+            (blockchain.value,)
+        )
+        return defs.Wallet.model_validate_json(rows[0]['data']) if rows else None
+
+    async def claim(self, blockchain: defs.Blockchain) -> defs.Wallet | None:
+        """Take an unassigned wallet, only waits for Circle if the pool ran completely dry."""
+        wallet = self.take(blockchain)
+        if wallet is None:
+            await self.refill(blockchain)
+            wallet = self.take(blockchain)
+        if self.depth(blockchain) < self.low_watermark:
+            self.refill(blockchain)
+        return wallet
+
+    def refill(self, blockchain: defs.Blockchain) -> asyncio.Task:
+        """Start a refill of the given blockchain's pool unless one is already running, returns the running refill."""
+        task = self._refills.get(blockchain)
+        if task is None or task.done():
+            task = self._refills[blockchain] = asyncio.create_task(self._refill(blockchain))
+        return task
+
+    def _lease(self, blockchain: defs.Blockchain) -> bool:
+        """Take or renew the refill lease of a blockchain, a single statement so two processes never both hold it."""
+        now = time.time()
+        rows = self.db.execute(
+            'INSERT INTO refill_leases VALUES (?, ?, ?) ON CONFLICT (blockchain) DO UPDATE SET owner = excluded.owner, leased_until = excluded.leased_until '
+            'WHERE refill_leases.owner = excluded.owner OR refill_leases.leased_until <= ? RETURNING blockchain',
+            (blockchain.value, self._owner, now + REFILL_LEASE_SECONDS, now)
+        )
+        return bool(rows)
+
+    def _release(self, blockchain: defs.Blockchain):
+        self.db.execute('DELETE FROM refill_leases WHERE blockchain = ? AND owner = ?', (blockchain.value, self._owner))
+
+    async def _refill(self, blockchain: defs.Blockchain):
+        if not self._lease(blockchain):
+            # another bot worker is refilling, wait a little for its first batch in case a claim found the pool dry
+            deadline = time.monotonic() + REFILL_WAIT_SECONDS
+            while self.depth(blockchain) == 0 and time.monotonic() < deadline:
+                await asyncio.sleep(1)
+            return
+        try:
+            while self.depth(blockchain) < self.low_watermark:
+                wallets = await circle_api.create_wallet(self.batch_size, blockchain)
+                if not wallets.wallets:
+                    break
+                self.add(wallets.wallets)
+                logging.info(f"Added {len(wallets.wallets)} wallets to the {blockchain.value} pool")
+                self._lease(blockchain)
+        except Exception:
+            logging.exception(f"Failed to refill the {blockchain.value} wallet pool")
+        finally:
+            self._release(blockchain)
+
+    async def run(self, interval: float = CHECK_INTERVAL):
+        """Keep all pools above the low watermark, meant to run as a background task for the lifetime of the bot."""
+        while True:
+            for blockchain in self.blockchains:
+                if self.depth(blockchain) < self.low_watermark:
+                    self.refill(blockchain)
+            await asyncio.sleep(interval)
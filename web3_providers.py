@@ -0,0 +1,92 @@
+import collections
+import os
+import threading
+
+import requests
+
+from constants import *
+
+WEB3_POOL_SIZE = int(os.getenv('WEB3_POOL_SIZE', '10'))
+WEB3_CACHE_SIZE = int(os.getenv('WEB3_CACHE_SIZE', '1024'))
+WEB3_TIMEOUT = float(os.getenv('WEB3_TIMEOUT', '10'))
+
+class LruCache:
+    """Small thread-safe LRU mapping, the lookups happen in worker threads."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class Web3Providers:
+    """Long-lived Web3 instances, one per chain in INFURA_ENPOINTS, each with its own keep-alive connection pool.
+
+    Receipts and decoded CCTP messages never change once a transaction is mined, so they are cached by tx hash."""
+
+    def __init__(self, pool_size: int = WEB3_POOL_SIZE, cache_size: int = WEB3_CACHE_SIZE):
+        self.pool_size = pool_size
+        self._providers = {}
+        self._lock = threading.Lock()
+        self._message_sent_topic: bytes | None = None
+        self.receipts = LruCache(cache_size)
+        self.messages = LruCache(cache_size)
+
+    def get(self, chain: str):
+        with self._lock:
+            if chain not in self._providers:
+                import web3
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._providers[chain] = web3.Web3(web3.HTTPProvider(INFURA_ENPOINTS[chain], session=session, request_kwargs={'timeout': WEB3_TIMEOUT}))
+            return self._providers[chain]
+
+    @property
+    def message_sent_topic(self) -> bytes:
+        if self._message_sent_topic is None:
+            import web3
+            self._message_sent_topic = bytes(web3.Web3.keccak(text='MessageSent(bytes)'))
+        return self._message_sent_topic
+
+    def get_transaction_receipt(self, chain: str, tx_hash: str):
+        key = (chain, tx_hash.lower())
+        receipt = self.receipts.get(key)
+        if receipt is None:
+            # raises TransactionNotFound while the transaction is not mined, those are not cached
+            receipt = self.get(chain).eth.get_transaction_receipt(tx_hash)
+            self.receipts.put(key, receipt)
+        return receipt
+
+    def get_cctp_message(self, chain: str, tx_hash: str) -> tuple[str, str]:
+        """The MessageSent bytes of a CCTP burn and their keccak hash (the key of the attestation), both 0x-prefixed."""
+        key = (chain, tx_hash.lower())
+        message = self.messages.get(key)
+        if message is not None:
+            return message
+        from eth_abi import decode
+        import web3
+        receipt = self.get_transaction_receipt(chain, tx_hash)
+        log = next((l for l in receipt['logs'] if l['topics'] and bytes(l['topics'][0]) == self.message_sent_topic), None)
+        if log is None:
+            raise ValueError("MessageSent event not found in transaction logs")
+        message_bytes = decode(['bytes'], log['data'])[0]
+        message = f'0x{message_bytes.hex()}', f'0x{bytes(web3.Web3.keccak(message_bytes)).hex()}'
+        self.messages.put(key, message)
+        return message
+
+PROVIDERS = Web3Providers()